@@ -0,0 +1,110 @@
+# analytics.py
+# Métricas de uso para el dashboard administrativo: ocupación frente a
+# capacidad por laboratorio y franja, tasas de no-show por usuario y grupo,
+# y percentiles de demanda por franja. Todo se calcula con operaciones
+# vectorizadas de pandas sobre las reservas de un rango (una fila por franja,
+# con columna 'Fecha'), sin depender de Streamlit.
+import pandas as pd
+
+weekday_names = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+demand_quantiles = [0.5, 0.9, 0.99]
+
+
+def prepare_reservations(reservations):
+    data = reservations.copy()
+    data['Fecha'] = pd.to_datetime(data['Fecha'].astype(str).str[:10])
+    if not isinstance(data['Hora'].dtype, pd.CategoricalDtype):
+        data['Hora'] = data['Hora'].astype(str).str[:5]
+    for col in ['Confirmado', 'No_show']:
+        if col not in data.columns:
+            data[col] = False
+        data[col] = data[col].fillna(False).astype(bool)
+    if 'Grupo' not in data.columns:
+        data['Grupo'] = ''
+    data['Grupo'] = data['Grupo'].fillna('').astype(str)
+    return data
+
+
+def utilization_heatmap(reservations, start_date, end_date, capacities, slots_by_lab):
+    # Ocupación promedio de cada (laboratorio, día de la semana, franja):
+    # reservas / (capacidad × cantidad de ese día de la semana en el rango)
+    days = pd.date_range(start_date, end_date, freq='D')
+    weekday_counts = pd.Series(days.weekday).value_counts()
+    rows = []
+    for lab, slots in slots_by_lab.items():
+        grid = pd.MultiIndex.from_product([range(7), slots], names=['Día_semana', 'Hora'])
+        lab_data = reservations[reservations['Laboratorio'] == lab]
+        counts = lab_data.groupby([lab_data['Fecha'].dt.weekday.rename('Día_semana'), 'Hora'], observed=True).size()
+        counts = counts.reindex(grid, fill_value=0)
+        available = weekday_counts.reindex(grid.get_level_values('Día_semana'), fill_value=0).to_numpy() * capacities[lab]
+        frame = counts.rename('Reservas').reset_index()
+        frame['Laboratorio'] = lab
+        frame['Ocupación'] = (frame['Reservas'] / available).where(available > 0).fillna(0.0)
+        rows.append(frame)
+    heatmap = pd.concat(rows, ignore_index=True)
+    heatmap['Día'] = heatmap['Día_semana'].map(dict(enumerate(weekday_names)))
+    return heatmap
+
+
+def booking_attendance(reservations, today, labs):
+    # Una reserva = mismo Reserva_ID; solo cuentan las ya pasadas de los
+    # laboratorios donde se registra asistencia. Igual que en la vista de
+    # asistencia, queda confirmada (o no-show) si lo están todas sus franjas.
+    past = reservations[(reservations['Fecha'] < pd.Timestamp(today)) & reservations['Laboratorio'].isin(labs)]
+    if past.empty:
+        return pd.DataFrame(columns=['Reserva_ID', 'Fecha', 'Laboratorio', 'Correo', 'Grupo', 'Confirmado', 'No_show'])
+    return past.groupby('Reserva_ID', as_index=False, observed=True).agg(
+        Fecha=('Fecha', 'first'),
+        Laboratorio=('Laboratorio', 'first'),
+        Correo=('Correo', 'first'),
+        Grupo=('Grupo', 'first'),
+        Confirmado=('Confirmado', 'all'),
+        No_show=('No_show', 'all'),
+    )
+
+
+def no_show_rates(bookings, by):
+    if bookings.empty:
+        return pd.DataFrame(columns=[by, 'Reservas', 'Confirmadas', 'No_show_marcados', 'Tasa_no_show'])
+    data = bookings if by != 'Grupo' else bookings[bookings['Grupo'] != '']
+    rates = data.groupby(by, observed=True).agg(
+        Reservas=('Fecha', 'size'),
+        Confirmadas=('Confirmado', 'sum'),
+        No_show_marcados=('No_show', 'sum'),
+    )
+    # Toda reserva pasada sin confirmación de asistencia cuenta como no-show
+    rates['Tasa_no_show'] = 1 - rates['Confirmadas'] / rates['Reservas']
+    return rates.sort_values(['Tasa_no_show', 'Reservas'], ascending=False).reset_index()
+
+
+def peak_demand(reservations, start_date, end_date, slots_by_lab, quantiles=demand_quantiles):
+    # Percentiles de reservas por franja sobre todos los días del rango
+    # (los días sin reservas cuentan como demanda cero)
+    days = pd.date_range(start_date, end_date, freq='D')
+    frames = []
+    for lab, slots in slots_by_lab.items():
+        lab_data = reservations[reservations['Laboratorio'] == lab]
+        if lab_data.empty:
+            demand = pd.DataFrame(0, index=days, columns=slots)
+        else:
+            demand = lab_data.groupby(['Fecha', 'Hora'], observed=True).size().unstack('Hora')
+            demand = demand.reindex(index=days, columns=slots, fill_value=0).fillna(0)
+        stats = demand.quantile(quantiles).T
+        stats.columns = [f"p{int(q * 100)}" for q in quantiles]
+        stats['Máximo'] = demand.max()
+        stats = stats.rename_axis('Hora').reset_index()
+        stats.insert(0, 'Laboratorio', lab)
+        frames.append(stats)
+    return pd.concat(frames, ignore_index=True)
+
+
+def compute_analytics(reservations, start_date, end_date, capacities, slots_by_lab, today, attendance_labs=('C402',)):
+    data = prepare_reservations(reservations)
+    bookings = booking_attendance(data, today, list(attendance_labs))
+    return {
+        'ocupacion': utilization_heatmap(data, start_date, end_date, capacities, slots_by_lab),
+        'no_show_usuarios': no_show_rates(bookings, 'Correo'),
+        'no_show_grupos': no_show_rates(bookings, 'Grupo'),
+        'demanda': peak_demand(data, start_date, end_date, slots_by_lab),
+        'reservas_evaluadas': len(bookings),
+    }
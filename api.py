@@ -0,0 +1,379 @@
+# api.py
+# API JSON local para kioscos y el portal docente. Usa las mismas reglas que
+# student_view (corte de B501, acceso al C402, límites de grupo) a través de
+# las funciones compartidas de appv3.
+#
+#   python api.py --host 127.0.0.1 --port 8502 --workers 8
+#
+# Con LABSYNC_DATA_DIR apuntando al mismo directorio, la API puede correr
+# junto a varias instancias de Streamlit.
+#
+# Endpoints:
+#   GET    /availability?lab=B501&date=2024-10-20
+#   GET    /earliest?lab=B501&duration=60[&from=2024-10-20&days=14]  (duration en múltiplos del intervalo del lab)
+#   GET    /bookings                       (Basic auth: correo:contraseña)
+#   GET    /calendar.ics                   (Basic auth) reservas en iCalendar, con ETag/Last-Modified
+#   POST   /bookings  {"lab","date","start","end","tipo","grupo","cantidad_alumnos","proposito","token"}
+#                      (token o cabecera Idempotency-Key: reintentos sin duplicar)
+#   DELETE /bookings  {"id"} (reserva completa) o {"lab","date","start","end"} (franjas)
+#   GET    /metrics                        latencias p50/p99 por ruta
+#   GET    /ready                          estado de la precarga (503 mientras siga en curso)
+import argparse
+import base64
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+import appv3
+
+# Objetivos de latencia por ruta (milisegundos)
+latency_targets_ms = {'p50': 50, 'p99': 250}
+
+latencies = {}
+latencies_lock = threading.Lock()
+
+def refresh_shared_state():
+    # Capacidades y horarios se revalidan por mtime en cada solicitud (la app
+    # Streamlit u otra instancia de la API pueden modificarlos). Bloqueos,
+    # índice de reservas y lista de espera se revalidan solos en appv3.
+    appv3.refresh_shared_config()
+
+
+def record_latency(route, elapsed_ms):
+    with latencies_lock:
+        latencies.setdefault(route, deque(maxlen=10000)).append(elapsed_ms)
+
+
+def latency_summary():
+    with latencies_lock:
+        snapshot = {route: list(values) for route, values in latencies.items()}
+    summary = {}
+    for route, values in snapshot.items():
+        series = pd.Series(values)
+        p50 = float(series.quantile(0.50))
+        p99 = float(series.quantile(0.99))
+        summary[route] = {
+            'n': len(values),
+            'p50_ms': round(p50, 2),
+            'p99_ms': round(p99, 2),
+            'cumple_objetivo': p50 <= latency_targets_ms['p50'] and p99 <= latency_targets_ms['p99'],
+        }
+    return {'objetivos_ms': latency_targets_ms, 'rutas': summary}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        raise ApiError(400, "Fecha inválida, usa el formato YYYY-MM-DD.")
+
+
+def parse_lab(value):
+    if value not in appv3.laboratories:
+        raise ApiError(404, f"Laboratorio desconocido: {value}")
+    return value
+
+
+class LabSyncHandler(BaseHTTPRequestHandler):
+    server_version = "LabSyncAPI/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        route = f"{method} {url.path}"
+        handler = routes.get((method, url.path))
+        try:
+            if handler is None:
+                raise ApiError(404, "Ruta no encontrada.")
+            refresh_shared_state()
+            status, payload, *headers = handler(self, parse_qs(url.query))
+        except ApiError as e:
+            status, payload, headers = e.status, {'error': e.message}, []
+        except Exception as e:
+            status, payload, headers = 500, {'error': str(e)}, []
+        if isinstance(payload, bytes):
+            self.send_raw(status, payload, headers[0])
+        else:
+            self.send_json(status, payload)
+        record_latency(route, (time.perf_counter() - start) * 1000)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_raw(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ApiError(400, "El cuerpo debe ser JSON válido.")
+        if not isinstance(body, dict):
+            raise ApiError(400, "El cuerpo debe ser un objeto JSON.")
+        return body
+
+    def current_user(self):
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Basic '):
+            raise ApiError(401, "Se requiere autenticación Basic (correo:contraseña).")
+        try:
+            correo, contraseña = base64.b64decode(header[6:]).decode('utf-8').split(':', 1)
+        except ValueError:
+            raise ApiError(401, "Credenciales mal formadas.")
+        user_row = appv3.authenticate_user(correo, contraseña)
+        if user_row is None:
+            raise ApiError(401, "Correo o contraseña incorrectos.")
+        return user_row
+
+
+def get_availability(handler, query):
+    lab = parse_lab(query.get('lab', [None])[0])
+    day = parse_date(query.get('date', [None])[0])
+    availability, capacity = appv3.get_day_availability(day.strftime("%Y-%m-%d"), lab)
+    slots = [
+        {'hora': hour, 'disponibles': info['disponibles'], 'bloqueado': info['bloqueado']}
+        for hour, info in availability.items()
+    ]
+    return 200, {'lab': lab, 'date': day.strftime("%Y-%m-%d"), 'capacidad': capacity, 'franjas': slots}
+
+
+def get_earliest(handler, query):
+    lab = parse_lab(query.get('lab', [None])[0])
+    from_day = parse_date(query.get('from', [datetime.today().strftime("%Y-%m-%d")])[0])
+    try:
+        duration = int(query.get('duration', ['30'])[0])
+        days = int(query.get('days', ['14'])[0])
+    except ValueError:
+        raise ApiError(400, "duration y days deben ser enteros.")
+    interval = int(appv3.lab_hours[lab]['intervalo'])
+    if duration <= 0 or duration % interval:
+        raise ApiError(400, f"duration debe ser múltiplo de {interval} minutos.")
+    found = appv3.find_earliest_slot(lab, from_day, duration // interval, min(days, 90))
+    if found is None:
+        return 404, {'error': "No hay horarios libres en el rango consultado."}
+    date_str, start, end = found
+    return 200, {'lab': lab, 'date': date_str, 'start': start, 'end': end}
+
+
+def list_bookings(handler, query):
+    user_row = handler.current_user()
+    reservations = appv3.get_user_reservations(user_row['Correo'])
+    columns = ['Reserva_ID', 'Fecha', 'Laboratorio', 'Hora', 'Propósito', 'Tipo', 'Grupo', 'Cantidad_alumnos']
+    reservations = reservations.reindex(columns=columns).fillna('')
+    return 200, {'reservas': reservations.to_dict(orient='records')}
+
+
+def not_modified(request_headers, etag, last_modified):
+    # If-None-Match tiene prioridad sobre If-Modified-Since (RFC 9110)
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request_headers.get('If-Modified-Since')
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def get_calendar(handler, query):
+    user_row = handler.current_user()
+    calendar = appv3.get_user_calendar(user_row['Correo'])
+    headers = {
+        'Content-Type': 'text/calendar; charset=utf-8',
+        'Content-Disposition': 'inline; filename="reservas_laboratorio.ics"',
+        'ETag': calendar['etag'],
+        'Cache-Control': 'private, no-cache',
+    }
+    if calendar['last_modified'] is not None:
+        headers['Last-Modified'] = formatdate(calendar['last_modified'], usegmt=True)
+    if not_modified(handler.headers, calendar['etag'], calendar['last_modified']):
+        return 304, b'', headers
+    return 200, calendar['ics'], headers
+
+
+def create_booking(handler, query):
+    user_row = handler.current_user()
+    body = handler.read_json()
+    lab = parse_lab(body.get('lab'))
+    day = parse_date(body.get('date'))
+    if day < datetime.today().date():
+        raise ApiError(400, "No puedes reservar en fechas pasadas.")
+
+    accessible_labs, _ = appv3.resolve_accessible_labs(user_row)
+    if lab not in accessible_labs:
+        raise ApiError(403, f"No tienes acceso al laboratorio {lab}.")
+
+    start, end = body.get('start'), body.get('end')
+    try:
+        desired_hours = appv3.get_desired_hours(lab, start, end)
+    except ValueError:
+        raise ApiError(400, "Error al parsear las horas seleccionadas.")
+    if not desired_hours:
+        raise ApiError(400, "La hora de fin debe ser posterior a la de inicio.")
+    error = appv3.validate_time_range(lab, start, end)
+    if error:
+        raise ApiError(400, error)
+
+    if lab == 'C402':
+        reservation_type = body.get('tipo', 'Individual')
+        if reservation_type not in ('Individual', 'Grupal'):
+            raise ApiError(400, "tipo debe ser Individual o Grupal.")
+        grupo = body.get('grupo', '') if reservation_type == 'Grupal' else ''
+        try:
+            cantidad_alumnos = int(body.get('cantidad_alumnos', 2)) if reservation_type == 'Grupal' else 1
+        except (TypeError, ValueError):
+            raise ApiError(400, "cantidad_alumnos debe ser un número entero.")
+        if reservation_type == 'Grupal' and cantidad_alumnos < 2:
+            raise ApiError(400, "Una reserva grupal requiere al menos 2 alumnos.")
+        propósito = body.get('proposito', '')
+    else:
+        reservation_type, grupo, cantidad_alumnos, propósito = '', '', 1, ''
+
+    # Reintentos con el mismo token (o cabecera Idempotency-Key) no duplican la reserva
+    token = str(body.get('token') or handler.headers.get('Idempotency-Key') or '')
+    booking_id, error = appv3.book_reservation(
+        user_row, lab, day, desired_hours, propósito, reservation_type, grupo, cantidad_alumnos, token
+    )
+    if error:
+        raise ApiError(409, error)
+    return 201, {'id': booking_id, 'lab': lab, 'date': day.strftime("%Y-%m-%d"), 'start': start, 'end': end}
+
+
+def cancel_booking(handler, query):
+    user_row = handler.current_user()
+    body = handler.read_json()
+    if body.get('id'):
+        booking_id = str(body['id'])
+        found = appv3.find_booking(booking_id)
+        removed = appv3.cancel_booking(user_row['Correo'], booking_id)
+        if not removed:
+            raise ApiError(404, "No se encontró la reserva.")
+        appv3.record_audit(
+            'Eliminación de reserva', user_row['Correo'], f"{found[0]} - {found[1]} ({booking_id}) (API)",
+            actor=user_row['Correo']
+        )
+        return 200, {'franjas_canceladas': removed}
+    lab = parse_lab(body.get('lab'))
+    day = parse_date(body.get('date'))
+    try:
+        cancel_hours = appv3.get_desired_hours(lab, body.get('start'), body.get('end'))
+    except ValueError:
+        raise ApiError(400, "Error al parsear las horas seleccionadas.")
+    removed = appv3.cancel_reservation(user_row['Correo'], day.strftime("%Y-%m-%d"), lab, cancel_hours)
+    if not removed:
+        raise ApiError(404, "No se encontraron reservas en ese rango.")
+    appv3.record_audit(
+        'Eliminación de reserva', user_row['Correo'],
+        f"{day.strftime('%Y-%m-%d')} - {lab} - {appv3.hour_runs(lab, cancel_hours)} (API)",
+        actor=user_row['Correo']
+    )
+    return 200, {'franjas_canceladas': removed}
+
+
+def get_metrics(handler, query):
+    return 200, latency_summary()
+
+
+def get_ready(handler, query):
+    # Las demás rutas responden igual antes de terminar la precarga (cargan a demanda)
+    status = appv3.warmup_status()
+    return (200 if status['listo'] else 503), status
+
+
+routes = {
+    ('GET', '/availability'): get_availability,
+    ('GET', '/earliest'): get_earliest,
+    ('GET', '/bookings'): list_bookings,
+    ('GET', '/calendar.ics'): get_calendar,
+    ('POST', '/bookings'): create_booking,
+    ('DELETE', '/bookings'): cancel_booking,
+    ('GET', '/metrics'): get_metrics,
+    ('GET', '/ready'): get_ready,
+}
+
+
+class PooledHTTPServer(HTTPServer):
+    # Atiende las solicitudes con un conjunto fijo de hilos que comparten el
+    # mismo estado de appv3 (candados por día, capacidades y bloqueos).
+    def __init__(self, address, handler_class, workers):
+        super().__init__(address, handler_class)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='labsync-api')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_worker, request, client_address)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API JSON de Lab Sync")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    server = PooledHTTPServer((args.host, args.port), LabSyncHandler, args.workers)
+    appv3.start_warmup()
+    print(f"API de Lab Sync escuchando en http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,146 @@
 #a
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import datetime, timedelta, timezone
 import os
+import re
 import glob
+import time
+import threading
 import plotly.express as px
 import json
+import heapq
+import bisect
+import textwrap
+import copy
+import hashlib
+import uuid
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from openpyxl.styles import Font
+
+import analytics
+import search
+import audit
 
 # ==============================
 # ARCHIVOS LOCALES / CONFIGURACIÓN
 # ==============================
-
-user_data_file = 'user_data.xlsx'
-schedule_file = 'blocked_schedules.xlsx'
-lab_capacities_file = 'lab_capacities.json'
-group_limits_file = 'group_limits.xlsx'
-comments_file = 'comments.xlsx'
-initial_image_file_B501 = 'initial_image_B501.png'
-initial_image_file_C402 = 'initial_image_C402.png'
+# Todos los archivos viven en LABSYNC_DATA_DIR (por defecto, el directorio de
+# trabajo). Varios procesos de Streamlit y la API pueden compartir el mismo
+# directorio: las escrituras son atómicas, las lecturas-modificaciones-
+# escrituras van bajo candados de archivo y cada proceso revalida su estado
+# en memoria con el mtime de los archivos.
+data_dir = os.environ.get('LABSYNC_DATA_DIR', '.')
+
+def data_path(name):
+    return os.path.join(data_dir, name)
+
+user_data_file = data_path('user_data.xlsx')
+schedule_file = data_path('blocked_schedules.xlsx')
+lab_capacities_file = data_path('lab_capacities.json')
+group_limits_file = data_path('group_limits.xlsx')
+comments_file = data_path('comments.xlsx')
+locks_dir = data_path('locks')
 # (Ya no usamos fondo personalizado)
 
+def initial_image_file(lab):
+    return data_path(f'initial_image_{lab}.png')
+
+# ------------------------------
+# ESCRITURA ATÓMICA Y CANDADOS ENTRE PROCESOS
+# ------------------------------
+def atomic_write(path, write):
+    # Se escribe en un temporal oculto del mismo directorio y se reemplaza de
+    # una vez: ningún lector ve un archivo a medio escribir.
+    folder, name = os.path.split(path)
+    tmp_file = os.path.join(folder, f".{name}.{os.getpid()}-{threading.get_ident()}{os.path.splitext(name)[1]}")
+    try:
+        write(tmp_file)
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def write_excel(df, path):
+    atomic_write(path, lambda tmp_file: df.to_excel(tmp_file, index=False))
+
+def write_json(data, path):
+    def write(tmp_file):
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+    atomic_write(path, write)
+
+def write_text(text, path):
+    def write(tmp_file):
+        with open(tmp_file, 'w') as f:
+            f.write(text)
+    atomic_write(path, write)
+
+@st.cache_resource
+def get_shared_locks():
+    return {'guard': threading.Lock(), 'locks': {}}
+
+@contextmanager
+def shared_lock(name):
+    # RLock para los hilos de este proceso más flock sobre locks/<name>.lock
+    # para los demás procesos. Reentrante en el mismo hilo. Sin fcntl
+    # (Windows) solo protege dentro del proceso.
+    locks = get_shared_locks()
+    with locks['guard']:
+        if name not in locks['locks']:
+            locks['locks'][name] = {'rlock': threading.RLock(), 'depth': 0, 'file': None}
+        lock = locks['locks'][name]
+    with lock['rlock']:
+        if lock['depth'] == 0 and fcntl is not None:
+            os.makedirs(locks_dir, exist_ok=True)
+            lock['file'] = open(os.path.join(locks_dir, f"{name}.lock"), 'a')
+            fcntl.flock(lock['file'], fcntl.LOCK_EX)
+        lock['depth'] += 1
+        try:
+            yield
+        finally:
+            lock['depth'] -= 1
+            if lock['depth'] == 0 and lock['file'] is not None:
+                fcntl.flock(lock['file'], fcntl.LOCK_UN)
+                lock['file'].close()
+                lock['file'] = None
+
+def file_version(path):
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+# Valores leídos de archivos compartidos, cacheados por proceso y validados
+# con el mtime en cada uso: lo que cambie otro proceso se ve en el siguiente
+# rerun o en la siguiente solicitud de la API.
+@st.cache_resource
+def get_shared_files():
+    return {'lock': threading.Lock(), 'files': {}}
+
+def read_shared_file(path, loader, copy_value=True):
+    # copy_value=False solo si el llamador no modifica el valor devuelto
+    shared = get_shared_files()
+    mtime = file_version(path)
+    with shared['lock']:
+        cached = shared['files'].get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, loader())
+        with shared['lock']:
+            shared['files'][path] = cached
+    return copy.deepcopy(cached[1]) if copy_value else cached[1]
+
 # ------------------------------
 # CARGAR / GUARDAR CAPACIDADES
 # ------------------------------
@@ -30,17 +151,118 @@ def load_lab_capacities():
             return json.load(f)
     else:
         capacities = {"B501": 15, "C402": 22}
-        with open(lab_capacities_file, 'w') as f:
-            json.dump(capacities, f)
+        write_json(capacities, lab_capacities_file)
         return capacities
 
 def save_lab_capacities(capacities):
-    with open(lab_capacities_file, 'w') as f:
-        json.dump(capacities, f)
+    write_json(capacities, lab_capacities_file)
 
-lab_capacities = load_lab_capacities()
 laboratories = ["B501", "C402"]
 
+# ------------------------------
+# ESQUEMA DE LOS DATOS CARGADOS
+# ------------------------------
+# Todos los lectores de Excel convierten las columnas a los mismos tipos en
+# vez de dejar que read_excel los infiera en cada lectura: categorías para
+# los valores de pocas opciones, enteros pequeños y fechas reales. 'Hora' es
+# una categoría ordenada con una categoría por minuto del día, así el código
+# de cada valor es su minuto y las franjas se obtienen con aritmética entera.
+hour_dtype = pd.CategoricalDtype([f"{m // 60:02d}:{m % 60:02d}" for m in range(24 * 60)], ordered=True)
+lab_dtype = pd.CategoricalDtype(laboratories)
+reservation_type_dtype = pd.CategoricalDtype(['', 'Individual', 'Grupal'])
+role_dtype = pd.CategoricalDtype(['alumno', 'admin', 'c402_admin'])
+
+# Columna -> (tipo, valor para vacíos o columnas faltantes)
+reservation_columns = [
+    'Nombre', 'Apellido', 'Código', 'Correo',
+    'Laboratorio', 'Hora', 'Propósito', 'Tipo',
+    'Grupo', 'Cantidad_alumnos', 'Reserva_ID'
+]
+reservation_schema = {
+    'Nombre': (str, ''),
+    'Apellido': (str, ''),
+    'Código': (str, ''),
+    'Correo': (str, ''),
+    'Laboratorio': (lab_dtype, None),
+    'Hora': (hour_dtype, None),
+    'Propósito': (str, ''),
+    'Tipo': (reservation_type_dtype, ''),
+    'Grupo': (str, ''),
+    'Cantidad_alumnos': ('int16', 1),
+    # Agrupa las franjas de una misma reserva (ver fill_booking_ids)
+    'Reserva_ID': (str, ''),
+    'Fecha': (str, ''),
+    # Solo existen en los días con asistencia registrada (C402)
+    'Confirmado': (bool, False),
+    'No_show': (bool, False),
+    # Token de la confirmación que creó la fila (vacío en filas antiguas)
+    'Token': (str, ''),
+}
+user_columns = [
+    'Nombre', 'Apellido', 'Correo', 'Rol',
+    'Código', 'Contraseña', 'C402_access', 'Temp_access_expiry'
+]
+user_schema = {
+    'Nombre': (str, ''),
+    'Apellido': (str, ''),
+    'Correo': (str, ''),
+    'Rol': (role_dtype, 'alumno'),
+    'Código': (str, ''),
+    'Contraseña': (str, ''),
+    'C402_access': ('int8', 0),
+    'Temp_access_expiry': ('datetime64[ns]', None),
+}
+
+def to_hours(values):
+    # "HH:MM", "HH:MM:SS" o datetime.time; lo que no sea una hora queda vacío
+    if values.dtype == hour_dtype:
+        return values
+    return values.astype(str).str[:5].astype(hour_dtype)
+
+def hour_minutes(values):
+    # Minuto del día de cada hora (-1 si está vacía)
+    return to_hours(values).cat.codes.to_numpy()
+
+def convert_column(values, dtype, default):
+    if dtype is hour_dtype:
+        return to_hours(values)
+    if dtype == 'datetime64[ns]':
+        return pd.to_datetime(values, errors='coerce', format='mixed').astype(dtype)
+    if default is not None:
+        values = values.fillna(default)
+    if dtype in ('int8', 'int16'):
+        return pd.to_numeric(values, errors='coerce').fillna(default).astype(dtype)
+    return values.astype(dtype)
+
+def apply_schema(df, schema, columns):
+    # Agrega las columnas obligatorias que falten y convierte todas las del
+    # esquema; las columnas desconocidas se conservan sin cambios.
+    df = df.loc[:, ~df.columns.astype(str).str.contains('^Unnamed')].copy()
+    for col in columns:
+        if col not in df.columns:
+            df[col] = schema[col][1]
+    for col, (dtype, default) in schema.items():
+        if col in df.columns:
+            df[col] = convert_column(df[col], dtype, default)
+    return df
+
+def excel_text_columns(schema):
+    # El texto se lee como texto (códigos y contraseñas numéricas incluidos)
+    return {
+        col: str for col, (dtype, _) in schema.items()
+        if dtype is str or isinstance(dtype, pd.CategoricalDtype)
+    }
+
+def read_typed_excel(path, schema, columns):
+    return apply_schema(pd.read_excel(path, index_col=None, dtype=excel_text_columns(schema)), schema, columns)
+
+def read_reservations_file(path):
+    return read_reservation_files([path])[path]
+
+def empty_reservations(extra_columns=()):
+    columns = reservation_columns + [c for c in extra_columns if c not in reservation_columns]
+    return apply_schema(pd.DataFrame(columns=columns), reservation_schema, columns)
+
 # ------------------------------
 # GENERAR FRANJAS HORARIAS
 # ------------------------------
@@ -52,123 +274,1585 @@ def generate_time_slots(start_time, end_time, interval_minutes=30):
         current_time += timedelta(minutes=interval_minutes)
     return slots
 
-hours = generate_time_slots(
-    datetime.strptime("08:00", "%H:%M"),
-    datetime.strptime("20:00", "%H:%M"),
-    interval_minutes=30
-)
+# ------------------------------
+# HORARIO Y GRANULARIDAD POR LABORATORIO
+# ------------------------------
+# Cada laboratorio define su apertura, cierre e intervalo (minutos). Las
+# franjas de un día se representan como bits de un entero: el bit i es la
+# franja i de la grilla del laboratorio, así que solapamientos, bloqueos y
+# ventanas libres se resuelven con operaciones a nivel de bits.
+lab_hours_file = data_path('lab_hours.json')
+default_lab_hours = {"apertura": "08:00", "cierre": "20:00", "intervalo": 30}
+
+def load_lab_hours():
+    config = {lab: dict(default_lab_hours) for lab in laboratories}
+    if os.path.exists(lab_hours_file):
+        with open(lab_hours_file, 'r') as f:
+            for lab, values in json.load(f).items():
+                config.setdefault(lab, dict(default_lab_hours)).update(values)
+    return config
+
+def save_lab_hours(config):
+    write_json(config, lab_hours_file)
+
+def refresh_shared_config():
+    # Se llama en cada rerun y en cada solicitud de la API
+    global lab_capacities, lab_hours
+    lab_capacities = read_shared_file(lab_capacities_file, load_lab_capacities)
+    lab_hours = read_shared_file(lab_hours_file, load_lab_hours)
+
+refresh_shared_config()
+
+def to_minutes(hhmm):
+    h, m = str(hhmm)[:5].split(':')
+    return int(h) * 60 + int(m)
+
+def get_lab_slots(lab):
+    # Horas de inicio de cada franja del laboratorio
+    config = lab_hours[lab]
+    return generate_time_slots(
+        datetime.strptime(config['apertura'], "%H:%M"),
+        datetime.strptime(config['cierre'], "%H:%M"),
+        interval_minutes=int(config['intervalo'])
+    )
+
+def get_lab_boundaries(lab):
+    # Inicios de franja más la hora de cierre: valores válidos para inicio/fin
+    return get_lab_slots(lab) + [lab_hours[lab]['cierre']]
+
+def slot_index(lab, hora):
+    config = lab_hours[lab]
+    offset = to_minutes(hora) - to_minutes(config['apertura'])
+    interval = int(config['intervalo'])
+    if offset < 0 or offset % interval:
+        return None
+    i = offset // interval
+    return i if i < len(get_lab_slots(lab)) else None
+
+def slots_mask(lab, slot_hours):
+    mask = 0
+    for hora in slot_hours:
+        i = slot_index(lab, hora)
+        if i is not None:
+            mask |= 1 << i
+    return mask
+
+def mask_to_slots(lab, mask):
+    slots = get_lab_slots(lab)
+    return [slots[i] for i in range(len(slots)) if mask >> i & 1]
+
+def full_day_mask(lab):
+    return (1 << len(get_lab_slots(lab))) - 1
+
+def hour_slot_indices(lab, hours):
+    # Índice de franja de cada hora en la grilla del laboratorio (-1 si no cae
+    # en un inicio de franja)
+    config = lab_hours[lab]
+    interval = int(config['intervalo'])
+    offsets = hour_minutes(hours) - to_minutes(config['apertura'])
+    indices = offsets // interval
+    valid = (offsets >= 0) & (offsets % interval == 0) & (indices < len(get_lab_slots(lab)))
+    return np.where(valid, indices, -1)
+
+def slot_counts(lab, reservations):
+    indices = hour_slot_indices(lab, reservations.loc[reservations['Laboratorio'] == lab, 'Hora'])
+    return np.bincount(indices[indices >= 0], minlength=len(get_lab_slots(lab))).tolist()
+
+def counts_to_full_mask(counts, capacity):
+    mask = 0
+    for i, count in enumerate(counts):
+        if count >= capacity:
+            mask |= 1 << i
+    return mask
+
+def window_starts_mask(free_mask, n_slots):
+    # Bit i activo si las franjas i..i+n_slots-1 están todas libres
+    run = free_mask
+    for k in range(1, n_slots):
+        run &= free_mask >> k
+    return run
 
 # --------------------------------
 # CARGAR / GUARDAR DATOS DE USUARIOS (Excel local)
 # --------------------------------
 def load_user_data():
     if os.path.exists(user_data_file):
-        df = pd.read_excel(user_data_file, index_col=None)
-        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-        required_columns = [
-            'Nombre', 'Apellido', 'Correo', 'Rol',
-            'Código', 'Contraseña', 'C402_access', 'Temp_access_expiry'
-        ]
-        for col in required_columns:
-            if col not in df.columns:
-                if col == 'Temp_access_expiry':
-                    df[col] = pd.NaT
-                elif col == 'C402_access':
-                    df[col] = 0
-                else:
-                    df[col] = ''
-        return df
-    else:
-        # Crear DataFrame vacío con columnas requeridas
-        df = pd.DataFrame(columns=[
-            'Nombre', 'Apellido', 'Correo', 'Rol',
-            'Código', 'Contraseña', 'C402_access', 'Temp_access_expiry'
-        ])
-        return df
+        return read_typed_excel(user_data_file, user_schema, user_columns)
+    # Crear DataFrame vacío con columnas requeridas
+    return apply_schema(pd.DataFrame(columns=user_columns), user_schema, user_columns)
+
+# Versión por usuario: cada guardado incrementa la de los usuarios que
+# modificó, y las sesiones la comparan con la de su perfil en memoria. Se
+# guarda en disco para que los demás procesos también la vean.
+user_versions_file = data_path('user_versions.json')
+
+def load_user_versions():
+    if os.path.exists(user_versions_file):
+        with open(user_versions_file, 'r') as f:
+            return json.load(f)
+    return {}
 
-def save_user_data(df):
-    df.to_excel(user_data_file, index=False)
+def get_user_version(correo):
+    return read_shared_file(user_versions_file, load_user_versions, copy_value=False).get(correo, 0)
+
+def bump_user_versions(correos):
+    correos = list(correos)
+    if not correos:
+        return
+    with shared_lock('usuarios'):
+        versions = load_user_versions()
+        for correo in correos:
+            versions[correo] = versions.get(correo, 0) + 1
+        write_json(versions, user_versions_file)
+
+# Quien modifica usuarios recarga, cambia y guarda dentro de
+# shared_lock('usuarios'): así no pisa lo que otro proceso guardó entre su
+# lectura y su escritura.
+def save_user_data(df, changed_users=()):
+    write_excel(df, user_data_file)
+    bump_user_versions(changed_users)
+
+def set_c402_access(correo, access, expiry=pd.NaT):
+    with shared_lock('usuarios'):
+        user_data = load_user_data()
+        user_data.loc[user_data['Correo'] == correo, 'C402_access'] = access
+        user_data.loc[user_data['Correo'] == correo, 'Temp_access_expiry'] = expiry
+        save_user_data(user_data, changed_users=[correo])
 
 # --------------------------------
 # CARGAR / GUARDAR HORARIOS BLOQUEADOS (Excel local)
 # --------------------------------
-def load_schedule_data():
-    global schedule_data
-    if os.path.exists(schedule_file):
-        schedule_data = pd.read_excel(schedule_file, index_col=None)
-        schedule_data = schedule_data.loc[:, ~schedule_data.columns.str.contains('^Unnamed')]
-    else:
-        schedule_data = pd.DataFrame(columns=[
-            'Día', 'Hora', 'Laboratorio', 'Estado', 'Motivo'
-        ])
-
-def save_schedule_data():
-    schedule_data.to_excel(schedule_file, index=False)
-
-schedule_data = pd.DataFrame(columns=[
-    'Día', 'Hora', 'Laboratorio', 'Estado', 'Motivo'
-])
+# Cada fila es un intervalo [Inicio, Fin) de un laboratorio: 'Única' para un
+# día concreto o 'Semanal' para una regla que se repite el mismo día de la
+# semana desde 'Día' hasta 'Hasta' (vacío = sin fin).
+blocks_columns = ['ID', 'Laboratorio', 'Repetición', 'Día', 'Día_semana', 'Hasta', 'Inicio', 'Fin', 'Motivo']
+weekday_names = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+
+def convert_legacy_blocks(legacy):
+    # Formato anterior: una fila por franja bloqueada ('Día', 'Hora', ...).
+    # Las franjas consecutivas con el mismo motivo se unen en un intervalo.
+    rows = []
+    legacy = legacy.fillna({'Motivo': ''})
+    for (day, lab, motivo), group in legacy.groupby(['Día', 'Laboratorio', 'Motivo']):
+        interval = int(lab_hours.get(lab, default_lab_hours)['intervalo'])
+        starts = sorted({to_minutes(h) for h in group['Hora']})
+        run_start = prev = starts[0]
+        for minute in starts[1:] + [None]:
+            if minute is not None and minute == prev + interval:
+                prev = minute
+                continue
+            rows.append({
+                'Laboratorio': lab, 'Repetición': 'Única', 'Día': str(day)[:10],
+                'Día_semana': '', 'Hasta': '',
+                'Inicio': f"{run_start // 60:02d}:{run_start % 60:02d}",
+                'Fin': f"{(prev + interval) // 60:02d}:{(prev + interval) % 60:02d}",
+                'Motivo': motivo
+            })
+            if minute is not None:
+                run_start = prev = minute
+    blocks = pd.DataFrame(rows, columns=blocks_columns)
+    blocks['ID'] = range(1, len(blocks) + 1)
+    return blocks
+
+def load_blocks():
+    if not os.path.exists(schedule_file):
+        return pd.DataFrame(columns=blocks_columns)
+    blocks = pd.read_excel(schedule_file, index_col=None, dtype=str)
+    blocks = blocks.loc[:, ~blocks.columns.str.contains('^Unnamed')]
+    if 'Hora' in blocks.columns:
+        blocks = convert_legacy_blocks(blocks)
+    blocks = blocks.reindex(columns=blocks_columns).fillna('')
+    blocks['ID'] = blocks['ID'].astype(int)
+    for col in ['Día', 'Hasta']:
+        blocks[col] = blocks[col].astype(str).str[:10]
+    for col in ['Inicio', 'Fin']:
+        blocks[col] = blocks[col].astype(str).str[:5]
+    return blocks
+
+def save_blocks(blocks):
+    write_excel(blocks, schedule_file)
+
+# Índice de bloqueos por (laboratorio, fecha) y por (laboratorio, día de la
+# semana). Se reconstruye solo si cambia el archivo; los intervalos de cada
+# día se fusionan y ordenan una vez para responder con búsqueda binaria.
+@st.cache_resource
+def get_block_index():
+    return {'lock': threading.Lock(), 'mtime': None, 'once': {}, 'weekly': {}, 'days': {}}
+
+def ensure_block_index():
+    index = get_block_index()
+    mtime = file_version(schedule_file)
+    with index['lock']:
+        if index['mtime'] != mtime or mtime is None:
+            once, weekly = {}, {}
+            for row in load_blocks().to_dict(orient='records'):
+                interval = (to_minutes(row['Inicio']), to_minutes(row['Fin']))
+                if row['Repetición'] == 'Semanal':
+                    weekly.setdefault((row['Laboratorio'], int(row['Día_semana'])), []).append((row['Día'], row['Hasta'], interval))
+                else:
+                    once.setdefault((row['Laboratorio'], row['Día']), []).append(interval)
+            index.update({'mtime': mtime, 'once': once, 'weekly': weekly, 'days': {}})
+    return index
+
+def get_day_blocks(lab, date_str):
+    # Intervalos bloqueados del día, fusionados: (inicios, fines) ordenados
+    index = ensure_block_index()
+    with index['lock']:
+        key = (lab, date_str)
+        if key not in index['days']:
+            intervals = list(index['once'].get(key, []))
+            weekday = datetime.strptime(date_str, "%Y-%m-%d").weekday()
+            for desde, hasta, interval in index['weekly'].get((lab, weekday), []):
+                if desde <= date_str and (not hasta or date_str <= hasta):
+                    intervals.append(interval)
+            starts, ends = [], []
+            for start, end in sorted(intervals):
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            index['days'][key] = (starts, ends)
+        return index['days'][key]
+
+def is_range_blocked(lab, date_str, start_time, end_time):
+    starts, ends = get_day_blocks(lab, date_str)
+    start, end = to_minutes(start_time), to_minutes(end_time)
+    i = bisect.bisect_right(starts, start) - 1
+    if i >= 0 and ends[i] > start:
+        return True
+    return i + 1 < len(starts) and starts[i + 1] < end
 
 # --------------------------------
 # CARGAR / GUARDAR RESERVAS POR DÍA (Excel local)
 # --------------------------------
+def day_file(date_str):
+    return data_path(f"{date_str}.xlsx")
+
+def file_date(path):
+    return os.path.basename(path)[:10]
+
 def get_reservations_for_day(date_str):
-    reservation_file = f"{date_str}.xlsx"
-    required_columns = [
-        'Nombre', 'Apellido', 'Código', 'Correo',
-        'Laboratorio', 'Hora', 'Propósito', 'Tipo',
-        'Grupo', 'Cantidad_alumnos'
-    ]
+    reservation_file = day_file(date_str)
     if os.path.exists(reservation_file):
-        reservations = pd.read_excel(reservation_file, index_col=None)
-        reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-        for col in required_columns:
-            if col not in reservations.columns:
-                if col == 'Cantidad_alumnos':
-                    reservations[col] = 1
-                else:
-                    reservations[col] = ''
-    else:
-        reservations = pd.DataFrame(columns=required_columns)
-    return reservations
+        return read_reservations_file(reservation_file)
+    return empty_reservations()
+
+# Restricción de unicidad: un alumno no puede tener dos filas en la misma
+# franja del mismo laboratorio y día. Las reservas lo validan antes de
+# escribir; aquí se garantiza en el almacenamiento (y se limpian los
+# duplicados que dejaron versiones anteriores).
+reservation_key = ['Correo', 'Laboratorio', 'Hora']
 
 def save_reservations_for_day(df, date_str):
-    df.to_excel(f"{date_str}.xlsx", index=False)
+    df = df[~df.duplicated(reservation_key, keep='first')]
+    write_excel(df, day_file(date_str))
+    update_reservation_index(date_str, df)
+
+# Cada reserva confirmada guarda un Reserva_ID en todas sus franjas. Las
+# filas anteriores a los IDs se agrupan como el calendario: franjas
+# consecutivas del mismo alumno, laboratorio y token. Su ID se deriva de esos
+# datos (es el mismo en todos los procesos) y queda guardado en la siguiente
+# escritura del día.
+def new_booking_id():
+    return uuid.uuid4().hex[:12]
+
+def fill_booking_ids(reservations, date_str=None):
+    missing = (reservations['Reserva_ID'] == '') & reservations['Hora'].notna()
+    if not missing.any():
+        return reservations
+    legacy = reservations[missing]
+    dates = pd.Series(date_str, index=legacy.index) if date_str else legacy['Fecha']
+    minutes = pd.Series(hour_minutes(legacy['Hora']), index=legacy.index)
+    tokens = legacy['Token'] if 'Token' in legacy.columns else pd.Series('', index=legacy.index)
+    keys = [dates.rename('Fecha'), legacy['Correo'], legacy['Laboratorio'], tokens.rename('Token')]
+    for (fecha, correo, lab, token), group in legacy.groupby(keys, observed=True):
+        group_minutes = minutes[group.index]
+        for start, end in minute_runs(lab, group['Hora'].astype(str)):
+            in_run = group.index[(group_minutes >= start) & (group_minutes < end)]
+            reservations.loc[in_run, 'Reserva_ID'] = text_digest(fecha, correo, lab, token, start)
+    return reservations
+
+# Solo los archivos con nombre de fecha (YYYY-MM-DD.xlsx) son archivos de reservas
+reservation_file_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}\.xlsx$')
+
+def get_reservation_files():
+    with os.scandir(data_dir) as entries:
+        files = [e.path for e in entries if e.is_file() and reservation_file_pattern.match(e.name)]
+    return sorted(files)
+
+# --------------------------------
+# LECTURA CONCURRENTE DE ARCHIVOS DE RESERVAS
+# --------------------------------
+# Los archivos del día y los meses archivados ya leídos se guardan en memoria
+# con su mtime y tamaño: una vista que recorre N días solo vuelve a leer los
+# que cambiaron. Si faltan muchos (la primera pasada), los libros se leen en
+# un pool de procesos, porque openpyxl ocupa un núcleo por archivo. La caché
+# es LRU: pasado el tope se descartan los archivos usados hace más tiempo.
+max_read_workers = min(8, os.cpu_count() or 1)
+parallel_read_min_files = 8
+max_cached_reservation_files = 400
+
+@st.cache_resource
+def get_reservation_file_cache():
+    return {'lock': threading.Lock(), 'files': OrderedDict()}
+
+def read_excel_frames(paths, dtype):
+    read = functools.partial(pd.read_excel, index_col=None, dtype=dtype)
+    if len(paths) < parallel_read_min_files or max_read_workers < 2:
+        return [read(path) for path in paths]
+    # spawn: los procesos no heredan los hilos ni el estado de Streamlit
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(max_read_workers, len(paths)), mp_context=context) as pool:
+        return list(pool.map(read, paths))
+
+def read_reservation_files(paths):
+    # {ruta: DataFrame tipado}; cada llamada recibe su propia copia
+    cache = get_reservation_file_cache()
+    versions = {}
+    for path in paths:
+        stat = os.stat(path)
+        versions[path] = (stat.st_mtime_ns, stat.st_size)
+    with cache['lock']:
+        cached = {path: cache['files'].get(path) for path in paths}
+        for path in paths:
+            if cached[path] is not None:
+                cache['files'].move_to_end(path)
+    stale = [path for path in paths if cached[path] is None or cached[path][0] != versions[path]]
+    if stale:
+        frames = read_excel_frames(stale, excel_text_columns(reservation_schema))
+        with cache['lock']:
+            for path, frame in zip(stale, frames):
+                frame = apply_schema(frame, reservation_schema, reservation_columns)
+                date_str = file_date(path) if reservation_file_pattern.match(os.path.basename(path)) else None
+                entry = (versions[path], fill_booking_ids(frame, date_str))
+                cache['files'][path] = cached[path] = entry
+                cache['files'].move_to_end(path)
+            while len(cache['files']) > max_cached_reservation_files:
+                cache['files'].popitem(last=False)
+    return {path: cached[path][1].copy() for path in paths}
+
+def forget_reservation_files(paths):
+    cache = get_reservation_file_cache()
+    with cache['lock']:
+        for path in paths:
+            cache['files'].pop(path, None)
+
+def load_reservation_days(files):
+    # Archivos del día -> un DataFrame con la columna Fecha
+    frames = []
+    for path, reservations in read_reservation_files(files).items():
+        reservations['Fecha'] = file_date(path)
+        frames.append(reservations)
+    return frames
+
+# --------------------------------
+# ÍNDICE DE RESERVAS POR USUARIO
+# --------------------------------
+# Correo -> {fecha: [[laboratorio, hora], ...]} y Reserva_ID -> [fecha,
+# laboratorio, correo]. Se actualiza en cada
+# save_reservations_for_day y se guarda en disco con el mtime de cada día,
+# así al reiniciar solo se vuelven a leer los días que cambiaron. Si otro
+# proceso reescribió el índice, se recarga antes de usarlo o modificarlo.
+reservation_index_file = data_path('reservation_index.json')
+
+@st.cache_resource
+def get_reservation_index():
+    return {'ready': False, 'file_mtime': None, 'days': {}, 'users': {}, 'bookings': {}}
+
+def save_reservation_index(index):
+    write_json({'days': index['days'], 'users': index['users'], 'bookings': index['bookings']}, reservation_index_file)
+    index['file_mtime'] = file_version(reservation_index_file)
+
+def load_stored_reservation_index(index):
+    index['days'], index['users'], index['bookings'] = {}, {}, {}
+    if os.path.exists(reservation_index_file):
+        try:
+            with open(reservation_index_file, 'r') as f:
+                stored = json.load(f)
+            # Un índice sin reservas por ID (versión anterior) se reconstruye completo
+            index['days'], index['users'], index['bookings'] = stored['days'], stored['users'], stored['bookings']
+        except (ValueError, KeyError):
+            pass
+    index['file_mtime'] = file_version(reservation_index_file)
+
+def remove_day_from_index(index, date_str):
+    day = index['days'].pop(date_str, {})
+    for correo in day.get('users', []):
+        user_days = index['users'].get(correo, {})
+        user_days.pop(date_str, None)
+        if not user_days:
+            index['users'].pop(correo, None)
+    for booking_id in day.get('bookings', []):
+        index['bookings'].pop(booking_id, None)
+
+def index_day(index, date_str, reservations):
+    remove_day_from_index(index, date_str)
+    reservation_file = day_file(date_str)
+    if not os.path.exists(reservation_file):
+        return
+    day_users = {}
+    day_bookings = {}
+    for correo, lab, hora, booking_id in zip(
+        reservations['Correo'], reservations['Laboratorio'], reservations['Hora'], reservations['Reserva_ID']
+    ):
+        day_users.setdefault(str(correo), []).append([str(lab), str(hora)[:5]])
+        if booking_id:
+            day_bookings[booking_id] = [date_str, str(lab), str(correo)]
+    for correo, slots in day_users.items():
+        index['users'].setdefault(correo, {})[date_str] = slots
+    index['bookings'].update(day_bookings)
+    index['days'][date_str] = {
+        'mtime': os.stat(reservation_file).st_mtime_ns,
+        'users': list(day_users),
+        'bookings': list(day_bookings)
+    }
+
+def update_reservation_index(date_str, reservations):
+    index = get_reservation_index()
+    with shared_lock('indice-reservas'):
+        # Aunque este proceso no tenga el índice listo, el cambio del día se
+        # guarda sobre el índice en disco: los procesos que sí lo tienen listo
+        # lo recargan al ver otro mtime. ready sigue en False y
+        # ensure_reservation_index reconcilia el resto al primer uso.
+        if not index['ready'] or index['file_mtime'] != file_version(reservation_index_file):
+            load_stored_reservation_index(index)
+        index_day(index, date_str, reservations)
+        save_reservation_index(index)
+
+def ensure_reservation_index():
+    index = get_reservation_index()
+    with shared_lock('indice-reservas'):
+        if index['ready']:
+            if index['file_mtime'] != file_version(reservation_index_file):
+                load_stored_reservation_index(index)
+            return index
+        load_stored_reservation_index(index)
+        # Reconciliar con el disco: solo se leen los días nuevos o modificados
+        current = {file_date(f): os.stat(f).st_mtime_ns for f in get_reservation_files()}
+        for date_str in list(index['days']):
+            if date_str not in current:
+                remove_day_from_index(index, date_str)
+        changed = [
+            day_file(date_str) for date_str, mtime in current.items()
+            if index['days'].get(date_str, {}).get('mtime') != mtime
+        ]
+        for path, reservations in read_reservation_files(changed).items():
+            index_day(index, file_date(path), reservations)
+        index['ready'] = True
+        save_reservation_index(index)
+    return index
+
+def invalidate_reservation_index():
+    index = get_reservation_index()
+    with shared_lock('indice-reservas'):
+        index['ready'] = False
+
+def get_user_booked_dates(correo):
+    index = ensure_reservation_index()
+    with shared_lock('indice-reservas'):
+        return sorted(index['users'].get(correo, {}))
+
+def find_booking(booking_id):
+    # (fecha, laboratorio, correo) de la reserva o None, sin abrir archivos
+    index = ensure_reservation_index()
+    with shared_lock('indice-reservas'):
+        found = index['bookings'].get(booking_id)
+    return tuple(found) if found else None
+
+# --------------------------------
+# RETENCIÓN Y COMPACTACIÓN DE ARCHIVOS
+# --------------------------------
+# Los días del ciclo actual quedan "calientes" en el directorio de trabajo,
+# los anteriores se compactan en un libro por mes dentro de archive/ y lo
+# que supera purge_years se elimina definitivamente.
+archive_dir = data_path('archive')
+retention_policy_file = data_path('retention_policy.json')
+retention_report_file = data_path('retention_report.json')
+
+def load_retention_policy():
+    policy = {"term_starts": ["01-01", "03-01", "08-01"], "purge_years": 3}
+    if os.path.exists(retention_policy_file):
+        with open(retention_policy_file, 'r') as f:
+            policy.update(json.load(f))
+    return policy
+
+def save_retention_policy(policy):
+    write_json(policy, retention_policy_file)
+
+def current_term_start(today, term_starts):
+    candidates = []
+    for year in (today.year - 1, today.year):
+        for month_day in term_starts:
+            start = datetime.strptime(f"{year}-{month_day}", "%Y-%m-%d").date()
+            if start <= today:
+                candidates.append(start)
+    return max(candidates)
+
+def get_archive_files():
+    return sorted(glob.glob(os.path.join(archive_dir, '*.xlsx')))
+
+def load_archived_reservations():
+    archived = list(read_reservation_files(get_archive_files()).values())
+    if archived:
+        return pd.concat(archived, ignore_index=True)
+    return empty_reservations(['Fecha'])
+
+def file_size(path):
+    # 0 si el archivo no existe (o lo archivó una compactación en curso)
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+def retention_data_bytes():
+    files = get_reservation_files() + get_archive_files() + [comments_file, schedule_file]
+    return sum(file_size(f) for f in files)
+
+def measure_scan_time(repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        get_reservation_files()
+    return (time.perf_counter() - start) / repeat
+
+def run_retention_job(policy=None, dry_run=False, today=None):
+    # Una sola ejecución a la vez entre todos los procesos. La vista previa
+    # (dry_run) solo lee: no toma el candado para no esperar a una
+    # compactación en curso.
+    if dry_run:
+        return run_retention_job_locked(policy, dry_run, today)
+    with shared_lock('retencion'):
+        return run_retention_job_locked(policy, dry_run, today)
+
+def run_retention_job_locked(policy, dry_run, today):
+    policy = policy or load_retention_policy()
+    today = today or datetime.today().date()
+    hot_since = current_term_start(today, policy['term_starts'])
+    try:
+        purge_before = today.replace(year=today.year - int(policy['purge_years']))
+    except ValueError:
+        # 29 de febrero en un año no bisiesto
+        purge_before = today.replace(year=today.year - int(policy['purge_years']), day=28)
+
+    files_before = get_reservation_files()
+    scan_before = measure_scan_time()
+    bytes_before = retention_data_bytes()
+
+    report = {
+        'fecha_ejecucion': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'dry_run': dry_run,
+        'activo_desde': hot_since.strftime("%Y-%m-%d"),
+        'purgar_antes_de': purge_before.strftime("%Y-%m-%d"),
+        'archivos_calientes_antes': len(files_before),
+        'dias_archivados': 0,
+        'dias_purgados': 0,
+        'meses_purgados': 0,
+        'comentarios_purgados': 0,
+        'bloqueos_purgados': 0,
+    }
+
+    # Agrupar los días fríos por mes; los que superan la purga no se archivan
+    to_archive = {}
+    to_purge = []
+    for file in files_before:
+        day = datetime.strptime(file_date(file), "%Y-%m-%d").date()
+        if day < purge_before:
+            to_purge.append(file)
+        elif day < hot_since:
+            to_archive.setdefault(day.strftime("%Y-%m"), []).append(file)
+    report['dias_archivados'] = sum(len(v) for v in to_archive.values())
+    report['dias_purgados'] = len(to_purge)
+
+    old_months = [
+        f for f in get_archive_files()
+        if os.path.basename(f).replace('.xlsx', '') < purge_before.strftime("%Y-%m")
+    ]
+    report['meses_purgados'] = len(old_months)
+
+    if not dry_run:
+        os.makedirs(archive_dir, exist_ok=True)
+        for month, files in to_archive.items():
+            month_file = os.path.join(archive_dir, f"{month}.xlsx")
+            # Los días del mes quedan bloqueados desde la lectura hasta su
+            # eliminación: ninguna reserva concurrente se pierde al archivar
+            with ExitStack() as stack:
+                for file in files:
+                    stack.enter_context(day_lock(file_date(file)))
+                frames = []
+                if os.path.exists(month_file):
+                    frames.append(read_reservations_file(month_file))
+                for file in files:
+                    reservations = get_reservations_for_day(file_date(file))
+                    reservations['Fecha'] = file_date(file)
+                    frames.append(reservations)
+                month_data = pd.concat(frames, ignore_index=True)
+                write_excel(month_data, month_file)
+                for file in files:
+                    os.remove(file)
+                forget_reservation_files(files)
+        for file in to_purge + old_months:
+            os.remove(file)
+        forget_reservation_files(to_purge + old_months)
+        # Se reconstruye y guarda el índice para que los demás procesos lo recarguen
+        invalidate_reservation_index()
+        ensure_reservation_index()
+
+        cutoff = purge_before.strftime("%Y-%m-%d")
+        with shared_lock('comentarios'):
+            if os.path.exists(comments_file):
+                comments = load_comments()
+                keep = comments['Fecha'] >= cutoff
+                report['comentarios_purgados'] = int((~keep).sum())
+                if not keep.all():
+                    write_excel(comments[keep], comments_file)
+        with shared_lock('bloqueos'):
+            blocks = load_blocks()
+            expired = (
+                ((blocks['Repetición'] != 'Semanal') & (blocks['Día'] < cutoff)) |
+                ((blocks['Repetición'] == 'Semanal') & (blocks['Hasta'] != '') & (blocks['Hasta'] < cutoff))
+            )
+            report['bloqueos_purgados'] = int(expired.sum())
+            if expired.any():
+                save_blocks(blocks[~expired])
+
+    report['archivos_calientes_despues'] = len(get_reservation_files())
+    report['bytes_recuperados'] = bytes_before - retention_data_bytes()
+    report['tiempo_escaneo_antes_ms'] = round(scan_before * 1000, 3)
+    report['tiempo_escaneo_despues_ms'] = round(measure_scan_time() * 1000, 3)
+
+    if not dry_run:
+        write_json(report, retention_report_file)
+    return report
+
+def load_retention_report():
+    if os.path.exists(retention_report_file):
+        with open(retention_report_file, 'r') as f:
+            return json.load(f)
+    return None
+
+@st.cache_resource
+def get_retention_job_state():
+    return {'thread': None, 'error': None}
+
+def start_retention_job():
+    state = get_retention_job_state()
+    if state['thread'] is not None and state['thread'].is_alive():
+        return False
+
+    def job():
+        try:
+            state['error'] = None
+            run_retention_job()
+        except Exception as e:
+            state['error'] = str(e)
+
+    state['thread'] = threading.Thread(target=job, name='retention-job', daemon=True)
+    state['thread'].start()
+    return True
+
+# --------------------------------
+# CARGA DE RESERVAS POR RANGO DE FECHAS
+# --------------------------------
+# El rango y los laboratorios se aplican antes de leer: solo se abren los
+# archivos del día (o meses archivados) que caen dentro del rango.
+def get_range_files(start_date, end_date):
+    start_str = start_date.strftime("%Y-%m-%d")
+    end_str = end_date.strftime("%Y-%m-%d")
+    day_files = [
+        f for f in get_reservation_files()
+        if start_str <= file_date(f) <= end_str
+    ]
+    month_files = [
+        f for f in get_archive_files()
+        if start_str[:7] <= os.path.basename(f).replace('.xlsx', '') <= end_str[:7]
+    ]
+    return day_files, month_files
+
+def get_range_version(start_date, end_date):
+    day_files, month_files = get_range_files(start_date, end_date)
+    return tuple((f, os.stat(f).st_mtime_ns) for f in day_files + month_files)
+
+def load_reservations_range(start_date, end_date, labs=None):
+    labs = list(labs) if labs else laboratories
+    start_str = start_date.strftime("%Y-%m-%d")
+    end_str = end_date.strftime("%Y-%m-%d")
+    day_files, month_files = get_range_files(start_date, end_date)
+    frames = [
+        reservations[reservations['Laboratorio'].isin(labs)]
+        for reservations in load_reservation_days(day_files)
+    ]
+    for archived in read_reservation_files(month_files).values():
+        archived = archived[
+            archived['Laboratorio'].isin(labs) &
+            (archived['Fecha'] >= start_str) & (archived['Fecha'] <= end_str)
+        ]
+        frames.append(archived)
+    frames = [f for f in frames if not f.empty]
+    if frames:
+        return pd.concat(frames, ignore_index=True)
+    return empty_reservations(['Fecha'])
+
+# --------------------------------
+# BÚSQUEDA DE TEXTO EN RESERVAS Y COMENTARIOS
+# --------------------------------
+# Una fuente por archivo del día, mes archivado y archivo de comentarios. En
+# cada búsqueda solo se vuelven a leer las fuentes cuyo mtime cambió, y de
+# ellas solo se tokenizan los documentos nuevos. El índice se guarda en disco
+# para que un reinicio u otro proceso no tenga que reconstruirlo.
+search_index_file = data_path('search_index.json')
+
+@st.cache_resource
+def get_search_index():
+    return {'ready': False, 'file_mtime': None, 'index': search.new_index()}
+
+def load_comments():
+    if os.path.exists(comments_file):
+        comments = pd.read_excel(comments_file, index_col=None, dtype=str)
+        return comments.loc[:, ~comments.columns.str.contains('^Unnamed')].fillna('')
+    return pd.DataFrame(columns=['Nombre', 'Correo', 'Comentario', 'Fecha'])
+
+def text_digest(*values):
+    return hashlib.sha1('|'.join(str(v) for v in values).encode('utf-8')).hexdigest()[:12]
+
+def minute_runs(lab, hours):
+    # Franjas consecutivas unidas en intervalos [inicio, fin) en minutos
+    interval = int(lab_hours.get(lab, default_lab_hours)['intervalo'])
+    runs = []
+    for minute in sorted(to_minutes(hour) for hour in hours):
+        if runs and minute == runs[-1][1]:
+            runs[-1][1] = minute + interval
+        elif not runs or minute > runs[-1][1]:
+            runs.append([minute, minute + interval])
+    return runs
+
+def hour_runs(lab, hours):
+    # Franjas consecutivas unidas en "inicio - fin"
+    return ', '.join(f"{a // 60:02d}:{a % 60:02d} - {b // 60:02d}:{b % 60:02d}" for a, b in minute_runs(lab, hours))
+
+def reservation_documents(reservations):
+    # Un documento por reserva con texto: mismo alumno, día, laboratorio,
+    # propósito y grupo
+    data = reservations[(reservations['Propósito'] != '') | (reservations['Grupo'] != '')]
+    documents = {}
+    keys = ['Fecha', 'Laboratorio', 'Correo', 'Propósito', 'Grupo']
+    for (fecha, lab, correo, propósito, grupo), group in data.groupby(keys, observed=True, sort=False):
+        hours = group['Hora'].astype(str).tolist()
+        first = group.iloc[0]
+        doc_id = f"reserva|{fecha}|{lab}|{correo}|{min(hours)}|{text_digest(propósito, grupo)}"
+        fields = {
+            'Tipo': 'Reserva', 'Fecha': fecha, 'Laboratorio': lab, 'Correo': correo,
+            'Nombre': f"{first['Nombre']} {first['Apellido']}".strip(),
+            'Horario': hour_runs(lab, hours),
+            'Texto': f"{propósito} (grupo: {grupo})" if grupo else propósito,
+        }
+        documents[doc_id] = (fields, f"{propósito} {grupo}")
+    return documents
+
+def comment_documents(comments):
+    documents = {}
+    for row in comments.to_dict(orient='records'):
+        if not row['Comentario']:
+            continue
+        doc_id = f"comentario|{row['Fecha']}|{row['Correo']}|{text_digest(row['Comentario'])}"
+        fields = {
+            'Tipo': 'Comentario', 'Fecha': row['Fecha'], 'Laboratorio': '', 'Correo': row['Correo'],
+            'Nombre': row['Nombre'], 'Horario': '', 'Texto': row['Comentario'],
+        }
+        documents[doc_id] = (fields, row['Comentario'])
+    return documents
+
+def get_search_sources():
+    sources = {f"dia:{file_date(f)}": f for f in get_reservation_files()}
+    sources.update({f"mes:{os.path.basename(f)[:7]}": f for f in get_archive_files()})
+    if os.path.exists(comments_file):
+        sources['comentarios'] = comments_file
+    return sources
+
+def source_documents(source, path):
+    # Los identificadores llevan la fuente: una reserva que pasa del archivo
+    # del día al mes archivado es otro documento
+    if source == 'comentarios':
+        documents = comment_documents(load_comments())
+    else:
+        reservations = read_reservations_file(path)
+        if source.startswith('dia:'):
+            reservations['Fecha'] = source[4:]
+        documents = reservation_documents(reservations)
+    return {f"{source}|{doc_id}": doc for doc_id, doc in documents.items()}
+
+def load_stored_search_index():
+    if os.path.exists(search_index_file):
+        try:
+            with open(search_index_file, 'r') as f:
+                return search.load_index(json.load(f))
+        except (ValueError, KeyError):
+            pass
+    return search.new_index()
+
+def ensure_search_index():
+    # Debe llamarse con el candado 'indice-busqueda' tomado
+    state = get_search_index()
+    if not state['ready'] or state['file_mtime'] != file_version(search_index_file):
+        state['index'] = load_stored_search_index()
+        state['file_mtime'] = file_version(search_index_file)
+        state['ready'] = True
+    index = state['index']
+    sources = get_search_sources()
+    changed = False
+    for source in list(index['sources']):
+        if source not in sources:
+            search.remove_source(index, source)
+            changed = True
+    # Los archivos de reservas pendientes se leen juntos (en paralelo si son muchos)
+    read_reservation_files([
+        path for source, path in sources.items()
+        if source != 'comentarios' and index['sources'].get(source, {}).get('version') != file_version(path)
+    ])
+    for source, path in sources.items():
+        # La versión se toma antes de leer: una escritura posterior se detecta
+        # en la siguiente búsqueda
+        version = file_version(path)
+        if index['sources'].get(source, {}).get('version') != version:
+            search.update_source(index, source, version, source_documents(source, path))
+            changed = True
+    if changed:
+        write_json(search.dump_index(index), search_index_file)
+        state['file_mtime'] = file_version(search_index_file)
+    return index
+
+def search_text(query, kinds=None, limit=100):
+    # Devuelve (resultados, documentos indexados, ms de la consulta)
+    with shared_lock('indice-busqueda'):
+        index = ensure_search_index()
+        start = time.perf_counter()
+        results = search.search(index, query, kinds, limit)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        return results, len(index['docs']), elapsed_ms
+
+# --------------------------------
+# REGISTRO DE AUDITORÍA
+# --------------------------------
+# Quién bloqueó, eliminó, dio acceso o cambió la configuración. Cada acción
+# agrega un evento binario al final de audit.log (ver audit.py) en lugar de
+# reescribir un Excel; el índice por tiempo permite paginar sin leerlo todo.
+audit_log_file = data_path('audit.log')
+audit_index_file = data_path('audit.idx')
+
+def record_audit(action, target, detail='', actor=None):
+    # Desde la API no hay sesión de Streamlit: el llamador indica el usuario
+    if actor is None:
+        actor = st.session_state.get('username', '')
+    with shared_lock('auditoria'):
+        audit.append_event(audit_log_file, audit_index_file, int(time.time() * 1000), action, actor, target, detail)
+
+def read_audit_page(start_date, end_date, page, page_size):
+    # Devuelve (DataFrame de la página, total de eventos en el rango)
+    start_ms = int(datetime.combine(start_date, datetime.min.time()).timestamp() * 1000)
+    end_ms = int(datetime.combine(end_date + timedelta(days=1), datetime.min.time()).timestamp() * 1000) - 1
+    with shared_lock('auditoria'):
+        events, total = audit.read_events(audit_log_file, audit_index_file, start_ms, end_ms, page, page_size)
+    events = pd.DataFrame(events, columns=['ts', 'accion', 'usuario', 'objetivo', 'detalle'])
+    events.insert(0, 'Fecha', [datetime.fromtimestamp(ts / 1000).strftime("%Y-%m-%d %H:%M:%S") for ts in events.pop('ts')])
+    events.columns = ['Fecha', 'Acción', 'Usuario', 'Objetivo', 'Detalle']
+    return events, total
+
+# --------------------------------
+# EXPORTACIÓN A EXCEL
+# --------------------------------
+# Los .xlsx para los administradores son solo un formato de exportación: se
+# generan a partir de load_reservations_range (no de los archivos del día
+# directamente) con openpyxl en modo write-only, que escribe las filas en
+# streaming sin armar el libro en memoria. Cada libro se guarda en exports/
+# con la versión de los datos en la clave, así se reutiliza hasta que cambia
+# algún archivo del rango.
+exports_dir = data_path('exports')
+export_columns = [
+    'Fecha', 'Laboratorio', 'Hora', 'Nombre', 'Apellido', 'Código', 'Correo',
+    'Propósito', 'Tipo', 'Grupo', 'Cantidad_alumnos'
+]
+export_column_widths = {'Fecha': 12, 'Nombre': 18, 'Apellido': 18, 'Correo': 30, 'Propósito': 40, 'Grupo': 20}
+max_cached_exports = 50
+
+def write_reservations_workbook(reservations, path, labs):
+    # Una hoja por laboratorio, ordenada por fecha y hora
+    workbook = Workbook(write_only=True)
+    for lab in labs:
+        sheet = workbook.create_sheet(title=lab)
+        for i, col in enumerate(export_columns):
+            sheet.column_dimensions[get_column_letter(i + 1)].width = export_column_widths.get(col, 12)
+        sheet.freeze_panes = 'A2'
+        header = []
+        for col in export_columns:
+            cell = WriteOnlyCell(sheet, value=col)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        sheet.append(header)
+        data = reservations[reservations['Laboratorio'] == lab].reindex(columns=export_columns)
+        data = data.sort_values(['Fecha', 'Hora'])
+        for row in zip(*[data[col].astype(object).where(data[col].notna(), None).tolist() for col in export_columns]):
+            sheet.append(row)
+    workbook.save(path)
+
+def prune_exports():
+    files = sorted(glob.glob(os.path.join(exports_dir, '*.xlsx')), key=os.path.getmtime, reverse=True)
+    for file in files[max_cached_exports:]:
+        os.remove(file)
+
+def export_reservations_xlsx(start_date, end_date, labs=None):
+    # Devuelve (ruta del libro, nombre sugerido, si se generó ahora)
+    labs = tuple(labs) if labs else tuple(laboratories)
+    start_str, end_str = start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    name = f"reservas_{start_str}" + (f"_{end_str}" if end_str != start_str else '') + f"_{'-'.join(labs)}.xlsx"
+    key = text_digest(start_str, end_str, labs, export_columns, get_range_version(start_date, end_date))
+    path = os.path.join(exports_dir, f"{key}.xlsx")
+    if os.path.exists(path):
+        return path, name, False
+    with shared_lock('exportaciones'):
+        if os.path.exists(path):
+            return path, name, False
+        reservations = load_reservations_range(start_date, end_date, labs)
+        os.makedirs(exports_dir, exist_ok=True)
+        atomic_write(path, lambda tmp_file: write_reservations_workbook(reservations, tmp_file, labs))
+        prune_exports()
+    return path, name, True
+
+def choose_resample_rule(start_date, end_date):
+    span = (end_date - start_date).days
+    if span <= 92:
+        return 'D', 'día'
+    if span <= 730:
+        return 'W-MON', 'semana'
+    return 'MS', 'mes'
 
 # --------------------------------
 # MOSTRAR LINEAMIENTOS DE LABORATORIO
 # --------------------------------
-def show_rules(lab=None):
+default_rules = """
+**Lineamientos para la reserva de laboratorios:**
+- Los alumnos deben respetar los equipos y mobiliario.
+- No se permite consumir alimentos ni bebidas dentro del laboratorio.
+- El horario de uso debe respetarse estrictamente.
+- Se debe solicitar permiso para el uso de equipos especiales.
+- Las actividades deben registrarse con anticipación.
+- El laboratorio debe dejarse limpio y ordenado después de cada uso.
+"""
+
+def get_rules_file(lab=None):
     if lab:
-        rules_file = f'lineamientos_{lab}.txt'
-    else:
-        rules_file = 'lineamientos.txt'
+        return data_path(f'lineamientos_{lab}.txt')
+    return data_path('lineamientos.txt')
+
+# Se ejecuta una sola vez por proceso: crea los lineamientos por defecto de
+# cada laboratorio para que show_rules nunca escriba archivos.
+@st.cache_resource
+def seed_default_rules():
+    for lab in laboratories:
+        rules_file = get_rules_file(lab)
+        if not os.path.exists(rules_file):
+            write_text(default_rules, rules_file)
+    return True
+
+# Texto listo para st.markdown. El mtime forma parte de la clave, así una
+# edición hecha desde otro proceso también invalida la caché.
+@st.cache_data
+def load_rules(lab=None, version=None):
+    rules_file = get_rules_file(lab)
     if os.path.exists(rules_file):
         with open(rules_file, 'r') as f:
             rules = f.read()
     else:
-        rules = """
-        **Lineamientos para la reserva de laboratorios:**
-        - Los alumnos deben respetar los equipos y mobiliario.
-        - No se permite consumir alimentos ni bebidas dentro del laboratorio.
-        - El horario de uso debe respetarse estrictamente.
-        - Se debe solicitar permiso para el uso de equipos especiales.
-        - Las actividades deben registrarse con anticipación.
-        - El laboratorio debe dejarse limpio y ordenado después de cada uso.
-        """
-        with open(rules_file, 'w') as f:
-            f.write(rules)
-    st.markdown(rules)
+        rules = default_rules
+    return textwrap.dedent(rules).strip()
+
+def show_rules(lab=None):
+    st.markdown(load_rules(lab, file_version(get_rules_file(lab))))
 
 # --------------------------------
 # RESET DE VARIABLES TEMPORALES
 # --------------------------------
 def clear_availability_state():
-    keys = ['show_availability', 'desired_start_time', 'desired_end_time', 'desired_hours', 'availability']
+    keys = ['show_availability', 'desired_lab', 'desired_date', 'desired_start_time', 'desired_end_time', 'desired_hours', 'availability', 'waitlist_offer', 'booking_token']
     for k in keys:
         if k in st.session_state:
             del st.session_state[k]
 
+# ================================
+# REGLAS DE RESERVA (compartidas por la app y la API)
+# ================================
+b501_max_time = "17:30"
+
+# Un candado por día: la lectura-modificación-escritura del Excel del día
+# no debe intercalarse entre sesiones, hilos de la API ni otros procesos.
+def day_lock(date_str):
+    return shared_lock(f"dia-{date_str}")
+
+def authenticate_user(correo, contraseña):
+    df_users = load_user_data()
+    user_row = df_users[
+        (df_users['Correo'] == correo) & (df_users['Contraseña'] == contraseña)
+    ]
+    if user_row.empty:
+        return None
+    return user_row.iloc[0]
+
+def resolve_accessible_labs(user_row):
+    if user_row['C402_access'] == 1:
+        if pd.notna(user_row['Temp_access_expiry']):
+            expiry_date = pd.to_datetime(user_row['Temp_access_expiry'])
+            if datetime.today() > expiry_date:
+                set_c402_access(user_row['Correo'], 0)
+                return ["B501"], True
+        return ["B501", "C402"], False
+    return ["B501"], False
+
+def load_group_limits():
+    if os.path.exists(group_limits_file):
+        limits = pd.read_excel(group_limits_file, index_col=None)
+        limits = limits.loc[:, ~limits.columns.str.contains('^Unnamed')]
+    else:
+        limits = pd.DataFrame(columns=['Tipo', 'Límite'])
+    return limits
+
+def get_desired_hours(lab, start_time, end_time):
+    # Lanza ValueError si alguna hora no pertenece a la grilla del laboratorio
+    boundaries = get_lab_boundaries(lab)
+    start_i = boundaries.index(start_time)
+    end_i = boundaries.index(end_time)
+    return get_lab_slots(lab)[start_i:end_i]
+
+def get_end_time(lab, desired_hours):
+    end = datetime.strptime(desired_hours[-1], "%H:%M") + timedelta(minutes=int(lab_hours[lab]['intervalo']))
+    return end.strftime("%H:%M")
+
+def validate_time_range(lab, start_time, end_time):
+    if lab == "B501":
+        if to_minutes(start_time) > to_minutes(b501_max_time) or to_minutes(end_time) > to_minutes(b501_max_time):
+            return f"Las reservas en {lab} solo están permitidas hasta las {b501_max_time}."
+    return None
+
+def get_blocked_mask(date_str, lab):
+    slots = get_lab_slots(lab)
+    interval = int(lab_hours[lab]['intervalo'])
+    opening = to_minutes(lab_hours[lab]['apertura'])
+    mask = 0
+    for start, end in zip(*get_day_blocks(lab, date_str)):
+        # Franjas que se solapan con [start, end)
+        first = max(0, (start - opening) // interval)
+        last = min(len(slots), -(-(end - opening) // interval))
+        if last > first:
+            mask |= ((1 << (last - first)) - 1) << first
+    return mask
+
+def get_day_availability(date_str, lab, reservations=None):
+    if reservations is None:
+        reservations = get_reservations_for_day(date_str)
+    blocked_mask = get_blocked_mask(date_str, lab)
+    capacity = lab_capacities[lab]
+    counts = slot_counts(lab, reservations)
+    availability = {}
+    for i, hour in enumerate(get_lab_slots(lab)):
+        availability[hour] = {
+            'disponibles': int(capacity - counts[i]),
+            'bloqueado': bool(blocked_mask >> i & 1)
+        }
+    return availability, capacity
+
+def check_availability(date_str, lab, desired_hours, reservations=None):
+    if reservations is None:
+        reservations = get_reservations_for_day(date_str)
+    capacity = lab_capacities[lab]
+    desired_mask = slots_mask(lab, desired_hours)
+    if is_range_blocked(lab, date_str, desired_hours[0], get_end_time(lab, desired_hours)):
+        return None, capacity, f"El horario seleccionado está bloqueado en {lab}."
+    counts = slot_counts(lab, reservations)
+    availability = {hour: int(capacity - counts[slot_index(lab, hour)]) for hour in desired_hours}
+    if desired_mask & counts_to_full_mask(counts, capacity):
+        return availability, capacity, "No hay suficientes cupos en el rango seleccionado."
+    return availability, capacity, None
+
+# Motivos de rechazo de validate_booking. Solo 'capacidad' puede cambiar al
+# liberarse cupos; la lista de espera descarta las solicitudes con los demás.
+rejection_reasons = ['horario_pasado', 'sin_acceso', 'duplicada', 'limite_grupo', 'capacidad']
+
+def validate_booking(user_row, lab, selected_day, desired_hours, reservation_type, cantidad_alumnos, reservations):
+    # Devuelve None o (motivo, mensaje), con motivo de rejection_reasons
+    # Prevenir reservas pasadas si la fecha es hoy
+    if selected_day == datetime.today().date():
+        current_time = datetime.now()
+        if to_minutes(desired_hours[0]) <= current_time.hour * 60 + current_time.minute:
+            return 'horario_pasado', "No puedes reservar en horarios pasados."
+
+    # Verificar acceso C402
+    if lab == 'C402' and user_row['C402_access'] == 0:
+        return 'sin_acceso', "No tienes acceso al laboratorio C402."
+
+    # Unicidad (Correo, día, laboratorio, franja)
+    own = (
+        (reservations['Correo'] == user_row['Correo']) &
+        (reservations['Laboratorio'] == lab) &
+        reservations['Hora'].isin(desired_hours)
+    )
+    if own.any():
+        return 'duplicada', "Ya tienes una reserva en ese horario."
+
+    # Límite grupal para C402
+    if lab == 'C402' and reservation_type == 'Grupal':
+        limits = load_group_limits()
+        grp_lim = limits[limits['Tipo'] == 'Grupal']['Límite'].values
+        if len(grp_lim) > 0 and cantidad_alumnos > grp_lim[0]:
+            return 'limite_grupo', f"El límite de alumnos por grupo es {grp_lim[0]}."
+
+    # Verificar capacidad global en C402
+    if lab == 'C402':
+        current_total = sum(reservations[reservations['Laboratorio'] == 'C402']['Cantidad_alumnos'])
+        new_total = current_total + cantidad_alumnos
+        if new_total > lab_capacities['C402']:
+            return 'capacidad', f"Al agregar esta reserva, total ({new_total}) excede capacidad máxima ({lab_capacities['C402']})."
+    return None
+
+def build_reservation_rows(user_row, lab, desired_hours, propósito, reservation_type, grupo, cantidad_alumnos, token='', booking_id=''):
+    rows = pd.DataFrame({
+        'Nombre': [user_row['Nombre']] * len(desired_hours),
+        'Apellido': [user_row['Apellido']] * len(desired_hours),
+        'Código': [user_row['Código']] * len(desired_hours),
+        'Correo': [user_row['Correo']] * len(desired_hours),
+        'Laboratorio': [lab] * len(desired_hours),
+        'Hora': desired_hours,
+        'Propósito': [propósito] * len(desired_hours),
+        'Tipo': [reservation_type] * len(desired_hours),
+        'Grupo': [grupo] * len(desired_hours),
+        'Cantidad_alumnos': [cantidad_alumnos] * len(desired_hours),
+        'Reserva_ID': [booking_id or new_booking_id()] * len(desired_hours),
+        'Token': [token] * len(desired_hours)
+    })
+    # Mismos tipos que las reservas cargadas: al concatenar se conservan las categorías
+    return apply_schema(rows, reservation_schema, reservation_columns)
+
+def new_booking_token():
+    return uuid.uuid4().hex
+
+def book_reservation(user_row, lab, selected_day, desired_hours, propósito='', reservation_type='', grupo='', cantidad_alumnos=1, token=''):
+    # Devuelve (Reserva_ID, error). Idempotente por token: si las filas de ese
+    # token ya están guardadas (doble clic, rerun o reintento de la API) se
+    # responde con la reserva existente sin escribir.
+    date_str = selected_day.strftime("%Y-%m-%d")
+    if lab == 'C402' and user_row.get('Rol') == 'alumno':
+        # El permiso del C402 pudo retirarse o vencer después de cargar user_row
+        user_data = load_user_data()
+        match = user_data[user_data['Correo'] == user_row['Correo']]
+        if match.empty or 'C402' not in resolve_accessible_labs(match.iloc[0])[0]:
+            return None, "No tienes acceso al laboratorio C402."
+        user_row = match.iloc[0]
+    with day_lock(date_str):
+        # Se vuelve a verificar con el archivo actual: otra sesión pudo reservar
+        # entre la verificación de disponibilidad y la confirmación.
+        reservations_all = get_reservations_for_day(date_str)
+        if token and 'Token' in reservations_all.columns:
+            same_token = reservations_all[
+                (reservations_all['Token'] == token) & (reservations_all['Correo'] == user_row['Correo'])
+            ]
+            if not same_token.empty:
+                if (same_token['Laboratorio'] == lab).all() and sorted(same_token['Hora'].astype(str)) == sorted(desired_hours):
+                    return same_token['Reserva_ID'].iloc[0], None
+                return None, "Este token ya se usó para otra reserva."
+        _, _, error = check_availability(date_str, lab, desired_hours, reservations_all)
+        if error:
+            return None, error
+        rejection = validate_booking(user_row, lab, selected_day, desired_hours, reservation_type, cantidad_alumnos, reservations_all)
+        if rejection:
+            return None, rejection[1]
+        booking_id = new_booking_id()
+        new_entries = build_reservation_rows(
+            user_row, lab, desired_hours, propósito, reservation_type, grupo, cantidad_alumnos, token, booking_id
+        )
+        if reservations_all.empty:
+            reservations_all = new_entries
+        else:
+            reservations_all = pd.concat([reservations_all, new_entries], ignore_index=True)
+        save_reservations_for_day(reservations_all, date_str)
+    return booking_id, None
+
+def remove_reservation_rows(date_str, lab, select):
+    # select(reservas) -> máscara de las filas a quitar; devuelve cuántas se quitaron
+    with day_lock(date_str):
+        reservations = get_reservations_for_day(date_str)
+        condition = select(reservations) & (reservations['Laboratorio'] == lab)
+        removed = int(condition.sum())
+        if removed:
+            freed_hours = reservations.loc[condition, 'Hora'].astype(str).tolist()
+            reservations = reservations[~condition]
+            # Los cupos liberados pasan a la lista de espera en la misma escritura
+            reservations, _ = apply_waitlist_promotions(reservations, date_str, lab, freed_hours)
+            save_reservations_for_day(reservations, date_str)
+    return removed
+
+def cancel_reservation(correo, date_str, lab, cancel_hours):
+    return remove_reservation_rows(
+        date_str, lab,
+        lambda reservations: (reservations['Correo'] == correo) & reservations['Hora'].isin(cancel_hours)
+    )
+
+def cancel_booking(correo, booking_id):
+    # Todas las franjas de la reserva en una escritura; 0 si no existe o es de otro usuario
+    found = find_booking(booking_id)
+    if found is None or found[2] != correo:
+        return 0
+    date_str, lab, _ = found
+    return remove_reservation_rows(
+        date_str, lab,
+        lambda reservations: (reservations['Correo'] == correo) & (reservations['Reserva_ID'] == booking_id)
+    )
+
+# ================================
+# LISTA DE ESPERA
+# ================================
+# Cada solicitud se encola (FIFO por número de secuencia) en un heap por
+# franja (fecha, laboratorio, hora). Al liberarse cupos solo se revisan las
+# colas de las franjas liberadas, así el costo depende de los cupos libres y
+# no del largo de la lista. Las solicitudes ya atendidas se descartan de
+# forma perezosa al llegar al frente de cada heap.
+waitlist_file = data_path('waitlist.json')
+
+@st.cache_resource
+def get_waitlist():
+    return {'ready': False, 'file_mtime': None, 'seq': 0, 'entries': {}, 'queues': {}}
+
+def save_waitlist(waitlist):
+    write_json({'seq': waitlist['seq'], 'entries': waitlist['entries']}, waitlist_file)
+    waitlist['file_mtime'] = file_version(waitlist_file)
+
+def enqueue_waitlist_entry(waitlist, entry):
+    for hour in entry['horas']:
+        key = (entry['fecha'], entry['laboratorio'], hour)
+        heapq.heappush(waitlist['queues'].setdefault(key, []), (entry['seq'], entry['id']))
+
+def ensure_waitlist():
+    # Debe llamarse con el candado 'lista-espera' tomado (ver locked_waitlist).
+    # Se recarga si el archivo cambió desde la última lectura o escritura
+    # de este proceso.
+    waitlist = get_waitlist()
+    mtime = file_version(waitlist_file)
+    if waitlist['ready'] and waitlist['file_mtime'] == mtime:
+        return waitlist
+    waitlist['seq'], waitlist['entries'], waitlist['queues'] = 0, {}, {}
+    if mtime is not None:
+        with open(waitlist_file, 'r') as f:
+            stored = json.load(f)
+        waitlist['seq'] = stored['seq']
+        today_str = datetime.today().strftime("%Y-%m-%d")
+        # Las solicitudes de días pasados ya no pueden atenderse
+        waitlist['entries'] = {
+            entry_id: entry for entry_id, entry in stored['entries'].items()
+            if entry['fecha'] >= today_str
+        }
+    for entry in waitlist['entries'].values():
+        if entry['estado'] == 'En espera':
+            enqueue_waitlist_entry(waitlist, entry)
+    waitlist['file_mtime'] = mtime
+    waitlist['ready'] = True
+    return waitlist
+
+@contextmanager
+def locked_waitlist():
+    with shared_lock('lista-espera'):
+        yield ensure_waitlist()
+
+def join_waitlist(user_row, lab, date_str, desired_hours, propósito='', reservation_type='', grupo='', cantidad_alumnos=1):
+    with locked_waitlist() as waitlist:
+        for entry in waitlist['entries'].values():
+            if (entry['correo'] == user_row['Correo'] and entry['estado'] == 'En espera' and
+                    entry['fecha'] == date_str and entry['laboratorio'] == lab and entry['horas'] == list(desired_hours)):
+                return "Ya estás en la lista de espera para ese horario."
+        waitlist['seq'] += 1
+        entry = {
+            'id': f"{date_str}-{lab}-{waitlist['seq']}",
+            'seq': waitlist['seq'],
+            'fecha': date_str,
+            'laboratorio': lab,
+            'horas': list(desired_hours),
+            'fin': get_end_time(lab, desired_hours),
+            'correo': user_row['Correo'],
+            'nombre': user_row['Nombre'],
+            'apellido': user_row['Apellido'],
+            'codigo': str(user_row['Código']),
+            'proposito': propósito,
+            'tipo': reservation_type,
+            'grupo': grupo,
+            'cantidad_alumnos': int(cantidad_alumnos),
+            'estado': 'En espera',
+            'creado': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        waitlist['entries'][entry['id']] = entry
+        enqueue_waitlist_entry(waitlist, entry)
+        save_waitlist(waitlist)
+    return None
+
+def leave_waitlist(correo, entry_id):
+    with locked_waitlist() as waitlist:
+        entry = waitlist['entries'].get(entry_id)
+        if entry is None or entry['correo'] != correo or entry['estado'] != 'En espera':
+            return False
+        entry['estado'] = 'Cancelada'
+        save_waitlist(waitlist)
+    return True
+
+def get_user_waitlist(correo):
+    with locked_waitlist() as waitlist:
+        entries = [dict(e) for e in waitlist['entries'].values() if e['correo'] == correo]
+    return sorted(entries, key=lambda e: e['seq'])
+
+def get_waitlist_dates(lab):
+    with locked_waitlist() as waitlist:
+        return sorted({
+            date_str for (date_str, queue_lab, _), queue in waitlist['queues'].items()
+            if queue_lab == lab and queue
+        })
+
+def apply_waitlist_promotions(reservations, date_str, lab, freed_hours):
+    # Debe llamarse con day_lock(date_str) tomado; devuelve las reservas con
+    # las filas promovidas agregadas (el llamador hace la única escritura).
+    promoted = []
+    with locked_waitlist() as waitlist:
+        selected_day = datetime.strptime(date_str, "%Y-%m-%d").date()
+        slots = set(get_lab_slots(lab))
+        user_data = None
+        changed = False
+        for hour in freed_hours:
+            queue = waitlist['queues'].get((date_str, lab, hour))
+            if not queue:
+                continue
+            if hour not in slots:
+                # La grilla cambió: la cola de esa hora ya no puede atenderse
+                for _, entry_id in queue:
+                    entry = waitlist['entries'].get(entry_id)
+                    if entry is not None and entry['estado'] == 'En espera':
+                        entry['estado'] = 'Descartada'
+                        entry['motivo'] = "El horario ya no existe en la grilla del laboratorio."
+                queue.clear()
+                changed = True
+                continue
+            # Presupuesto de revisión: los cupos libres en esta franja
+            availability, _ = get_day_availability(date_str, lab, reservations)
+            budget = max(availability[hour]['disponibles'], 0)
+            skipped = []
+            while queue and budget > 0:
+                seq, entry_id = heapq.heappop(queue)
+                entry = waitlist['entries'].get(entry_id)
+                if entry is None or entry['estado'] != 'En espera':
+                    continue
+                if not slots.issuperset(entry['horas']):
+                    entry['estado'] = 'Descartada'
+                    entry['motivo'] = "El horario ya no existe en la grilla del laboratorio."
+                    changed = True
+                    continue
+                budget -= 1
+                _, _, error = check_availability(date_str, lab, entry['horas'], reservations)
+                if error:
+                    skipped.append((seq, entry_id))
+                    continue
+                c402_access = 1
+                if lab == 'C402':
+                    if user_data is None:
+                        user_data = load_user_data()
+                    match = user_data[user_data['Correo'] == entry['correo']]
+                    c402_access = int(match['C402_access'].iloc[0]) if not match.empty else 0
+                user_row = pd.Series({
+                    'Nombre': entry['nombre'], 'Apellido': entry['apellido'],
+                    'Código': entry['codigo'], 'Correo': entry['correo'],
+                    'C402_access': c402_access
+                })
+                rejection = validate_booking(
+                    user_row, lab, selected_day, entry['horas'],
+                    entry['tipo'], entry['cantidad_alumnos'], reservations
+                )
+                if rejection:
+                    reason, message = rejection
+                    if reason == 'capacidad':
+                        skipped.append((seq, entry_id))
+                    else:
+                        # Sin acceso u horario ya pasado: la solicitud no podrá atenderse
+                        entry['estado'] = 'Descartada'
+                        entry['motivo'] = message
+                        changed = True
+                    continue
+                new_entries = build_reservation_rows(
+                    user_row, lab, entry['horas'], entry['proposito'],
+                    entry['tipo'], entry['grupo'], entry['cantidad_alumnos'], entry['id'], new_booking_id()
+                )
+                reservations = pd.concat([reservations, new_entries], ignore_index=True)
+                entry['estado'] = 'Promovida'
+                entry['promovida'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                promoted.append(entry)
+                changed = True
+            for item in skipped:
+                heapq.heappush(queue, item)
+        if changed:
+            save_waitlist(waitlist)
+    return reservations, promoted
+
+def promote_waitlist_for_lab(lab):
+    # Tras un aumento de capacidad: una escritura por día con solicitudes
+    promoted = []
+    for date_str in get_waitlist_dates(lab):
+        with day_lock(date_str):
+            reservations = get_reservations_for_day(date_str)
+            with locked_waitlist() as waitlist:
+                hours_waiting = [h for (d, l, h), q in waitlist['queues'].items() if d == date_str and l == lab and q]
+            reservations, day_promoted = apply_waitlist_promotions(reservations, date_str, lab, hours_waiting)
+            if day_promoted:
+                save_reservations_for_day(reservations, date_str)
+                promoted.extend(day_promoted)
+    return promoted
+
+def get_user_reservations(correo):
+    # Solo se abren los días en los que el usuario tiene reservas
+    files = [day_file(date_str) for date_str in get_user_booked_dates(correo)]
+    files = [f for f in files if os.path.exists(f)]
+    user_reservations = [
+        reservations[reservations['Correo'] == correo]
+        for reservations in load_reservation_days(files)
+    ]
+    user_reservations = [r for r in user_reservations if not r.empty]
+    if user_reservations:
+        all_user_reservations = pd.concat(user_reservations)
+        return all_user_reservations.sort_values(['Fecha', 'Hora']).reset_index(drop=True)
+    return empty_reservations(['Fecha'])
+
+# Una fila por reserva (Reserva_ID) con sus franjas unidas en "inicio - fin"
+booking_columns = ['Fecha', 'Laboratorio', 'Horario', 'Franjas', 'Propósito', 'Tipo', 'Grupo', 'Cantidad_alumnos', 'Reserva_ID']
+
+def group_bookings(reservations, extra_columns=()):
+    columns = booking_columns + list(extra_columns)
+    rows = []
+    for (booking_id, fecha), group in reservations.groupby(['Reserva_ID', 'Fecha'], sort=False):
+        first = group.iloc[0]
+        row = {col: first[col] for col in columns if col in group.columns}
+        row.update({
+            'Reserva_ID': booking_id, 'Fecha': fecha, 'Franjas': len(group),
+            'Horario': hour_runs(first['Laboratorio'], group['Hora'].astype(str)),
+        })
+        rows.append(row)
+    bookings = pd.DataFrame(rows, columns=columns)
+    return bookings.sort_values(['Fecha', 'Horario']).reset_index(drop=True)
+
+def booking_label(booking):
+    return f"{booking['Fecha']} - {booking['Laboratorio']} - {booking['Horario']}"
+
+# --------------------------------
+# CALENDARIO ICS POR USUARIO
+# --------------------------------
+# Las franjas consecutivas del mismo día y laboratorio forman un solo evento.
+# El calendario se regenera solo cuando cambia alguno de los archivos del día
+# en los que el usuario tiene reservas (o la grilla de los laboratorios); esa
+# misma versión da el ETag y el Last-Modified de la API.
+calendar_vtimezone = [
+    'BEGIN:VTIMEZONE', 'TZID:America/Lima',
+    'BEGIN:STANDARD', 'DTSTART:19700101T000000',
+    'TZOFFSETFROM:-0500', 'TZOFFSETTO:-0500', 'TZNAME:-05',
+    'END:STANDARD', 'END:VTIMEZONE',
+]
+
+def ics_text(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def fold_ics_line(line):
+    # RFC 5545: hasta 75 octetos por línea; las continuaciones empiezan con
+    # un espacio y no se corta un carácter UTF-8 a la mitad
+    data = line.encode('utf-8')
+    parts = []
+    while len(data) > (75 if not parts else 74):
+        cut = 75 if not parts else 74
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+    parts.append(data)
+    return b'\r\n '.join(parts)
+
+def get_user_calendar_version(correo):
+    # (fecha, mtime) de cada día con reservas del usuario
+    index = ensure_reservation_index()
+    with shared_lock('indice-reservas'):
+        return tuple((date_str, index['days'][date_str]['mtime']) for date_str in sorted(index['users'].get(correo, {})))
+
+def calendar_events(reservations):
+    events = []
+    for (fecha, lab), group in reservations.groupby(['Fecha', 'Laboratorio'], observed=True):
+        minutes = hour_minutes(group['Hora'])
+        for start, end in minute_runs(lab, group['Hora'].astype(str)):
+            rows = group[(minutes >= start) & (minutes < end)]
+            purposes = [p for p in dict.fromkeys(rows['Propósito']) if p]
+            groups = [g for g in dict.fromkeys(rows['Grupo']) if g]
+            events.append({'fecha': fecha, 'lab': lab, 'inicio': start, 'fin': end, 'propósitos': purposes, 'grupos': groups})
+    return events
+
+@st.cache_data(max_entries=256)
+def build_user_calendar(correo, version, hours_config):
+    last_modified = max((mtime for _, mtime in version), default=None)
+    # DTSTAMP fijo por versión: el mismo contenido en todos los procesos
+    stamp = datetime.fromtimestamp((last_modified or 0) / 1e9, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    user_key = hashlib.sha1(correo.encode('utf-8')).hexdigest()[:12]
+    lines = [
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Lab Sync//Reservas//ES',
+        'CALSCALE:GREGORIAN', 'METHOD:PUBLISH', 'X-WR-CALNAME:Reservas de laboratorio',
+        'X-WR-TIMEZONE:America/Lima',
+    ] + calendar_vtimezone
+    for event in calendar_events(get_user_reservations(correo)):
+        day = event['fecha'].replace('-', '')
+        start = f"{event['inicio'] // 60:02d}{event['inicio'] % 60:02d}00"
+        end = f"{event['fin'] // 60:02d}{event['fin'] % 60:02d}00"
+        summary = f"Reserva {event['lab']}"
+        if event['propósitos']:
+            summary += f": {'; '.join(event['propósitos'])}"
+        lines += [
+            'BEGIN:VEVENT',
+            f"UID:{day}-{event['lab']}-{start}-{user_key}@labsync",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART;TZID=America/Lima:{day}T{start}",
+            f"DTEND;TZID=America/Lima:{day}T{end}",
+            f"SUMMARY:{ics_text(summary)}",
+            f"LOCATION:{ics_text('Laboratorio ' + event['lab'])}",
+        ]
+        if event['grupos']:
+            lines.append(f"DESCRIPTION:{ics_text('Grupo: ' + ', '.join(event['grupos']))}")
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    etag = hashlib.sha1(repr((correo, version, hours_config)).encode('utf-8')).hexdigest()[:20]
+    return {
+        'ics': b'\r\n'.join(fold_ics_line(line) for line in lines) + b'\r\n',
+        'etag': f'"{etag}"',
+        'last_modified': last_modified / 1e9 if last_modified else None,
+    }
+
+def get_user_calendar(correo):
+    hours_config = tuple(sorted((lab, tuple(sorted(config.items()))) for lab, config in lab_hours.items()))
+    return build_user_calendar(correo, get_user_calendar_version(correo), hours_config)
+
+def find_earliest_slot(lab, from_day, n_slots, days=14):
+    slots = get_lab_slots(lab)
+    boundaries = get_lab_boundaries(lab)
+    # Franjas que pueden formar parte de una reserva (corte de B501)
+    allowed = full_day_mask(lab)
+    for i in range(len(slots)):
+        if validate_time_range(lab, slots[i], boundaries[i + 1]):
+            allowed &= ~(1 << i)
+    capacity = lab_capacities[lab]
+    for offset in range(days):
+        day = from_day + timedelta(days=offset)
+        date_str = day.strftime("%Y-%m-%d")
+        reservations = get_reservations_for_day(date_str)
+        busy = get_blocked_mask(date_str, lab) | counts_to_full_mask(slot_counts(lab, reservations), capacity)
+        free = allowed & ~busy
+        if day == datetime.today().date():
+            now = datetime.now()
+            elapsed = slots_mask(lab, [h for h in slots if to_minutes(h) <= now.hour * 60 + now.minute])
+            free &= ~elapsed
+        starts = window_starts_mask(free, n_slots)
+        if starts:
+            i = (starts & -starts).bit_length() - 1
+            return date_str, slots[i], boundaries[i + n_slots]
+    return None
+
 # ================================
 # MENÚ DE AUTENTICACIÓN → LOGIN / REGISTRAR USUARIO
 # ================================
@@ -186,7 +1870,6 @@ def auth_page():
         register_form()
 
 def login_form():
-    df_users = load_user_data()
     st.write("### Iniciar sesión")
     with st.form(key='login_form'):
         correo = st.text_input("Correo electrónico", key="login_correo")
@@ -208,20 +1891,18 @@ def login_form():
             st.success(f"Inicio de sesión exitoso como {correo}.")
             return
         # Usuario normal desde Excel
-        user_row = df_users[
-            (df_users['Correo'] == correo) & (df_users['Contraseña'] == contraseña)
-        ]
-        if not user_row.empty:
+        user_row = authenticate_user(correo, contraseña)
+        if user_row is not None:
             st.session_state['logged_in'] = True
-            st.session_state['role'] = user_row.iloc[0]['Rol']
+            st.session_state['role'] = user_row['Rol']
             st.session_state['username'] = correo
+            store_session_profile(user_row, get_user_version(correo))
             st.success(f"Inicio de sesión exitoso como {correo}.")
             return
         else:
             st.error("Correo o contraseña incorrectos.")
 
 def register_form():
-    df_users = load_user_data()
     st.write("### Registro de nuevo usuario")
     with st.form(key='register_form'):
         nombre = st.text_input("Nombre", key="register_nombre")
@@ -231,10 +1912,6 @@ def register_form():
         contraseña = st.text_input("Contraseña", type="password", key="register_contraseña")
         submit = st.form_submit_button("Registrarse")
     if submit:
-        # Verificar si ya existe el correo
-        if correo in df_users['Correo'].values:
-            st.error("El correo electrónico ya está registrado.")
-            return
         # Solo permitimos correos de alumnos con dominio @alum.up.edu.pe
         if not correo.endswith('@alum.up.edu.pe'):
             st.error("Solo los alumnos pueden registrarse con un correo institucional '@alum.up.edu.pe'.")
@@ -252,11 +1929,56 @@ def register_form():
             'C402_access': [c402_access],
             'Temp_access_expiry': [pd.NaT]
         })
-        df_users = pd.concat([df_users, nueva_fila], ignore_index=True)
-        save_user_data(df_users)
+        with shared_lock('usuarios'):
+            df_users = load_user_data()
+            # Verificar si ya existe el correo
+            if correo in df_users['Correo'].values:
+                st.error("El correo electrónico ya está registrado.")
+                return
+            df_users = pd.concat([df_users, nueva_fila], ignore_index=True)
+            save_user_data(df_users, changed_users=[correo])
         st.success("Registro exitoso. Ahora puedes iniciar sesión.")
         return
 
+# ------------------------------
+# PERFIL DEL USUARIO EN SESIÓN
+# ------------------------------
+# El perfil se resuelve al iniciar sesión y se guarda en session_state; solo
+# se vuelve a leer user_data.xlsx cuando cambia la versión de ese usuario
+# (permiso del C402, vencimiento o edición del administrador).
+def store_session_profile(user_row, version):
+    st.session_state['user_profile'] = {'row': user_row, 'version': version}
+
+def get_session_user_row():
+    current_user = st.session_state['username']
+    if current_user == 'admin@up.edu.pe':
+        return pd.Series({
+            'Nombre': 'Admin',
+            'Apellido': 'User',
+            'Correo': 'admin@up.edu.pe',
+            'Rol': 'admin',
+            'C402_access': 0,
+            'Temp_access_expiry': pd.NaT
+        })
+    if current_user.endswith('@c402.up.edu.pe'):
+        return pd.Series({
+            'Nombre': 'C402',
+            'Apellido': 'Admin',
+            'Correo': current_user,
+            'Rol': 'c402_admin',
+            'C402_access': 1,
+            'Temp_access_expiry': pd.NaT
+        })
+    profile = st.session_state.get('user_profile')
+    version = get_user_version(current_user)
+    if profile is None or profile['row']['Correo'] != current_user or profile['version'] != version:
+        user_data = load_user_data()
+        match = user_data[user_data['Correo'] == current_user]
+        if match.empty:
+            return None
+        store_session_profile(match.iloc[0], version)
+    return st.session_state['user_profile']['row']
+
 # ================================================
 # CERRAR SESIÓN
 # ================================================
@@ -281,14 +2003,20 @@ def admin_view():
         [
             "Ver Dashboard",
             "Ver reservas",
+            "Exportar a Excel",
             "Bloquear horario",
             "Administrar acceso al C402",
             "Editar lineamientos",
             "Eliminar reservas",
+            "Buscar en reservas y comentarios",
             "Administrar cuentas",
+            "Importar alumnos",
             "Gestionar imágenes iniciales",
             "Configurar límites de grupos",
-            "Configurar capacidades de laboratorios"
+            "Configurar capacidades de laboratorios",
+            "Configurar horario de laboratorios",
+            "Retención y compactación",
+            "Registro de auditoría"
         ],
         key='admin_option'
     )
@@ -296,6 +2024,8 @@ def admin_view():
         show_admin_dashboard()
     elif admin_option == "Ver reservas":
         view_all_reservations()
+    elif admin_option == "Exportar a Excel":
+        export_reservations_page()
     elif admin_option == "Bloquear horario":
         block_schedule()
     elif admin_option == "Administrar acceso al C402":
@@ -304,85 +2034,204 @@ def admin_view():
         edit_rules()
     elif admin_option == "Eliminar reservas":
         delete_reservations()
+    elif admin_option == "Buscar en reservas y comentarios":
+        search_page()
     elif admin_option == "Administrar cuentas":
         manage_accounts()
+    elif admin_option == "Importar alumnos":
+        import_students()
     elif admin_option == "Gestionar imágenes iniciales":
         manage_initial_images()
     elif admin_option == "Configurar límites de grupos":
         configure_group_limits()
     elif admin_option == "Configurar capacidades de laboratorios":
         configure_lab_capacities()
+    elif admin_option == "Configurar horario de laboratorios":
+        configure_lab_hours()
+    elif admin_option == "Retención y compactación":
+        manage_retention()
+    elif admin_option == "Registro de auditoría":
+        audit_log_page()
+
+# Figuras cacheadas por combinación de filtros; la versión (mtime de los
+# archivos del rango) invalida la entrada cuando cambian los datos.
+@st.cache_data(max_entries=64)
+def build_dashboard_figures(start_date, end_date, labs, version):
+    all_reservations = load_reservations_range(start_date, end_date, labs)
+    lab_reservations = all_reservations['Laboratorio'].value_counts().reindex(list(labs), fill_value=0)
+    result = {'total': len(all_reservations), 'figures': []}
+
+    data = lab_reservations.rename('Reservas').rename_axis('Laboratorio').reset_index()
+    result['figures'].append(
+        px.pie(data, values='Reservas', names='Laboratorio', title='Distribución de reservas por laboratorio')
+    )
+    if all_reservations.empty:
+        return result
+
+    rule, unit = choose_resample_rule(start_date, end_date)
+    per_day = all_reservations.groupby('Fecha').size()
+    per_day.index = pd.to_datetime(per_day.index)
+    full_range = pd.date_range(start_date, end_date, freq='D')
+    reservations_over_time = per_day.reindex(full_range, fill_value=0).resample(rule).sum()
+    reservations_over_time = reservations_over_time.rename('Reservas').rename_axis('Fecha').reset_index()
+    result['figures'].append(
+        px.line(reservations_over_time, x='Fecha', y='Reservas', title=f'Reservas por {unit}')
+    )
+
+    # Conteo por categoría: ya sale en orden cronológico
+    peak_hours = to_hours(all_reservations['Hora']).value_counts(sort=False)
+    peak_hours = peak_hours[peak_hours > 0].astype(int)
+    peak_hours.index = peak_hours.index.astype(str)
+    peak_hours = peak_hours.rename('Reservas').rename_axis('Hora').reset_index()
+    result['figures'].append(
+        px.bar(peak_hours, x='Hora', y='Reservas', title='Reservas por hora')
+    )
+
+    top_users = all_reservations['Correo'].value_counts().head(10)
+    top_users = top_users.rename('Reservas').rename_axis('Correo').reset_index()
+    result['figures'].append(
+        px.bar(top_users, x='Correo', y='Reservas', title='Top 10 usuarios con más reservas')
+    )
+    return result
+
+@st.cache_data(max_entries=32)
+def build_analytics(start_date, end_date, labs, version, capacities, hours_config):
+    # capacities y hours_config forman parte de la clave: la ocupación cambia
+    # si cambia la capacidad o la grilla de un laboratorio
+    reservations = load_reservations_range(start_date, end_date, labs)
+    slots_by_lab = {lab: get_lab_slots(lab) for lab in labs}
+    result = analytics.compute_analytics(
+        reservations, start_date, end_date, dict(capacities), slots_by_lab, datetime.today().date()
+    )
+    result['figures'] = [
+        px.density_heatmap(
+            result['ocupacion'][result['ocupacion']['Laboratorio'] == lab],
+            x='Día', y='Hora', z='Ocupación', histfunc='avg',
+            category_orders={'Día': analytics.weekday_names},
+            range_color=(0, 1), color_continuous_scale='YlOrRd',
+            title=f'Ocupación promedio frente a capacidad — {lab}'
+        ).update_yaxes(autorange='reversed')
+        for lab in labs
+    ]
+    return result
+
+def analytics_config_key(labs):
+    capacities = tuple(sorted((lab, lab_capacities[lab]) for lab in labs))
+    hours_config = tuple(sorted((lab, tuple(sorted(lab_hours[lab].items()))) for lab in labs))
+    return capacities, hours_config
 
+def show_analytics_tab(start_date, end_date, labs):
+    version = get_range_version(start_date, end_date)
+    result = build_analytics(start_date, end_date, labs, version, *analytics_config_key(labs))
+
+    st.write("#### Ocupación por laboratorio y franja")
+    for fig in result['figures']:
+        st.plotly_chart(fig)
+
+    st.write("#### Demanda por franja (reservas por día)")
+    st.dataframe(result['demanda'])
+
+    st.write("#### Tasas de no-show")
+    st.caption(f"Reservas pasadas evaluadas: {result['reservas_evaluadas']}. Solo el C402 registra asistencia; una reserva sin asistencia confirmada cuenta como no-show.")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.write("Por usuario")
+        st.dataframe(result['no_show_usuarios'])
+    with col2:
+        st.write("Por grupo")
+        st.dataframe(result['no_show_grupos'])
+
+def dashboard_default_range(today):
+    return current_term_start(today, load_retention_policy()['term_starts']), today + timedelta(days=30)
+
+# Los filtros y los gráficos forman un fragmento: cambiar el rango o los
+# laboratorios no vuelve a ejecutar el menú ni el resto del panel
+@st.fragment
 def show_admin_dashboard():
     st.write("### Dashboard administrativo")
     st.write("#### Estadísticas de reservas")
-    reservation_files = glob.glob('*.xlsx')
-    exclude = [
-        user_data_file, schedule_file,
-        initial_image_file_B501, initial_image_file_C402,
-        group_limits_file, comments_file
-    ]
-    reservation_files = [f for f in reservation_files if f not in exclude]
-    total_reservations = 0
-    lab_reservations = {lab: 0 for lab in laboratories}
-    reservation_list = []
-    for file in reservation_files:
-        reservations = pd.read_excel(file, index_col=None)
-        reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-        date_str = file.replace('.xlsx', '')
-        reservations['Fecha'] = date_str
-        reservation_list.append(reservations)
-        total_reservations += len(reservations)
-        for lab in laboratories:
-            lab_reservations[lab] += len(reservations[reservations['Laboratorio'] == lab])
-
+    status = warmup_status()
+    if not status['listo']:
+        st.info(f"La precarga del servidor sigue en curso ({status['completados']}/{status['total']}); los datos que falten se cargan al abrirlos.")
+    today = datetime.today().date()
     col1, col2 = st.columns(2)
     with col1:
-        st.metric("Total de reservas", total_reservations)
+        date_range = st.date_input(
+            "Rango de fechas",
+            value=dashboard_default_range(today),
+            key='dashboard_date_range'
+        )
     with col2:
-        st.metric("Laboratorios", len(laboratories))
-
-    data = pd.DataFrame.from_dict(lab_reservations, orient='index', columns=['Reservas'])
-    data = data.reset_index().rename(columns={'index': 'Laboratorio'})
-    fig = px.pie(data, values='Reservas', names='Laboratorio', title='Distribución de reservas por laboratorio')
-    st.plotly_chart(fig)
-
-    if reservation_list:
-        all_reservations = pd.concat(reservation_list)
-        all_reservations = all_reservations.sort_values(['Fecha', 'Hora'])
-        reservations_over_time = all_reservations.groupby('Fecha').size().reset_index(name='Reservas')
-        fig_time = px.line(reservations_over_time, x='Fecha', y='Reservas', title='Reservas a lo largo del tiempo')
-        st.plotly_chart(fig_time)
-
-        peak_hours = all_reservations.groupby('Hora').size().reset_index(name='Reservas')
-        peak_hours['Hora'] = pd.to_datetime(peak_hours['Hora'], format='%H:%M')
-        peak_hours = peak_hours.sort_values('Hora')
-        fig_peak = px.bar(peak_hours, x=peak_hours['Hora'].dt.strftime('%H:%M'), y='Reservas', title='Reservas por hora')
-        st.plotly_chart(fig_peak)
-
-        user_reservations = all_reservations.groupby('Correo').size().reset_index(name='Reservas')
-        top_users = user_reservations.sort_values('Reservas', ascending=False).head(10)
-        fig_users = px.bar(top_users, x='Correo', y='Reservas', title='Top 10 usuarios con más reservas')
-        st.plotly_chart(fig_users)
+        selected_labs = st.multiselect(
+            "Laboratorios",
+            laboratories,
+            default=laboratories,
+            key='dashboard_labs'
+        )
+    if not isinstance(date_range, (list, tuple)) or len(date_range) != 2:
+        st.info("Selecciona la fecha de inicio y de fin del rango.")
+        return
+    if not selected_labs:
+        st.info("Selecciona al menos un laboratorio.")
+        return
+    start_date, end_date = date_range
+    labs = tuple(selected_labs)
+
+    tab_reservations, tab_analytics = st.tabs(["Reservas", "Analítica"])
+    with tab_reservations:
+        dashboard = build_dashboard_figures(start_date, end_date, labs, get_range_version(start_date, end_date))
+
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Total de reservas", dashboard['total'])
+        with col2:
+            st.metric("Laboratorios", len(labs))
+
+        for fig in dashboard['figures']:
+            st.plotly_chart(fig)
+        if dashboard['total'] == 0:
+            st.write("No hay datos suficientes para generar métricas.")
+    with tab_analytics:
+        show_analytics_tab(start_date, end_date, labs)
+
+def export_reservations_page():
+    st.write("### Exportar a Excel")
+    st.write("Genera un libro .xlsx (una hoja por laboratorio) con las reservas de un día, de un rango de fechas o de un solo laboratorio. Si los datos no cambiaron, se reutiliza el último libro generado.")
+    scope = st.radio("Exportar", ["Un día", "Rango de fechas", "Un laboratorio"], key='export_scope', horizontal=True)
+    today = datetime.today().date()
+    labs = laboratories
+    if scope == "Un día":
+        day = st.date_input("Fecha", value=today, key='export_day')
+        start_date = end_date = day
     else:
-        st.write("No hay datos suficientes para generar métricas.")
+        if scope == "Un laboratorio":
+            labs = [st.selectbox("Laboratorio", laboratories, key='export_lab')]
+        date_range = st.date_input("Rango de fechas", value=dashboard_default_range(today), key='export_range')
+        if not isinstance(date_range, (list, tuple)) or len(date_range) != 2:
+            st.info("Selecciona la fecha de inicio y de fin del rango.")
+            return
+        start_date, end_date = date_range
+    if st.button("Generar Excel", key='export_button'):
+        start = time.perf_counter()
+        path, name, generated = export_reservations_xlsx(start_date, end_date, labs)
+        elapsed = (time.perf_counter() - start) * 1000
+        st.caption(f"{'Generado' if generated else 'Tomado de la caché'} en {elapsed:.0f} ms.")
+        with open(path, 'rb') as f:
+            st.download_button(
+                f"Descargar {name}",
+                data=f.read(),
+                file_name=name,
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key='export_download'
+            )
 
 def view_all_reservations():
     st.write("### Todas las reservas")
-    reservation_files = glob.glob('*.xlsx')
-    exclude = [
-        user_data_file, schedule_file,
-        initial_image_file_B501, initial_image_file_C402,
-        group_limits_file, comments_file
-    ]
-    reservation_files = [f for f in reservation_files if f not in exclude]
-    reservations_list = []
-    for file in reservation_files:
-        reservations = pd.read_excel(file, index_col=None)
-        reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-        date_str = file.replace('.xlsx', '')
-        reservations['Fecha'] = date_str
-        reservations_list.append(reservations)
+    reservations_list = load_reservation_days(get_reservation_files())
+    if st.checkbox("Incluir reservas archivadas", key='view_all_include_archive'):
+        archived = load_archived_reservations()
+        if not archived.empty:
+            reservations_list.append(archived)
     if reservations_list:
         all_reservations = pd.concat(reservations_list)
         all_reservations.sort_values(['Fecha', 'Hora'], inplace=True)
@@ -390,14 +2239,75 @@ def view_all_reservations():
     else:
         st.write("No hay reservas registradas.")
 
+def search_page():
+    st.write("### Buscar en reservas y comentarios")
+    st.write("Busca en el propósito y el grupo de las reservas (incluidas las archivadas) y en los comentarios de los alumnos. Se muestran primero los resultados más relevantes; una palabra incompleta también coincide con las que empiezan igual.")
+    query = st.text_input("Palabras a buscar", key='search_query')
+    kinds = st.multiselect("Incluir", ['Reserva', 'Comentario'], default=['Reserva', 'Comentario'], key='search_kinds')
+    if not query.strip():
+        return
+    results, n_docs, elapsed_ms = search_text(query, kinds)
+    st.caption(f"{len(results)} resultados en {elapsed_ms:.1f} ms ({n_docs} documentos indexados).")
+    if results:
+        columns = ['Tipo', 'Puntaje', 'Fecha', 'Laboratorio', 'Horario', 'Nombre', 'Correo', 'Texto']
+        st.dataframe(pd.DataFrame(results, columns=columns), hide_index=True)
+    else:
+        st.write("No se encontraron coincidencias.")
+
+def audit_log_page():
+    st.write("### Registro de auditoría")
+    today = datetime.today().date()
+    col1, col2 = st.columns(2)
+    with col1:
+        date_range = st.date_input("Rango de fechas", value=(today - timedelta(days=30), today), key='audit_date_range')
+    with col2:
+        page_size = st.selectbox("Eventos por página", [25, 50, 100], key='audit_page_size')
+    if not isinstance(date_range, (list, tuple)) or len(date_range) != 2:
+        st.info("Selecciona la fecha de inicio y de fin del rango.")
+        return
+    start_date, end_date = date_range
+    page = st.number_input("Página", min_value=1, value=1, step=1, key='audit_page') - 1
+    start = time.perf_counter()
+    events, total = read_audit_page(start_date, end_date, int(page), page_size)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    pages = max((total + page_size - 1) // page_size, 1)
+    st.caption(f"{total} eventos en el rango; página {int(page) + 1} de {pages} ({elapsed_ms:.1f} ms).")
+    if events.empty:
+        st.write("No hay eventos en esta página.")
+    else:
+        st.dataframe(events, hide_index=True)
+
+def remove_blocked_reservations(lab, dates, start_time, end_time):
+    # Quita las reservas que caen dentro del bloqueo; una escritura por día
+    block_mask = slots_mask(lab, get_desired_hours(lab, start_time, end_time))
+    affected_list = []
+    for date_str in dates:
+        with day_lock(date_str):
+            reservations = get_reservations_for_day(date_str)
+            # Una reserva queda afectada si el bit de su franja está en el bloqueo
+            blocked_indices = [i for i in range(len(get_lab_slots(lab))) if block_mask >> i & 1]
+            affected_mask = (reservations['Laboratorio'] == lab) & np.isin(
+                hour_slot_indices(lab, reservations['Hora']), blocked_indices
+            )
+            affected = reservations[affected_mask]
+            if not affected.empty:
+                save_reservations_for_day(reservations[~affected_mask], date_str)
+                affected_list.append(affected.assign(Fecha=date_str))
+    if affected_list:
+        return pd.concat(affected_list, ignore_index=True)
+    return pd.DataFrame()
+
 def block_schedule():
     st.write("### Bloquear horario")
+    # El laboratorio va fuera del formulario: la grilla de horas depende de él
+    selected_lab = st.selectbox(
+        "Seleccionar laboratorio para bloquear",
+        laboratories,
+        key='admin_lab_block'
+    )
+    lab_slots = get_lab_slots(selected_lab)
+    lab_boundaries = get_lab_boundaries(selected_lab)
     with st.form(key='block_form'):
-        selected_lab = st.selectbox(
-            "Seleccionar laboratorio para bloquear",
-            laboratories,
-            key='admin_lab_block'
-        )
         selected_day = st.date_input(
             "Seleccionar fecha para bloquear",
             key='admin_date_block'
@@ -405,12 +2315,12 @@ def block_schedule():
         date_str = selected_day.strftime("%Y-%m-%d")
         selected_start_time = st.selectbox(
             "Hora de inicio",
-            hours,
+            lab_slots,
             key='admin_start_time_block'
         )
         try:
-            start_index = hours.index(selected_start_time) + 1
-            available_end_times = hours[start_index:]
+            start_index = lab_boundaries.index(selected_start_time) + 1
+            available_end_times = lab_boundaries[start_index:]
             if not available_end_times:
                 st.error("No hay horas de fin disponibles después de la hora de inicio seleccionada.")
                 selected_end_time = None
@@ -424,53 +2334,87 @@ def block_schedule():
             st.error("Hora de inicio seleccionada no es válida.")
             selected_end_time = None
 
+        repetition = st.radio(
+            "Repetición",
+            ["Solo esta fecha", "Cada semana"],
+            key='admin_block_repetition',
+            help="'Cada semana' bloquea el mismo día de la semana a partir de la fecha seleccionada."
+        )
+        col1, col2 = st.columns(2)
+        with col1:
+            until_day = st.date_input("Repetir hasta", key='admin_block_until')
+        with col2:
+            no_end = st.checkbox("Sin fecha final", value=True, key='admin_block_no_end')
         block_reason = st.text_area("Motivo del bloqueo (opcional)", key='admin_block_reason')
         submit_button = st.form_submit_button(label='Bloquear horario')
 
     if submit_button and selected_end_time:
-        global schedule_data
-        start_index = hours.index(selected_start_time)
-        end_index = hours.index(selected_end_time)
-        blocked_hours = hours[start_index:end_index]
-        new_rows = pd.DataFrame({
-            'Día': [date_str]*len(blocked_hours),
-            'Hora': blocked_hours,
-            'Laboratorio': [selected_lab]*len(blocked_hours),
-            'Estado': [1]*len(blocked_hours),
-            'Motivo': [block_reason]*len(blocked_hours)
-        })
-        schedule_data = pd.concat([schedule_data, new_rows], ignore_index=True)
-        save_schedule_data()
-        st.success(f"Horario bloqueado en laboratorio {selected_lab} el día {date_str} de {selected_start_time} a {selected_end_time}.")
-
-        affected_reservations = []
-        for blocked_hour in blocked_hours:
-            reservations = get_reservations_for_day(date_str)
-            affected = reservations[
-                (reservations['Laboratorio'] == selected_lab) &
-                (reservations['Hora'] == blocked_hour)
+        weekly = repetition == "Cada semana"
+        until_str = until_day.strftime("%Y-%m-%d") if weekly and not no_end else ''
+        if until_str and until_str < date_str:
+            st.error("La fecha final de la repetición debe ser posterior a la fecha inicial.")
+            return
+        with shared_lock('bloqueos'):
+            blocks = load_blocks()
+            new_block = pd.DataFrame([{
+                'ID': int(blocks['ID'].max()) + 1 if not blocks.empty else 1,
+                'Laboratorio': selected_lab,
+                'Repetición': 'Semanal' if weekly else 'Única',
+                'Día': date_str,
+                'Día_semana': selected_day.weekday() if weekly else '',
+                'Hasta': until_str,
+                'Inicio': selected_start_time,
+                'Fin': selected_end_time,
+                'Motivo': block_reason
+            }], columns=blocks_columns)
+            save_blocks(pd.concat([blocks, new_block], ignore_index=True))
+        detail = f"{'Semanal' if weekly else 'Única'} desde {date_str}" + (f" hasta {until_str}" if until_str else "")
+        record_audit('Bloqueo de horario', selected_lab, f"{detail}, {selected_start_time} - {selected_end_time}. {block_reason}".strip())
+        if weekly:
+            hasta = f" hasta el {until_str}" if until_str else ""
+            st.success(f"Horario bloqueado en laboratorio {selected_lab} cada {weekday_names[selected_day.weekday()].lower()} desde el {date_str}{hasta}, de {selected_start_time} a {selected_end_time}.")
+            # Días con reservas guardadas que coinciden con la regla
+            dates = [
+                day for day in (file_date(file) for file in get_reservation_files())
+                if day >= date_str and (not until_str or day <= until_str) and
+                datetime.strptime(day, "%Y-%m-%d").weekday() == selected_day.weekday()
             ]
-            if not affected.empty:
-                affected_reservations.append(affected)
+        else:
+            st.success(f"Horario bloqueado en laboratorio {selected_lab} el día {date_str} de {selected_start_time} a {selected_end_time}.")
+            dates = [date_str]
 
-        if affected_reservations:
-            affected_df = pd.concat(affected_reservations)
+        affected_df = remove_blocked_reservations(selected_lab, dates, selected_start_time, selected_end_time)
+        if not affected_df.empty:
+            for (fecha, correo), affected in affected_df.groupby(['Fecha', 'Correo']):
+                record_audit('Eliminación de reserva', correo, f"{fecha} - {selected_lab} - {hour_runs(selected_lab, affected['Hora'].astype(str))} (por bloqueo)")
             st.write("Se han encontrado las siguientes reservas afectadas:")
             st.dataframe(affected_df.reset_index(drop=True))
             for index, row in affected_df.iterrows():
                 st.info(f"Se notificó a {row['Nombre']} {row['Apellido']} ({row['Correo']}) sobre el bloqueo.")
-            for blocked_hour in blocked_hours:
-                reservations = get_reservations_for_day(date_str)
-                updated_reservations = reservations[
-                    ~(
-                        (reservations['Laboratorio'] == selected_lab) &
-                        (reservations['Hora'] == blocked_hour)
-                    )
-                ]
-                save_reservations_for_day(updated_reservations, date_str)
         else:
             st.write("No hay reservas afectadas por este bloqueo.")
 
+    st.write("#### Bloqueos registrados")
+    blocks = load_blocks()
+    if blocks.empty:
+        st.write("No hay bloqueos registrados.")
+        return
+    display = blocks.copy()
+    display['Día_semana'] = display['Día_semana'].map(lambda d: weekday_names[int(d)] if d != '' else '')
+    st.dataframe(display.reset_index(drop=True))
+    to_remove = st.multiselect(
+        "Seleccionar bloqueos a eliminar",
+        blocks['ID'],
+        format_func=lambda block_id: " ".join(str(v) for v in blocks.loc[blocks['ID'] == block_id, ['Laboratorio', 'Repetición', 'Día', 'Inicio', 'Fin']].iloc[0]),
+        key='admin_remove_blocks'
+    )
+    if to_remove and st.button("Eliminar bloqueos seleccionados", key='admin_remove_blocks_button'):
+        with shared_lock('bloqueos'):
+            blocks = load_blocks()
+            save_blocks(blocks[~blocks['ID'].isin(to_remove)])
+        record_audit('Eliminación de bloqueos', ', '.join(str(block_id) for block_id in to_remove))
+        st.success(f"Se eliminaron {len(to_remove)} bloqueos.")
+
 def grant_c402_access():
     st.write("### Administrar acceso al laboratorio C402")
     st.write("En esta sección, puedes habilitar o deshabilitar el acceso de los alumnos al laboratorio C402, incluyendo permisos temporales.")
@@ -487,7 +2431,7 @@ def grant_c402_access():
         access_status = "Habilitado" if current_access == 1 else "Deshabilitado"
         st.write(f"**Acceso actual al C402:** {access_status}")
         if pd.notna(temp_expiry):
-            st.write(f"**Permiso temporal hasta:** {temp_expiry}")
+            st.write(f"**Permiso temporal hasta:** {temp_expiry.strftime('%Y-%m-%d')}")
         else:
             st.write(f"**Permiso temporal hasta:** No aplica")
 
@@ -499,17 +2443,15 @@ def grant_c402_access():
 
         if new_access == "Habilitar":
             if st.button("Actualizar acceso a Habilitado", key='enable_access_button'):
-                user_data.loc[user_data['Correo'] == selected_user, 'C402_access'] = 1
-                user_data.loc[user_data['Correo'] == selected_user, 'Temp_access_expiry'] = pd.NaT
-                save_user_data(user_data)
+                set_c402_access(selected_user, 1)
+                record_audit('Acceso al C402', selected_user, "Habilitado")
                 st.success(f"Acceso al laboratorio C402 habilitado para {user_row['Nombre']} {user_row['Apellido']}.")
                 return
 
         elif new_access == "Deshabilitar":
             if st.button("Actualizar acceso a Deshabilitado", key='disable_access_button'):
-                user_data.loc[user_data['Correo'] == selected_user, 'C402_access'] = 0
-                user_data.loc[user_data['Correo'] == selected_user, 'Temp_access_expiry'] = pd.NaT
-                save_user_data(user_data)
+                set_c402_access(selected_user, 0)
+                record_audit('Acceso al C402', selected_user, "Deshabilitado")
                 st.success(f"Acceso al laboratorio C402 deshabilitado para {user_row['Nombre']} {user_row['Apellido']}.")
                 return
 
@@ -519,72 +2461,30 @@ def grant_c402_access():
                 submit_temp = st.form_submit_button("Aplicar permiso temporal")
             if submit_temp:
                 expiry_date = datetime.today() + timedelta(days=int(days))
-                user_data.loc[user_data['Correo'] == selected_user, 'C402_access'] = 1
-                user_data.loc[user_data['Correo'] == selected_user, 'Temp_access_expiry'] = expiry_date.strftime("%Y-%m-%d")
-                save_user_data(user_data)
+                set_c402_access(selected_user, 1, pd.Timestamp(expiry_date.date()))
+                record_audit('Acceso al C402', selected_user, f"Temporal hasta {expiry_date.strftime('%Y-%m-%d')}")
                 st.success(f"Acceso temporal al laboratorio C402 habilitado para {user_row['Nombre']} {user_row['Apellido']} hasta {expiry_date.strftime('%Y-%m-%d')}.")
                 return
 
 def delete_reservations():
     st.write("### Eliminar reservas")
-    user_data = load_user_data()
     current_user = st.session_state['username']
-    user_reservations = []
-    reservation_files = glob.glob('*.xlsx')
-    exclude = [
-        user_data_file, schedule_file,
-        initial_image_file_B501, initial_image_file_C402,
-        group_limits_file, comments_file
-    ]
-    reservation_files = [f for f in reservation_files if f not in exclude]
-    for file in reservation_files:
-        reservations = pd.read_excel(file, index_col=None)
-        reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-        date_str = file.replace('.xlsx', '')
-        required_columns = [
-            'Nombre', 'Apellido', 'Código', 'Correo',
-            'Laboratorio', 'Hora', 'Propósito', 'Tipo',
-            'Grupo', 'Cantidad_alumnos'
-        ]
-        for col in required_columns:
-            if col not in reservations.columns:
-                if col == 'Cantidad_alumnos':
-                    reservations[col] = 1
-                else:
-                    reservations[col] = ''
-        user_specific = reservations[reservations['Correo'] == current_user]
-        if not user_specific.empty:
-            user_specific['Fecha'] = date_str
-            user_reservations.append(user_specific)
+    bookings = group_bookings(get_user_reservations(current_user))
+    if not bookings.empty:
+        st.dataframe(bookings, hide_index=True)
 
-    if user_reservations:
-        all_user_reservations = pd.concat(user_reservations)
-        all_user_reservations = all_user_reservations.sort_values(['Fecha', 'Hora'])
-        display_columns = ['Fecha', 'Laboratorio', 'Hora', 'Propósito', 'Tipo', 'Grupo', 'Cantidad_alumnos']
-        for col in display_columns:
-            if col not in all_user_reservations.columns:
-                all_user_reservations[col] = ''
-        st.dataframe(all_user_reservations[display_columns].reset_index(drop=True))
-
-        all_user_reservations = all_user_reservations.reset_index(drop=True)
-        selected_reservation = st.selectbox(
+        # Se elimina la reserva completa (todas sus franjas) en una escritura
+        selected_booking = st.selectbox(
             "Seleccionar reserva a eliminar",
-            all_user_reservations.index,
-            format_func=lambda x: f"{all_user_reservations.loc[x]['Fecha']} - {all_user_reservations.loc[x]['Laboratorio']} - {all_user_reservations.loc[x]['Hora']}"
+            bookings.index,
+            format_func=lambda x: booking_label(bookings.loc[x])
         )
         if st.button("Eliminar reserva"):
-            reservation_row = all_user_reservations.loc[selected_reservation]
-            reservation_file = f"{reservation_row['Fecha']}.xlsx"
-            reservations = pd.read_excel(reservation_file, index_col=None)
-            reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-            condition = (
-                (reservations['Correo'] == reservation_row['Correo']) &
-                (reservations['Laboratorio'] == reservation_row['Laboratorio']) &
-                (reservations['Hora'] == reservation_row['Hora'])
-            )
-            reservations = reservations[~condition]
-            save_reservations_for_day(reservations, reservation_row['Fecha'])
-            st.success("Reserva eliminada exitosamente.")
+            booking = bookings.loc[selected_booking]
+            removed = cancel_booking(current_user, booking['Reserva_ID'])
+            if removed:
+                record_audit('Eliminación de reserva', current_user, f"{booking_label(booking)} ({booking['Reserva_ID']})")
+            st.success(f"Reserva eliminada exitosamente ({removed} franjas liberadas).")
             return
     else:
         st.info("No tienes reservas para eliminar.")
@@ -596,10 +2496,7 @@ def edit_rules():
         ["Global"] + laboratories,
         key='select_lab_edit_rules'
     )
-    if selected_lab == "Global":
-        rules_file = 'lineamientos.txt'
-    else:
-        rules_file = f'lineamientos_{selected_lab}.txt'
+    rules_file = get_rules_file(None if selected_lab == "Global" else selected_lab)
     if os.path.exists(rules_file):
         with open(rules_file, 'r') as f:
             rules = f.read()
@@ -607,8 +2504,8 @@ def edit_rules():
         rules = ""
     new_rules = st.text_area("Edita los lineamientos aquí:", value=rules, height=300)
     if st.button("Guardar cambios"):
-        with open(rules_file, 'w') as f:
-            f.write(new_rules)
+        write_text(new_rules, rules_file)
+        load_rules.clear()
         st.success("Lineamientos actualizados exitosamente.")
         return
 
@@ -628,11 +2525,7 @@ def manage_accounts():
             contraseña = st.text_input("Contraseña", type="password", key="add_admin_contraseña")
             submit_button = st.form_submit_button(label='Agregar administrador')
         if submit_button:
-            user_data = load_user_data()
-            if correo in user_data['Correo'].values:
-                st.error("El correo electrónico ya está registrado.")
-                return
-            elif not correo.endswith('@up.edu.pe'):
+            if not correo.endswith('@up.edu.pe'):
                 st.error("El correo debe ser institucional '@up.edu.pe'.")
                 return
             new_admin = pd.DataFrame({
@@ -645,8 +2538,14 @@ def manage_accounts():
                 'C402_access': [0],
                 'Temp_access_expiry': [pd.NaT]
             })
-            user_data = pd.concat([user_data, new_admin], ignore_index=True)
-            save_user_data(user_data)
+            with shared_lock('usuarios'):
+                user_data = load_user_data()
+                if correo in user_data['Correo'].values:
+                    st.error("El correo electrónico ya está registrado.")
+                    return
+                user_data = pd.concat([user_data, new_admin], ignore_index=True)
+                save_user_data(user_data, changed_users=[correo])
+            record_audit('Cuenta creada', correo, "admin")
             st.success("Nuevo administrador agregado exitosamente.")
             return
 
@@ -659,11 +2558,7 @@ def manage_accounts():
             contraseña = st.text_input("Contraseña", type="password", key="add_c402_admin_contraseña")
             submit_button = st.form_submit_button(label='Agregar C402 Admin')
         if submit_button:
-            user_data = load_user_data()
-            if correo in user_data['Correo'].values:
-                st.error("El correo electrónico ya está registrado.")
-                return
-            elif not correo.endswith('@up.edu.pe'):
+            if not correo.endswith('@up.edu.pe'):
                 st.error("El correo debe ser institucional '@up.edu.pe'.")
                 return
             new_c402_admin = pd.DataFrame({
@@ -676,21 +2571,111 @@ def manage_accounts():
                 'C402_access': [1],
                 'Temp_access_expiry': [pd.NaT]
             })
-            user_data = pd.concat([user_data, new_c402_admin], ignore_index=True)
-            save_user_data(user_data)
+            with shared_lock('usuarios'):
+                user_data = load_user_data()
+                if correo in user_data['Correo'].values:
+                    st.error("El correo electrónico ya está registrado.")
+                    return
+                user_data = pd.concat([user_data, new_c402_admin], ignore_index=True)
+                save_user_data(user_data, changed_users=[correo])
+            record_audit('Cuenta creada', correo, "c402_admin")
             st.success("Nuevo C402 Admin agregado exitosamente.")
             return
 
+# Columnas mínimas de un padrón; la contraseña es opcional (por defecto el código)
+roster_columns = ['Nombre', 'Apellido', 'Correo', 'Código']
+
+def validate_roster(roster, df_users):
+    roster = roster.loc[:, ~roster.columns.astype(str).str.contains('^Unnamed')].copy()
+    roster.columns = [str(c).strip() for c in roster.columns]
+    for col in roster_columns + ['Contraseña']:
+        if col not in roster.columns:
+            roster[col] = ''
+    roster = roster[roster_columns + ['Contraseña']].fillna('').astype(str)
+    roster = roster.apply(lambda c: c.str.strip())
+    roster['Correo'] = roster['Correo'].str.lower()
+
+    existing = set(df_users['Correo'].astype(str).str.strip().str.lower())
+    checks = {
+        "Correo vacío": roster['Correo'] == '',
+        "Dominio distinto de @alum.up.edu.pe": (roster['Correo'] != '') & ~roster['Correo'].str.endswith('@alum.up.edu.pe'),
+        "Correo ya registrado": roster['Correo'].isin(existing),
+        "Correo duplicado en el archivo": (roster['Correo'] != '') & roster['Correo'].duplicated(keep='first'),
+        "Código faltante": roster['Código'] == '',
+        "Nombre faltante": roster['Nombre'] == '',
+    }
+    errors = pd.Series([''] * len(roster), index=roster.index)
+    for message, mask in checks.items():
+        errors = errors.where(~mask, errors + message + '; ')
+    errors = errors.str.rstrip('; ')
+
+    report = roster[['Nombre', 'Apellido', 'Correo', 'Código']].copy()
+    # Fila según el archivo original (encabezado en la fila 1)
+    report.insert(0, 'Fila', range(2, len(roster) + 2))
+    report['Estado'] = errors.map(lambda e: 'Error' if e else 'Válido')
+    report['Errores'] = errors
+
+    valid = roster[errors == ''].copy()
+    valid['Contraseña'] = valid['Contraseña'].where(valid['Contraseña'] != '', valid['Código'])
+    valid['Rol'] = 'alumno'
+    valid['C402_access'] = 0
+    valid['Temp_access_expiry'] = pd.NaT
+    return valid, report
+
+def import_students():
+    st.write("### Importar alumnos")
+    st.write("Sube un padrón en CSV o Excel con las columnas **Nombre**, **Apellido**, **Correo** y **Código** (opcionalmente **Contraseña**; si falta, la contraseña inicial será el código).")
+    uploaded_file = st.file_uploader("Subir padrón", type=["csv", "xlsx"], key='import_students_file')
+    if not uploaded_file:
+        return
+    try:
+        if uploaded_file.name.lower().endswith('.csv'):
+            roster = pd.read_csv(uploaded_file, dtype=str)
+        else:
+            roster = pd.read_excel(uploaded_file, dtype=str, index_col=None)
+    except Exception as e:
+        st.error(f"No se pudo leer el archivo: {e}")
+        return
+
+    df_users = load_user_data()
+    valid, report = validate_roster(roster, df_users)
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Filas válidas", len(valid))
+    with col2:
+        st.metric("Filas con errores", int((report['Estado'] == 'Error').sum()))
+    st.dataframe(report.reset_index(drop=True))
+    st.download_button(
+        "Descargar reporte",
+        report.to_csv(index=False).encode('utf-8'),
+        file_name='reporte_importacion.csv',
+        mime='text/csv',
+        key='import_students_report'
+    )
+
+    if not valid.empty and st.button(f"Registrar {len(valid)} alumnos", key='import_students_confirm'):
+        with shared_lock('usuarios'):
+            # Se valida otra vez contra el archivo actual: alguien pudo
+            # registrarse después de la vista previa
+            df_users = load_user_data()
+            valid, _ = validate_roster(roster, df_users)
+            df_users = pd.concat([df_users, valid.reindex(columns=df_users.columns)], ignore_index=True)
+            save_user_data(df_users, changed_users=valid['Correo'])
+        st.success(f"Se registraron {len(valid)} alumnos.")
+        return
+
 def manage_initial_images():
     st.write("### Gestionar imágenes iniciales")
     st.write("Puedes subir imágenes específicas para cada laboratorio.")
     for lab in laboratories:
         st.write(f"#### Imagen para {lab}")
-        image_file = f'initial_image_{lab}.png'
+        image_file = initial_image_file(lab)
         uploaded_file = st.file_uploader(f"Subir imagen para {lab}", type=["png", "jpg", "jpeg"], key=f'upload_initial_image_{lab}')
         if uploaded_file:
-            with open(image_file, "wb") as f:
-                f.write(uploaded_file.getbuffer())
+            def write_image(tmp_file):
+                with open(tmp_file, "wb") as f:
+                    f.write(uploaded_file.getbuffer())
+            atomic_write(image_file, write_image)
             st.success(f"Imagen para {lab} subida exitosamente.")
             return
         if os.path.exists(image_file):
@@ -699,11 +2684,7 @@ def manage_initial_images():
 def configure_group_limits():
     st.write("### Configurar límites de grupos para C402")
     limits_file = group_limits_file
-    if os.path.exists(limits_file):
-        limits = pd.read_excel(limits_file, index_col=None)
-        limits = limits.loc[:, ~limits.columns.str.contains('^Unnamed')]
-    else:
-        limits = pd.DataFrame(columns=['Tipo', 'Límite'])
+    limits = load_group_limits()
 
     st.write("#### Límites actuales:")
     st.dataframe(limits.reset_index(drop=True))
@@ -713,12 +2694,15 @@ def configure_group_limits():
         limite = st.number_input("Límite de alumnos por grupo", min_value=1, max_value=100, key='group_limit')
         submit_limit = st.form_submit_button("Actualizar límite")
     if submit_limit:
-        if tipo in limits['Tipo'].values:
-            limits.loc[limits['Tipo'] == tipo, 'Límite'] = limite
-        else:
-            new_limit = pd.DataFrame({'Tipo': [tipo], 'Límite': [limite]})
-            limits = pd.concat([limits, new_limit], ignore_index=True)
-        limits.to_excel(limits_file, index=False)
+        with shared_lock('limites-grupo'):
+            limits = load_group_limits()
+            if tipo in limits['Tipo'].values:
+                limits.loc[limits['Tipo'] == tipo, 'Límite'] = limite
+            else:
+                new_limit = pd.DataFrame({'Tipo': [tipo], 'Límite': [limite]})
+                limits = pd.concat([limits, new_limit], ignore_index=True)
+            write_excel(limits, limits_file)
+        record_audit('Límite de grupo', tipo, str(limite))
         st.success("Límite de grupo actualizado exitosamente.")
         return
 
@@ -734,11 +2718,125 @@ def configure_lab_capacities():
         new_capacity = st.number_input(f"Nueva capacidad para {selected_lab}", min_value=1, max_value=100, value=lab_capacities[selected_lab], key='new_capacity')
         submit_capacity = st.form_submit_button("Actualizar capacidad")
     if submit_capacity:
-        lab_capacities[selected_lab] = new_capacity
-        save_lab_capacities(lab_capacities)
+        # Se parte del archivo actual: otro proceso pudo cambiar otra capacidad
+        with shared_lock('configuracion'):
+            capacities = load_lab_capacities()
+            previous_capacity = capacities[selected_lab]
+            capacities[selected_lab] = new_capacity
+            save_lab_capacities(capacities)
+        record_audit('Capacidad de laboratorio', selected_lab, f"{previous_capacity} -> {new_capacity}")
+        refresh_shared_config()
         st.success(f"Capacidad del laboratorio {selected_lab} actualizada a {new_capacity}.")
+        if new_capacity > previous_capacity:
+            promoted = promote_waitlist_for_lab(selected_lab)
+            if promoted:
+                st.info(f"Se asignaron {len(promoted)} reservas desde la lista de espera.")
         return
 
+def configure_lab_hours():
+    st.write("### Configurar horario de laboratorios")
+    hours_df = pd.DataFrame([
+        {'Laboratorio': lab, 'Apertura': config['apertura'], 'Cierre': config['cierre'], 'Intervalo (min)': config['intervalo']}
+        for lab, config in lab_hours.items()
+    ])
+    st.write("#### Horario actual:")
+    st.dataframe(hours_df.reset_index(drop=True))
+    st.info("Las reservas y bloqueos existentes se ubican por su hora de inicio; si cambias el intervalo, los que no caigan en la nueva grilla dejan de contarse.")
+
+    with st.form(key='update_lab_hours_form'):
+        selected_lab = st.selectbox("Seleccionar laboratorio", laboratories, key='select_lab_hours')
+        config = lab_hours[selected_lab]
+        apertura = st.time_input("Apertura", value=datetime.strptime(config['apertura'], "%H:%M").time(), key='lab_hours_apertura')
+        cierre = st.time_input("Cierre", value=datetime.strptime(config['cierre'], "%H:%M").time(), key='lab_hours_cierre')
+        interval_options = [10, 15, 20, 30, 60]
+        current_interval = int(config['intervalo'])
+        intervalo = st.selectbox(
+            "Duración de cada franja (minutos)",
+            interval_options,
+            index=interval_options.index(current_interval) if current_interval in interval_options else 3,
+            key='lab_hours_intervalo'
+        )
+        submit_hours = st.form_submit_button("Actualizar horario")
+    if submit_hours:
+        apertura_str = apertura.strftime("%H:%M")
+        cierre_str = cierre.strftime("%H:%M")
+        total = to_minutes(cierre_str) - to_minutes(apertura_str)
+        if total <= 0:
+            st.error("La hora de cierre debe ser posterior a la de apertura.")
+            return
+        if total % intervalo:
+            st.error(f"El horario de {apertura_str} a {cierre_str} no se divide en franjas de {intervalo} minutos.")
+            return
+        with shared_lock('configuracion'):
+            config = load_lab_hours()
+            config[selected_lab] = {"apertura": apertura_str, "cierre": cierre_str, "intervalo": intervalo}
+            save_lab_hours(config)
+        refresh_shared_config()
+        st.success(f"Horario de {selected_lab} actualizado: {apertura_str} a {cierre_str}, franjas de {intervalo} minutos.")
+
+def manage_retention():
+    st.write("### Retención y compactación")
+    st.write("Los días del ciclo actual se mantienen en el directorio de trabajo; los anteriores se compactan por mes en la carpeta de archivo y los que superan el plazo de purga se eliminan.")
+    policy = load_retention_policy()
+
+    with st.form(key='retention_policy_form'):
+        term_starts = st.text_input(
+            "Inicio de ciclos (MM-DD, separados por comas)",
+            value=", ".join(policy['term_starts']),
+            key='retention_term_starts'
+        )
+        purge_years = st.number_input(
+            "Purgar datos con más de (años)",
+            min_value=1, max_value=20, value=int(policy['purge_years']),
+            key='retention_purge_years'
+        )
+        submit_policy = st.form_submit_button("Guardar política")
+    if submit_policy:
+        starts = [t.strip() for t in term_starts.split(',') if t.strip()]
+        try:
+            for t in starts:
+                datetime.strptime(f"2000-{t}", "%Y-%m-%d")
+        except ValueError:
+            st.error("Las fechas de inicio de ciclo deben tener el formato MM-DD.")
+            return
+        if not starts:
+            st.error("Debes indicar al menos un inicio de ciclo.")
+            return
+        policy = {"term_starts": starts, "purge_years": int(purge_years)}
+        save_retention_policy(policy)
+        st.success("Política de retención actualizada.")
+
+    state = get_retention_job_state()
+    running = state['thread'] is not None and state['thread'].is_alive()
+    # Mientras la compactación mueve archivos la vista previa no sería estable
+    if not running:
+        preview = run_retention_job(policy, dry_run=True)
+        st.write(f"**Ciclo actual desde:** {preview['activo_desde']} — **Purga antes de:** {preview['purgar_antes_de']}")
+        st.write(f"Días por archivar: {preview['dias_archivados']} — Días por purgar: {preview['dias_purgados']} — Meses archivados por purgar: {preview['meses_purgados']}")
+
+    if running:
+        st.info("La compactación se está ejecutando en segundo plano.")
+    elif st.button("Ejecutar compactación", key='run_retention_job'):
+        start_retention_job()
+        st.info("Compactación iniciada en segundo plano. Vuelve a esta sección para ver el resultado.")
+    if state['error']:
+        st.error(f"La última compactación falló: {state['error']}")
+
+    report = load_retention_report()
+    if report:
+        st.write("#### Última ejecución")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Bytes recuperados", report['bytes_recuperados'])
+        with col2:
+            st.metric("Archivos activos", report['archivos_calientes_despues'],
+                      report['archivos_calientes_despues'] - report['archivos_calientes_antes'])
+        with col3:
+            st.metric("Escaneo (ms)", report['tiempo_escaneo_despues_ms'],
+                      round(report['tiempo_escaneo_despues_ms'] - report['tiempo_escaneo_antes_ms'], 3),
+                      delta_color='inverse')
+        st.json(report)
+
 # ================================================
 # ADMINISTRACIÓN C402
 # ================================================
@@ -754,121 +2852,151 @@ def admin_c402_view():
     elif admin_option == "Confirmar reservas cumplidas":
         confirm_reservations()
 
+attendance_columns = ['Confirmado', 'No_show']
+
+def load_c402_attendance(start_date, end_date):
+    day_files, _ = get_range_files(start_date, end_date)
+    frames = [
+        reservations[reservations['Laboratorio'] == 'C402']
+        for reservations in load_reservation_days(day_files)
+    ]
+    frames = [f for f in frames if not f.empty]
+    # Una fila por reserva: queda confirmada (o no-show) si lo están todas sus franjas
+    columns = ['Fecha', 'Horario', 'Nombre', 'Apellido', 'Correo', 'Tipo', 'Grupo', 'Cantidad_alumnos'] + attendance_columns + ['Reserva_ID']
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    reservations = pd.concat(frames, ignore_index=True)
+    for col in attendance_columns:
+        reservations[col] = reservations.get(col, False)
+        reservations[col] = reservations[col].fillna(False).astype(bool)
+    attendance = group_bookings(reservations, ['Nombre', 'Apellido', 'Correo'])
+    flags = reservations.groupby('Reserva_ID')[attendance_columns].all()
+    for col in attendance_columns:
+        attendance[col] = attendance['Reserva_ID'].map(flags[col]).astype(bool)
+    return attendance[columns]
+
+def save_attendance_changes(changes):
+    # Una lectura y una escritura por día modificado; cada cambio marca todas
+    # las franjas de la reserva
+    for date_str, day_changes in changes.groupby('Fecha'):
+        with day_lock(date_str):
+            reservations = get_reservations_for_day(date_str)
+            for col in attendance_columns:
+                if col not in reservations.columns:
+                    reservations[col] = False
+            for _, change in day_changes.iterrows():
+                condition = (
+                    (reservations['Laboratorio'] == 'C402') &
+                    (reservations['Reserva_ID'] == change['Reserva_ID'])
+                )
+                for col in attendance_columns:
+                    reservations.loc[condition, col] = bool(change[col])
+            save_reservations_for_day(reservations, date_str)
+
 def confirm_reservations():
     st.write("### Confirmar reservas cumplidas")
-    reservation_files = glob.glob('*.xlsx')
-    exclude = [
-        user_data_file, schedule_file,
-        initial_image_file_B501, initial_image_file_C402,
-        group_limits_file, comments_file
-    ]
-    reservation_files = [f for f in reservation_files if f not in exclude]
-    reservations_list = []
-    for file in reservation_files:
-        reservations = pd.read_excel(file, index_col=None)
-        reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-        date_str = file.replace('.xlsx', '')
-        reservations = reservations[reservations['Laboratorio'] == 'C402']
-        if not reservations.empty:
-            reservations['Fecha'] = date_str
-            reservations_list.append(reservations)
-    if reservations_list:
-        all_reservations = pd.concat(reservations_list)
-        all_reservations = all_reservations.sort_values(['Fecha', 'Hora'])
-        st.dataframe(all_reservations.reset_index(drop=True))
-        selected_reservation = st.selectbox(
-            "Seleccionar reserva para confirmar",
-            all_reservations.index,
-            format_func=lambda x: f"{all_reservations.loc[x]['Fecha']} - {all_reservations.loc[x]['Hora']} - {all_reservations.loc[x]['Correo']}"
-        )
-        if st.button("Confirmar que se cumplió la reserva"):
-            reservation_row = all_reservations.loc[selected_reservation]
-            reservation_file = f"{reservation_row['Fecha']}.xlsx"
-            reservations = pd.read_excel(reservation_file, index_col=None)
-            reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-            condition = (
-                (reservations['Correo'] == reservation_row['Correo']) &
-                (reservations['Hora'] == reservation_row['Hora'])
-            )
-            if 'Confirmado' not in reservations.columns:
-                reservations['Confirmado'] = False
-            reservations.loc[condition, 'Confirmado'] = True
-            save_reservations_for_day(reservations, reservation_row['Fecha'])
-            st.success("Reserva confirmada exitosamente.")
-            return
-    else:
+    today = datetime.today().date()
+    date_range = st.date_input(
+        "Rango de fechas",
+        value=(today - timedelta(days=7), today),
+        key='confirm_date_range'
+    )
+    if not isinstance(date_range, (list, tuple)) or len(date_range) != 2:
+        st.info("Selecciona la fecha inicial y final del rango.")
+        return
+    start_date, end_date = date_range
+
+    attendance = load_c402_attendance(start_date, end_date)
+    if attendance.empty:
         st.info("No hay reservas para confirmar.")
+        return
+
+    st.write("Marca 'Confirmado' si el alumno asistió o 'No_show' si no se presentó, y guarda todos los cambios a la vez.")
+    edited = st.data_editor(
+        attendance,
+        column_config={
+            'Confirmado': st.column_config.CheckboxColumn('Confirmado'),
+            'No_show': st.column_config.CheckboxColumn('No_show'),
+        },
+        disabled=[col for col in attendance.columns if col not in attendance_columns],
+        hide_index=True,
+        key='confirm_editor'
+    )
+    changed = (edited[attendance_columns] != attendance[attendance_columns]).any(axis=1)
+    st.write(f"Cambios pendientes: {int(changed.sum())}")
+    if st.button("Guardar cambios", key='confirm_save_button'):
+        changes = edited[changed]
+        if changes.empty:
+            st.info("No hay cambios para guardar.")
+            return
+        conflicts = changes[changes['Confirmado'] & changes['No_show']]
+        if not conflicts.empty:
+            st.error("Una reserva no puede estar confirmada y marcada como no-show a la vez.")
+            st.dataframe(conflicts.reset_index(drop=True))
+            return
+        save_attendance_changes(changes)
+        st.success(f"Se actualizaron {len(changes)} reservas en {changes['Fecha'].nunique()} días.")
 
 # ================================================
 # MIS RESERVAS (Alumno)
 # ================================================
 def view_user_reservations():
     st.write("### Mis reservas")
-    user_data = load_user_data()
     current_user = st.session_state['username']
-    user_reservations = []
-    reservation_files = glob.glob('*.xlsx')
-    exclude = [
-        user_data_file, schedule_file,
-        initial_image_file_B501, initial_image_file_C402,
-        group_limits_file, comments_file
-    ]
-    reservation_files = [f for f in reservation_files if f not in exclude]
-    for file in reservation_files:
-        reservations = pd.read_excel(file, index_col=None)
-        reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-        date_str = file.replace('.xlsx', '')
-        required_columns = [
-            'Nombre', 'Apellido', 'Código', 'Correo',
-            'Laboratorio', 'Hora', 'Propósito', 'Tipo',
-            'Grupo', 'Cantidad_alumnos'
-        ]
-        for col in required_columns:
-            if col not in reservations.columns:
-                if col == 'Cantidad_alumnos':
-                    reservations[col] = 1
-                else:
-                    reservations[col] = ''
-        user_specific = reservations[reservations['Correo'] == current_user]
-        if not user_specific.empty:
-            user_specific['Fecha'] = date_str
-            user_reservations.append(user_specific)
+    bookings = group_bookings(get_user_reservations(current_user))
+    if not bookings.empty:
+        st.dataframe(bookings, hide_index=True)
+        st.download_button(
+            "Descargar en mi calendario (.ics)",
+            data=get_user_calendar(current_user)['ics'],
+            file_name="reservas_laboratorio.ics",
+            mime="text/calendar",
+            key='calendar_download'
+        )
 
-    if user_reservations:
-        all_user_reservations = pd.concat(user_reservations)
-        all_user_reservations = all_user_reservations.sort_values(['Fecha', 'Hora'])
-        display_columns = ['Fecha', 'Laboratorio', 'Hora', 'Propósito', 'Tipo', 'Grupo', 'Cantidad_alumnos']
-        for col in display_columns:
-            if col not in all_user_reservations.columns:
-                all_user_reservations[col] = ''
-        st.dataframe(all_user_reservations[display_columns].reset_index(drop=True))
-
-        all_user_reservations = all_user_reservations.reset_index(drop=True)
-        selected_reservation = st.selectbox(
+        selected_booking = st.selectbox(
             "Seleccionar reserva a eliminar",
-            all_user_reservations.index,
-            format_func=lambda x: f"{all_user_reservations.loc[x]['Fecha']} - {all_user_reservations.loc[x]['Laboratorio']} - {all_user_reservations.loc[x]['Hora']}"
+            bookings.index,
+            format_func=lambda x: booking_label(bookings.loc[x])
         )
         if st.button("Eliminar reserva"):
-            reservation_row = all_user_reservations.loc[selected_reservation]
-            reservation_file = f"{reservation_row['Fecha']}.xlsx"
-            reservations = pd.read_excel(reservation_file, index_col=None)
-            reservations = reservations.loc[:, ~reservations.columns.str.contains('^Unnamed')]
-            condition = (
-                (reservations['Correo'] == reservation_row['Correo']) &
-                (reservations['Laboratorio'] == reservation_row['Laboratorio']) &
-                (reservations['Hora'] == reservation_row['Hora'])
-            )
-            reservations = reservations[~condition]
-            save_reservations_for_day(reservations, reservation_row['Fecha'])
-            st.success("Reserva eliminada exitosamente.")
+            booking = bookings.loc[selected_booking]
+            removed = cancel_booking(current_user, booking['Reserva_ID'])
+            if removed:
+                record_audit('Eliminación de reserva', current_user, f"{booking_label(booking)} ({booking['Reserva_ID']})")
+            st.success(f"Reserva eliminada exitosamente ({removed} franjas liberadas).")
             return
     else:
         st.info("No tienes reservas registradas.")
 
+    waitlist_entries = get_user_waitlist(current_user)
+    if waitlist_entries:
+        st.write("#### Lista de espera")
+        waitlist_df = pd.DataFrame([
+            {
+                'Fecha': e['fecha'], 'Laboratorio': e['laboratorio'],
+                'Horario': f"{e['horas'][0]} - {e['fin']}",
+                'Estado': e['estado'], 'Solicitado': e['creado']
+            }
+            for e in waitlist_entries
+        ])
+        st.dataframe(waitlist_df)
+        waiting = [e for e in waitlist_entries if e['estado'] == 'En espera']
+        if waiting:
+            selected_entry = st.selectbox(
+                "Salir de la lista de espera",
+                [e['id'] for e in waiting],
+                format_func=lambda x: next(f"{e['fecha']} - {e['laboratorio']} - {e['horas'][0]}" for e in waiting if e['id'] == x),
+                key='leave_waitlist_select'
+            )
+            if st.button("Salir de la lista de espera", key='leave_waitlist_button'):
+                leave_waitlist(current_user, selected_entry)
+                st.success("Saliste de la lista de espera.")
+
 # ================================================
 # ZONA DE COMENTARIOS (Alumno)
 # ================================================
+@st.fragment
 def comments_section():
     st.write("### Zona de comentarios")
     with st.form(key='comments_form'):
@@ -880,54 +3008,215 @@ def comments_section():
         if not nombre or not correo or not comentario:
             st.error("Por favor, completa todos los campos.")
         else:
-            if os.path.exists(comments_file):
-                comments = pd.read_excel(comments_file, index_col=None)
-                comments = comments.loc[:, ~comments.columns.str.contains('^Unnamed')]
-            else:
-                comments = pd.DataFrame(columns=['Nombre', 'Correo', 'Comentario', 'Fecha'])
-            new_comment = pd.DataFrame({
-                'Nombre': [nombre],
-                'Correo': [correo],
-                'Comentario': [comentario],
-                'Fecha': [datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
-            })
-            comments = pd.concat([comments, new_comment], ignore_index=True)
-            comments.to_excel(comments_file, index=False)
+            with shared_lock('comentarios'):
+                comments = load_comments()
+                new_comment = pd.DataFrame({
+                    'Nombre': [nombre],
+                    'Correo': [correo],
+                    'Comentario': [comentario],
+                    'Fecha': [datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+                })
+                comments = pd.concat([comments, new_comment], ignore_index=True)
+                write_excel(comments, comments_file)
             st.success("Comentario enviado exitosamente.")
             return
 
     if os.path.exists(comments_file):
         st.write("#### Comentarios recientes:")
-        comments = pd.read_excel(comments_file, index_col=None)
-        comments = comments.loc[:, ~comments.columns.str.contains('^Unnamed')]
-        comments = comments.sort_values('Fecha', ascending=False).head(10)
+        comments = load_comments().sort_values('Fecha', ascending=False).head(10)
         st.dataframe(comments.reset_index(drop=True))
 
 # ================================================
 # RESERVA DE LABORATORIO (Alumno)
 # ================================================
+def reservation_details_inputs(selected_lab, key_suffix):
+    if selected_lab == 'C402':
+        st.write("#### Detalles de la reserva")
+        reservation_type = st.radio("Tipo de reserva", ['Individual', 'Grupal'], key=f'reservation_type_{key_suffix}')
+        if reservation_type == 'Grupal':
+            grupo = st.text_input("Nombre del grupo", key=f'group_name_{key_suffix}')
+            cantidad_alumnos = st.number_input(
+                "Cantidad de alumnos",
+                min_value=2,
+                max_value=lab_capacities['C402'],
+                key=f'group_size_{key_suffix}'
+            )
+        else:
+            grupo = ""
+            cantidad_alumnos = 1
+        propósito = st.text_input("Propósito de la reserva", key=f'reservation_purpose_{key_suffix}')
+    else:
+        propósito = ""
+        reservation_type = ""
+        grupo = ""
+        cantidad_alumnos = 1
+    return propósito, reservation_type, grupo, cantidad_alumnos
+
+def show_waitlist_offer(user_row, selected_lab):
+    offer = st.session_state['waitlist_offer']
+    st.write("### Lista de espera")
+    st.write(f"Puedes unirte a la lista de espera para el {offer['date']} de {offer['start']} a {offer['end']}. Si se libera un cupo, la reserva se asignará automáticamente en orden de llegada.")
+    with st.form(key='waitlist_form'):
+        propósito, reservation_type, grupo, cantidad_alumnos = reservation_details_inputs(selected_lab, 'waitlist')
+        submit_waitlist = st.form_submit_button("Unirme a la lista de espera")
+    if submit_waitlist:
+        error = join_waitlist(
+            user_row, offer['lab'], offer['date'], offer['hours'],
+            propósito, reservation_type, grupo, cantidad_alumnos
+        )
+        if error:
+            st.error(error)
+        else:
+            del st.session_state['waitlist_offer']
+            st.success("Te uniste a la lista de espera. Revisa el estado en 'Mis reservas'.")
+
+# Los pasos 2 y 3 y los comentarios son fragmentos: verificar disponibilidad,
+# confirmar o comentar solo vuelve a ejecutar su propia sección, no el CSS,
+# la recarga del usuario, los lineamientos ni la imagen del laboratorio. Como
+# el script no se vuelve a ejecutar, cada fragmento relee la configuración
+# compartida y el usuario de la sesión.
+@st.fragment
+def availability_panel(selected_lab, selected_day):
+    refresh_shared_config()
+    user_row = get_session_user_row()
+    if user_row is None:
+        return
+    date_str = selected_day.strftime("%Y-%m-%d")
+    st.write("### Paso 2: Seleccionar horario y verificar disponibilidad")
+    with st.form(key='availability_form'):
+        col1, col2 = st.columns(2)
+        with col1:
+            selected_start_time = st.selectbox(
+                "Hora de inicio",
+                get_lab_slots(selected_lab),
+                key='student_start_time_select'
+            )
+        with col2:
+            # Calcular horas de fin disponibles basadas en inicio
+            try:
+                lab_boundaries = get_lab_boundaries(selected_lab)
+                start_index = lab_boundaries.index(selected_start_time) + 1
+                available_end_times = lab_boundaries[start_index:]
+                if not available_end_times:
+                    st.error("No hay horas de fin disponibles después de la hora de inicio seleccionada.")
+                    selected_end_time = None
+                else:
+                    selected_end_time = st.selectbox(
+                        "Hora de fin",
+                        available_end_times,
+                        key='student_end_time_select'
+                    )
+            except ValueError:
+                st.error("Hora de inicio seleccionada no es válida.")
+                selected_end_time = None
+
+        submit_avail = st.form_submit_button("Verificar disponibilidad")
+
+    if submit_avail:
+        if not selected_start_time or not selected_end_time:
+            st.error("Debes seleccionar hora de inicio y hora de fin válidas.")
+        else:
+            # Validar límites de B501
+            error = validate_time_range(selected_lab, selected_start_time, selected_end_time)
+            if error:
+                st.error(error)
+                return
+
+            # Calcular horas deseadas
+            try:
+                desired_hours = get_desired_hours(selected_lab, selected_start_time, selected_end_time)
+            except ValueError:
+                st.error("Error al parsear las horas seleccionadas.")
+                return
+
+            # Verificar bloqueos y cupos del día
+            availability, capacity, error = check_availability(date_str, selected_lab, desired_hours)
+            if error:
+                st.error(error)
+                if availability is not None:
+                    # Franja llena (no bloqueada): se ofrece la lista de espera
+                    st.session_state['waitlist_offer'] = {
+                        'lab': selected_lab, 'date': date_str, 'hours': desired_hours,
+                        'start': selected_start_time, 'end': selected_end_time
+                    }
+                    show_waitlist_offer(user_row, selected_lab)
+                return
+
+            # Guardar en session_state para mostrar disponibilidad abajo
+            st.session_state['show_availability'] = True
+            st.session_state['desired_lab'] = selected_lab
+            st.session_state['desired_date'] = date_str
+            st.session_state['desired_start_time'] = selected_start_time
+            st.session_state['desired_end_time'] = selected_end_time
+            st.session_state['desired_hours'] = desired_hours
+            st.session_state['availability'] = availability
+            st.session_state['available_capacity'] = capacity
+            # Cada verificación emite un token: confirmar varias veces con
+            # el mismo token registra la reserva una sola vez
+            st.session_state['booking_token'] = new_booking_token()
+
+    # ---------- Lista de espera ofrecida en una verificación anterior ----------
+    offer = st.session_state.get('waitlist_offer')
+    if not submit_avail and offer and offer['lab'] == selected_lab and offer['date'] == date_str:
+        show_waitlist_offer(user_row, selected_lab)
+
+    # ---------- Mostrar disponibilidad si ya fue calculada ----------
+    confirm_panel(selected_lab, selected_day)
+
+@st.fragment
+def confirm_panel(selected_lab, selected_day):
+    if not st.session_state.get('show_availability', False):
+        return
+    refresh_shared_config()
+    user_row = get_session_user_row()
+    if user_row is None:
+        return
+    date_str = selected_day.strftime("%Y-%m-%d")
+    # La selección pudo cambiar sin on_change (p. ej. al perder el acceso al
+    # C402 el selector vuelve a B501): lo verificado ya no aplica
+    if (st.session_state.get('desired_lab'), st.session_state.get('desired_date')) != (selected_lab, date_str):
+        clear_availability_state()
+        return
+    st.write("### Disponibilidad por horario:")
+    availability = st.session_state['availability']
+    capacity = st.session_state['available_capacity']
+    for hour in st.session_state['desired_hours']:
+        avail_spots = availability[hour]
+        if avail_spots <= 0:
+            st.markdown(f"**{hour}** - No disponible")
+            st.progress(0)
+        else:
+            st.markdown(f"**{hour}** - {avail_spots} cupos disponibles")
+            st.progress(avail_spots / capacity)
+
+    # ---------- Paso 3: Confirmar reserva ----------
+    st.write("### Paso 3: Confirmar reserva")
+    with st.form(key='confirm_reservation_form'):
+        propósito, reservation_type, grupo, cantidad_alumnos = reservation_details_inputs(selected_lab, 'confirm')
+        submit_confirm = st.form_submit_button("Confirmar reserva")
+
+    if submit_confirm:
+        _, error = book_reservation(
+            user_row, selected_lab, selected_day, st.session_state['desired_hours'],
+            propósito, reservation_type, grupo, cantidad_alumnos,
+            st.session_state.get('booking_token', '')
+        )
+        if error:
+            st.error(error)
+            return
+        st.success(f"Reserva exitosa para el {date_str} de {st.session_state['desired_start_time']} a {st.session_state['desired_end_time']} en {selected_lab}.")
+        # Limpiar estado de disponibilidad
+        clear_availability_state()
+        return
+
 def student_view():
     st.write("## Reserva de laboratorio")
-    user_data = load_user_data()
-    current_user = st.session_state['username']
-    user_row = user_data[user_data['Correo'] == current_user].iloc[0]
+    user_row = get_session_user_row()
 
     # Determinar laboratorios accesibles
-    if user_row['C402_access'] == 1:
-        if pd.notna(user_row['Temp_access_expiry']):
-            expiry_date = pd.to_datetime(user_row['Temp_access_expiry'])
-            if datetime.today() > expiry_date:
-                user_data.loc[user_data['Correo'] == current_user, 'C402_access'] = 0
-                user_data.loc[user_data['Correo'] == current_user, 'Temp_access_expiry'] = pd.NaT
-                save_user_data(user_data)
-                st.warning("Tu acceso temporal al laboratorio C402 ha expirado.")
-                accessible_labs = ["B501"]
-            else:
-                accessible_labs = ["B501", "C402"]
-        else:
-            accessible_labs = ["B501", "C402"]
-    else:
-        accessible_labs = ["B501"]
+    accessible_labs, expired = resolve_accessible_labs(user_row)
+    if expired:
+        st.warning("Tu acceso temporal al laboratorio C402 ha expirado.")
 
     # ---------- Paso 1: Seleccionar laboratorio y fecha ----------
     st.write("### Paso 1: Seleccionar laboratorio y fecha")
@@ -945,196 +3234,14 @@ def student_view():
     )
 
     # Mostrar imagen inicial si existe
-    image_file = f'initial_image_{selected_lab}.png'
+    image_file = initial_image_file(selected_lab)
     if os.path.exists(image_file):
         st.image(image_file, caption=f"Horarios disponibles para {selected_lab}", use_column_width=True)
 
     # ---------- Paso 2: Verificar disponibilidad ----------
     if selected_lab and selected_day:
-        date_str = selected_day.strftime("%Y-%m-%d")
         show_rules(selected_lab)
-
-        st.write("### Paso 2: Seleccionar horario y verificar disponibilidad")
-        with st.form(key='availability_form'):
-            col1, col2 = st.columns(2)
-            with col1:
-                selected_start_time = st.selectbox(
-                    "Hora de inicio",
-                    hours,
-                    key='student_start_time_select'
-                )
-            with col2:
-                # Calcular horas de fin disponibles basadas en inicio
-                try:
-                    start_index = hours.index(selected_start_time) + 1
-                    available_end_times = hours[start_index:]
-                    if not available_end_times:
-                        st.error("No hay horas de fin disponibles después de la hora de inicio seleccionada.")
-                        selected_end_time = None
-                    else:
-                        selected_end_time = st.selectbox(
-                            "Hora de fin",
-                            available_end_times,
-                            key='student_end_time_select'
-                        )
-                except ValueError:
-                    st.error("Hora de inicio seleccionada no es válida.")
-                    selected_end_time = None
-
-            submit_avail = st.form_submit_button("Verificar disponibilidad")
-
-        if submit_avail:
-            if not selected_start_time or not selected_end_time:
-                st.error("Debes seleccionar hora de inicio y hora de fin válidas.")
-            else:
-                # Validar límites de B501
-                if selected_lab == "B501":
-                    max_time = "17:30"
-                    if selected_start_time > max_time or selected_end_time > max_time:
-                        st.error(f"Las reservas en {selected_lab} solo están permitidas hasta las {max_time}.")
-                        return
-
-                # Calcular horas deseadas
-                try:
-                    start_i = hours.index(selected_start_time)
-                    end_i = hours.index(selected_end_time)
-                    desired_hours = hours[start_i:end_i]
-                except ValueError:
-                    st.error("Error al parsear las horas seleccionadas.")
-                    return
-
-                # Cargar datos del día
-                reservations = get_reservations_for_day(date_str)
-                lab_reservations = reservations[reservations['Laboratorio'] == selected_lab]
-                blocked = schedule_data[
-                    (schedule_data['Día'] == date_str) &
-                    (schedule_data['Laboratorio'] == selected_lab)
-                ]
-
-                # Verificar si alguna hora está bloqueada
-                is_blocked = blocked['Hora'].isin(desired_hours).any()
-                if is_blocked:
-                    st.error(f"El horario seleccionado está bloqueado en {selected_lab}.")
-                    return
-
-                # Calcular disponibilidad
-                capacity = lab_capacities[selected_lab]
-                total_res = lab_reservations.groupby('Hora').size().reset_index(name='count')
-                availability = {}
-                for hour in desired_hours:
-                    count = total_res[total_res['Hora'] == hour]['count'].sum()
-                    available_spots = capacity - count if not pd.isna(count) else capacity
-                    availability[hour] = available_spots
-
-                # Chequear si todas las horas tienen cupo
-                if not all(availability[hour] > 0 for hour in desired_hours):
-                    st.error("No hay suficientes cupos en el rango seleccionado.")
-                    return
-
-                # Guardar en session_state para mostrar disponibilidad abajo
-                st.session_state['show_availability'] = True
-                st.session_state['desired_start_time'] = selected_start_time
-                st.session_state['desired_end_time'] = selected_end_time
-                st.session_state['desired_hours'] = desired_hours
-                st.session_state['availability'] = availability
-                st.session_state['available_capacity'] = capacity
-
-        # ---------- Mostrar disponibilidad si ya fue calculada ----------
-        if st.session_state.get('show_availability', False):
-            st.write("### Disponibilidad por horario:")
-            availability = st.session_state['availability']
-            capacity = st.session_state['available_capacity']
-            for hour in st.session_state['desired_hours']:
-                avail_spots = availability[hour]
-                if avail_spots <= 0:
-                    st.markdown(f"**{hour}** - No disponible")
-                    st.progress(0)
-                else:
-                    st.markdown(f"**{hour}** - {avail_spots} cupos disponibles")
-                    st.progress(avail_spots / capacity)
-
-            # ---------- Paso 3: Confirmar reserva ----------
-            st.write("### Paso 3: Confirmar reserva")
-            with st.form(key='confirm_reservation_form'):
-                if selected_lab == 'C402':
-                    st.write("#### Detalles de la reserva")
-                    reservation_type = st.radio("Tipo de reserva", ['Individual', 'Grupal'], key='reservation_type_confirm')
-                    if reservation_type == 'Grupal':
-                        grupo = st.text_input("Nombre del grupo", key='group_name_confirm')
-                        cantidad_alumnos = st.number_input(
-                            "Cantidad de alumnos",
-                            min_value=2,
-                            max_value=lab_capacities['C402'],
-                            key='group_size_confirm'
-                        )
-                    else:
-                        grupo = ""
-                        cantidad_alumnos = 1
-                    propósito = st.text_input("Propósito de la reserva", key='reservation_purpose_confirm')
-                else:
-                    propósito = ""
-                    reservation_type = ""
-                    grupo = ""
-                    cantidad_alumnos = 1
-
-                submit_confirm = st.form_submit_button("Confirmar reserva")
-
-            if submit_confirm:
-                # Prevenir reservas pasadas si la fecha es hoy
-                if selected_day == datetime.today().date():
-                    current_time = datetime.now().strftime("%H:%M")
-                    if st.session_state['desired_start_time'] <= current_time:
-                        st.error("No puedes reservar en horarios pasados.")
-                        return
-
-                # Verificar acceso C402
-                if selected_lab == 'C402' and user_row['C402_access'] == 0:
-                    st.error("No tienes acceso al laboratorio C402.")
-                    return
-
-                # Límite grupal para C402
-                if selected_lab == 'C402' and reservation_type == 'Grupal':
-                    if os.path.exists(group_limits_file):
-                        limits = pd.read_excel(group_limits_file, index_col=None)
-                        limits = limits.loc[:, ~limits.columns.str.contains('^Unnamed')]
-                    else:
-                        limits = pd.DataFrame(columns=['Tipo', 'Límite'])
-                    grp_lim = limits[limits['Tipo'] == 'Grupal']['Límite'].values
-                    if len(grp_lim) > 0 and cantidad_alumnos > grp_lim[0]:
-                        st.error(f"El límite de alumnos por grupo es {grp_lim[0]}.")
-                        return
-
-                # Verificar capacidad global en C402
-                if selected_lab == 'C402':
-                    current_total = sum(reservations['Cantidad_alumnos'])
-                    new_total = current_total + cantidad_alumnos
-                    if new_total > lab_capacities['C402']:
-                        st.error(f"Al agregar esta reserva, total ({new_total}) excede capacidad máxima ({lab_capacities['C402']}).")
-                        return
-
-                # Guardar la reserva
-                reservations_all = get_reservations_for_day(date_str)
-                new_entries = pd.DataFrame({
-                    'Nombre': [user_row['Nombre']] * len(st.session_state['desired_hours']),
-                    'Apellido': [user_row['Apellido']] * len(st.session_state['desired_hours']),
-                    'Código': [user_row['Código']] * len(st.session_state['desired_hours']),
-                    'Correo': [user_row['Correo']] * len(st.session_state['desired_hours']),
-                    'Laboratorio': [selected_lab] * len(st.session_state['desired_hours']),
-                    'Hora': st.session_state['desired_hours'],
-                    'Propósito': [propósito] * len(st.session_state['desired_hours']),
-                    'Tipo': [reservation_type] * len(st.session_state['desired_hours']),
-                    'Grupo': [grupo] * len(st.session_state['desired_hours']),
-                    'Cantidad_alumnos': [cantidad_alumnos] * len(st.session_state['desired_hours'])
-                })
-                if reservations_all.empty:
-                    reservations_all = new_entries
-                else:
-                    reservations_all = pd.concat([reservations_all, new_entries], ignore_index=True)
-                save_reservations_for_day(reservations_all, date_str)
-                st.success(f"Reserva exitosa para el {date_str} de {st.session_state['desired_start_time']} a {st.session_state['desired_end_time']} en {selected_lab}.")
-                # Limpiar estado de disponibilidad
-                clear_availability_state()
-                return
+        availability_panel(selected_lab, selected_day)
 
     # ------------------------------
     # SECCIÓN DE COMENTARIOS
@@ -1142,11 +3249,75 @@ def student_view():
     st.write("---")
     comments_section()
 
+# ================================================
+# PRECARGA EN SEGUNDO PLANO
+# ================================================
+# El primer rerun del proceso lanza un hilo que construye los índices y las
+# cachés más costosas mientras ya se sirve la pantalla de inicio. Nada
+# depende de que termine: cada paso usa las mismas funciones y candados que
+# la carga a demanda, así una solicitud temprana solo espera ese candado o
+# calcula el dato ella misma.
+@st.cache_resource
+def get_warmup_state():
+    return {'lock': threading.Lock(), 'thread': None, 'steps': []}
+
+def warm_search_index():
+    with shared_lock('indice-busqueda'):
+        ensure_search_index()
+
+def warm_dashboard(today):
+    start_date, end_date = dashboard_default_range(today)
+    labs = tuple(laboratories)
+    version = get_range_version(start_date, end_date)
+    build_dashboard_figures(start_date, end_date, labs, version)
+    build_analytics(start_date, end_date, labs, version, *analytics_config_key(labs))
+
+def get_warmup_steps():
+    today = datetime.today().date()
+    return [
+        ('Índice de reservas por usuario', ensure_reservation_index),
+        ('Bloqueos', ensure_block_index),
+        ('Búsqueda de texto', warm_search_index),
+        ('Dashboard y analítica del ciclo', lambda: warm_dashboard(today)),
+    ]
+
+def run_warmup(state, steps):
+    for step, (_, function) in zip(state['steps'], steps):
+        step['estado'] = 'En curso'
+        start = time.perf_counter()
+        try:
+            function()
+            step['estado'] = 'Listo'
+        except Exception as e:
+            # Ese dato se cargará a demanda
+            step['estado'] = 'Error'
+            step['error'] = str(e)
+        step['ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+def start_warmup():
+    state = get_warmup_state()
+    with state['lock']:
+        if state['thread'] is not None:
+            return False
+        steps = get_warmup_steps()
+        state['steps'] = [{'paso': name, 'estado': 'Pendiente', 'ms': None, 'error': ''} for name, _ in steps]
+        state['thread'] = threading.Thread(target=run_warmup, args=(state, steps), name='warmup', daemon=True)
+        state['thread'].start()
+    return True
+
+def warmup_status():
+    state = get_warmup_state()
+    with state['lock']:
+        steps = [dict(step) for step in state['steps']]
+    done = sum(step['estado'] in ('Listo', 'Error') for step in steps)
+    return {'listo': bool(steps) and done == len(steps), 'completados': done, 'total': len(steps), 'pasos': steps}
+
 # ================================================
 # VISTA PRINCIPAL (DESPUÉS DE LOGIN)
 # ================================================
 def main_app():
-    load_schedule_data()
+    seed_default_rules()
+    start_warmup()
 
     # CSS global (sin fondo completo)
     css = """
@@ -1200,29 +3371,12 @@ def main_app():
         auth_page()
         return
 
-    # Ya está logueado, obtenemos user_row
-    user_data = load_user_data()
-    current_user = st.session_state['username']
-    if current_user == 'admin@up.edu.pe':
-        user_row = pd.Series({
-            'Nombre': 'Admin',
-            'Apellido': 'User',
-            'Correo': 'admin@up.edu.pe',
-            'Rol': 'admin',
-            'C402_access': 0,
-            'Temp_access_expiry': pd.NaT
-        })
-    elif current_user.endswith('@c402.up.edu.pe'):
-        user_row = pd.Series({
-            'Nombre': 'C402',
-            'Apellido': 'Admin',
-            'Correo': current_user,
-            'Rol': 'c402_admin',
-            'C402_access': 1,
-            'Temp_access_expiry': pd.NaT
-        })
-    else:
-        user_row = user_data[user_data['Correo'] == current_user].iloc[0]
+    # Ya está logueado, obtenemos user_row desde el perfil en sesión
+    user_row = get_session_user_row()
+    if user_row is None:
+        st.session_state['logged_in'] = False
+        st.error("Tu cuenta ya no existe. Vuelve a iniciar sesión.")
+        return
 
     # Menú lateral según rol
     st.sidebar.write(f"**Usuario:** {user_row['Nombre']} {user_row['Apellido']}")
@@ -0,0 +1,151 @@
+# audit.py
+# Registro de auditoría de solo agregado para las acciones administrativas.
+# Cada evento se codifica en binario en audit.log (cabecera fija de 15 bytes
+# más los textos en UTF-8) y su posición se agrega a audit.idx como una
+# entrada fija (timestamp en ms, offset). Como los timestamps del índice no
+# decrecen, un rango de fechas se ubica con búsqueda binaria y una página se
+# lee con un seek por evento, sin recorrer el registro. Sin Streamlit.
+import os
+import struct
+
+import numpy as np
+
+# Las acciones se guardan por posición: solo se agregan al final
+actions = [
+    'Bloqueo de horario',
+    'Eliminación de bloqueos',
+    'Acceso al C402',
+    'Eliminación de reserva',
+    'Capacidad de laboratorio',
+    'Límite de grupo',
+    'Cuenta creada',
+]
+action_codes = {name: code for code, name in enumerate(actions)}
+
+# timestamp (ms), acción, largo de usuario, objetivo y detalle
+record_header = struct.Struct('<qBHHH')
+index_entry = struct.Struct('<qQ')
+index_dtype = np.dtype([('ts', '<i8'), ('offset', '<u8')])
+max_text_bytes = 0xFFFF
+
+
+def encode_text(value):
+    # Se corta en un límite de carácter si excede lo que cabe en la cabecera
+    data = str(value).encode('utf-8')
+    if len(data) > max_text_bytes:
+        data = data[:max_text_bytes].decode('utf-8', errors='ignore').encode('utf-8')
+    return data
+
+
+def encode_record(ts_ms, action, actor, target, detail):
+    texts = [encode_text(actor), encode_text(target), encode_text(detail)]
+    return record_header.pack(ts_ms, action_codes[action], *(len(t) for t in texts)) + b''.join(texts)
+
+
+def decode_record(data):
+    # Devuelve (evento, bytes usados) o (None, 0) si el registro está incompleto
+    if len(data) < record_header.size:
+        return None, 0
+    ts_ms, code, *lengths = record_header.unpack_from(data)
+    size = record_header.size + sum(lengths)
+    if len(data) < size:
+        return None, 0
+    texts = []
+    position = record_header.size
+    for length in lengths:
+        texts.append(data[position:position + length].decode('utf-8'))
+        position += length
+    action = actions[code] if code < len(actions) else f"Acción {code}"
+    return {'ts': ts_ms, 'accion': action, 'usuario': texts[0], 'objetivo': texts[1], 'detalle': texts[2]}, size
+
+
+def read_record(log, offset):
+    log.seek(offset)
+    header = log.read(record_header.size)
+    if len(header) < record_header.size:
+        return None, 0
+    rest = sum(record_header.unpack(header)[2:])
+    return decode_record(header + log.read(rest))
+
+
+def index_count(index_path):
+    if not os.path.exists(index_path):
+        return 0
+    return os.path.getsize(index_path) // index_entry.size
+
+
+def sync_index(log_path, index_path):
+    # Tras una caída entre las dos escrituras: indexa los eventos completos que
+    # falten y descarta un evento o una entrada a medio escribir. Devuelve el
+    # último timestamp indexado.
+    count = index_count(index_path)
+    if os.path.exists(index_path) and os.path.getsize(index_path) != count * index_entry.size:
+        with open(index_path, 'r+b') as f:
+            f.truncate(count * index_entry.size)
+    if not os.path.exists(log_path):
+        return 0
+    last_ts, end = 0, 0
+    with open(log_path, 'rb') as log:
+        if count:
+            with open(index_path, 'rb') as f:
+                f.seek((count - 1) * index_entry.size)
+                last_ts, offset = index_entry.unpack(f.read(index_entry.size))
+            _, size = read_record(log, offset)
+            end = offset + size
+        log_size = os.path.getsize(log_path)
+        missing = []
+        while end < log_size:
+            event, size = read_record(log, end)
+            if event is None:
+                break
+            missing.append(index_entry.pack(event['ts'], end))
+            last_ts = max(last_ts, event['ts'])
+            end += size
+    if missing:
+        with open(index_path, 'ab') as f:
+            f.write(b''.join(missing))
+    if end < log_size:
+        with open(log_path, 'r+b') as log:
+            log.truncate(end)
+    return last_ts
+
+
+def append_event(log_path, index_path, ts_ms, action, actor, target, detail=''):
+    # Debe llamarse con un candado tomado (un solo escritor a la vez)
+    last_ts = sync_index(log_path, index_path)
+    # El índice se mantiene ordenado aunque el reloj retroceda
+    ts_ms = max(int(ts_ms), last_ts)
+    record = encode_record(ts_ms, action, actor, target, detail)
+    with open(log_path, 'ab') as log:
+        offset = log.tell()
+        log.write(record)
+        log.flush()
+        os.fsync(log.fileno())
+    with open(index_path, 'ab') as f:
+        f.write(index_entry.pack(ts_ms, offset))
+        f.flush()
+        os.fsync(f.fileno())
+    return ts_ms
+
+
+def read_events(log_path, index_path, start_ms=None, end_ms=None, page=0, page_size=50):
+    # Eventos de [start_ms, end_ms] del más reciente al más antiguo; devuelve
+    # (eventos de la página, total en el rango)
+    count = index_count(index_path)
+    if not count:
+        return [], 0
+    index = np.memmap(index_path, dtype=index_dtype, mode='r', shape=(count,))
+    lo = 0 if start_ms is None else int(np.searchsorted(index['ts'], start_ms, side='left'))
+    hi = count if end_ms is None else int(np.searchsorted(index['ts'], end_ms, side='right'))
+    total = max(hi - lo, 0)
+    first = hi - 1 - page * page_size
+    positions = range(first, max(first - page_size, lo - 1), -1)
+    offsets = [int(index['offset'][i]) for i in positions]
+    del index
+    events = []
+    with open(log_path, 'rb') as log:
+        for offset in offsets:
+            event, _ = read_record(log, offset)
+            if event is not None:
+                events.append(event)
+    return events, total
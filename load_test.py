@@ -0,0 +1,379 @@
+# load_test.py
+# Prueba de carga con sesiones concurrentes de Streamlit AppTest:
+# cada sesión inicia sesión, consulta disponibilidad en student_view y
+# confirma una reserva sobre las mismas franjas que las demás.
+#
+#   python load_test.py --sessions 40 --concurrency 20 --lab B501 --start 09:00 --end 10:00
+#   python load_test.py --check-shared-state
+#
+# Se ejecuta en un directorio temporal (o en --workdir) para no tocar los
+# datos reales. Al final reporta rendimiento, percentiles de latencia por paso
+# y cualquier franja con más reservas que lab_capacities.
+#
+# AppTest no admite varias sesiones en hilos del mismo proceso, por eso cada
+# sesión concurrente corre en su propio proceso; todos comparten el
+# directorio de datos a través de LABSYNC_DATA_DIR.
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'appv3.py')
+steps = ['login', 'navegacion', 'disponibilidad', 'confirmacion']
+
+
+def create_students(n_sessions, c402_access):
+    users = pd.DataFrame({
+        'Nombre': [f"Alumno{i}" for i in range(n_sessions)],
+        'Apellido': ['Carga'] * n_sessions,
+        'Correo': [f"carga{i}@alum.up.edu.pe" for i in range(n_sessions)],
+        'Rol': ['alumno'] * n_sessions,
+        'Código': [f"{20240000 + i}" for i in range(n_sessions)],
+        'Contraseña': ['carga123'] * n_sessions,
+        'C402_access': [1 if c402_access else 0] * n_sessions,
+        'Temp_access_expiry': [pd.NaT] * n_sessions,
+    })
+    users.to_excel('user_data.xlsx', index=False)
+    return users
+
+
+def click(at, label):
+    next(b for b in at.button if b.label == label).click()
+    at.run()
+
+
+def login(correo, password, timeout):
+    at = AppTest.from_file(app_path, default_timeout=timeout)
+    at.run()
+    at.text_input(key='login_correo').input(correo)
+    at.text_input(key='login_password').input(password)
+    click(at, 'Entrar')
+    at.run()
+    return at
+
+
+def open_student_view(at, lab, day):
+    at.sidebar.selectbox[0].select('Reservar laboratorio')
+    at.run()
+    at.selectbox(key='student_lab_select').select(lab)
+    at.run()
+    at.date_input(key='student_date_select').set_value(day)
+    at.run()
+
+
+def verify_availability(at, start, end):
+    # La hora de fin se mueve primero al cierre (válido para cualquier inicio)
+    # para que el valor anterior no quede fuera de las nuevas opciones
+    end_select = at.selectbox(key='student_end_time_select')
+    end_select.select(end_select.options[-1])
+    at.selectbox(key='student_start_time_select').select(start)
+    at.run()
+    at.selectbox(key='student_end_time_select').select(end)
+    click(at, 'Verificar disponibilidad')
+    return [e.value for e in at.error]
+
+
+def use_workdir(workdir):
+    # Cada proceso apunta appv3 al mismo directorio de datos
+    os.chdir(workdir)
+    os.environ['LABSYNC_DATA_DIR'] = workdir
+
+
+def run_session(correo, args, day, barrier, workdir):
+    use_workdir(workdir)
+    timings = {}
+
+    start = time.perf_counter()
+    at = login(correo, 'carga123', args.timeout)
+    timings['login'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    open_student_view(at, args.lab, day)
+    timings['navegacion'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    errors = verify_availability(at, args.start, args.end)
+    timings['disponibilidad'] = time.perf_counter() - start
+    if errors:
+        return {'correo': correo, 'resultado': 'sin_cupo', 'mensaje': errors[0], 'tiempos': timings}
+
+    # Todas las sesiones confirman a la vez para forzar la contención
+    if barrier is not None:
+        try:
+            barrier.wait(timeout=args.timeout)
+        except threading.BrokenBarrierError:
+            pass
+    start = time.perf_counter()
+    click(at, 'Confirmar reserva')
+    timings['confirmacion'] = time.perf_counter() - start
+    errors = [e.value for e in at.error] + [str(e.value) for e in at.exception]
+    if errors:
+        return {'correo': correo, 'resultado': 'rechazada', 'mensaje': errors[0], 'tiempos': timings}
+    return {'correo': correo, 'resultado': 'reservada', 'mensaje': '', 'tiempos': timings}
+
+
+# --------------------------------
+# VERIFICACIÓN DE ESTADO COMPARTIDO ENTRE PROCESOS
+# --------------------------------
+# Un proceso de alumno deja sus cachés calientes, otro proceso de admin
+# reduce la capacidad a 1 y bloquea una franja, y el primero debe aplicar
+# ambos cambios sin reiniciarse.
+def shifted(hhmm, minutes):
+    return (datetime.strptime(hhmm, "%H:%M") + timedelta(minutes=minutes)).strftime("%H:%M")
+
+
+def run_admin_changes(args, day, workdir, warmed, changed, results):
+    use_workdir(workdir)
+    try:
+        warmed.wait(timeout=args.timeout)
+        at = login('admin@up.edu.pe', 'admin123', args.timeout)
+        at.sidebar.selectbox[0].select('Administración')
+        at.run()
+        at.selectbox(key='admin_option').select('Configurar capacidades de laboratorios')
+        at.run()
+        at.selectbox(key='select_lab_capacity').select(args.lab)
+        at.number_input(key='new_capacity').set_value(1)
+        click(at, 'Actualizar capacidad')
+        at.selectbox(key='admin_option').select('Bloquear horario')
+        at.run()
+        at.selectbox(key='admin_lab_block').select(args.lab)
+        at.run()
+        at.date_input(key='admin_date_block').set_value(day)
+        at.selectbox(key='admin_start_time_block').select(args.end)
+        at.selectbox(key='admin_end_time_block').select(shifted(args.end, 60))
+        click(at, 'Bloquear horario')
+        errors = [e.value for e in at.error] + [str(e.value) for e in at.exception]
+        results.put({'proceso': 'admin', 'errores': errors})
+    except Exception as e:
+        results.put({'proceso': 'admin', 'errores': [str(e)]})
+    finally:
+        changed.set()
+
+
+def run_student_checks(args, day, workdir, warmed, changed, results):
+    checks = {}
+    try:
+        student_checks(args, day, workdir, warmed, changed, checks)
+        results.put({'proceso': 'alumno', 'verificaciones': checks})
+    except Exception as e:
+        results.put({'proceso': 'alumno', 'verificaciones': checks, 'error': str(e)})
+    finally:
+        warmed.set()
+
+
+def student_checks(args, day, workdir, warmed, changed, checks):
+    use_workdir(workdir)
+    try:
+        # Primer alumno ocupa la franja principal con la capacidad original
+        first = login('carga0@alum.up.edu.pe', 'carga123', args.timeout)
+        open_student_view(first, args.lab, day)
+        errors = verify_availability(first, args.start, args.end)
+        if not errors:
+            click(first, 'Confirmar reserva')
+            errors = [e.value for e in first.error]
+        checks['reserva_inicial'] = not errors
+
+        # Segundo alumno: cachés calientes antes del cambio
+        second = login('carga1@alum.up.edu.pe', 'carga123', args.timeout)
+        open_student_view(second, args.lab, day)
+        checks['franja_libre_antes'] = not verify_availability(second, args.end, shifted(args.end, 60))
+    finally:
+        warmed.set()
+    changed.wait(timeout=args.timeout * 4)
+
+    errors = verify_availability(second, args.end, shifted(args.end, 60))
+    checks['bloqueo_aplicado'] = any('bloqueado' in e for e in errors)
+    errors = verify_availability(second, args.start, args.end)
+    checks['capacidad_aplicada'] = any('cupos' in e for e in errors)
+
+
+def check_shared_state(args, context, workdir, day):
+    warmed, changed, results = context.Event(), context.Event(), context.Queue()
+    module = importlib.import_module('load_test')
+    processes = [
+        context.Process(target=module.run_student_checks, args=(args, day, workdir, warmed, changed, results)),
+        context.Process(target=module.run_admin_changes, args=(args, day, workdir, warmed, changed, results)),
+    ]
+    for process in processes:
+        process.start()
+    outputs = {}
+    for _ in processes:
+        output = results.get(timeout=args.timeout * 6)
+        outputs[output['proceso']] = output
+    for process in processes:
+        process.join()
+    checks = outputs.get('alumno', {}).get('verificaciones', {})
+    return {
+        'directorio': workdir,
+        'laboratorio': args.lab,
+        'fecha': day.strftime('%Y-%m-%d'),
+        'verificaciones': checks,
+        'errores_admin': outputs.get('admin', {}).get('errores', []),
+        'error_alumno': outputs.get('alumno', {}).get('error', ''),
+        'ok': bool(checks) and all(checks.values()) and 'error' not in outputs.get('alumno', {}),
+    }
+
+
+def check_overbooking(day, lab):
+    capacities_file = 'lab_capacities.json'
+    with open(capacities_file, 'r') as f:
+        capacities = json.load(f)
+    day_file = f"{day.strftime('%Y-%m-%d')}.xlsx"
+    if not os.path.exists(day_file):
+        return []
+    try:
+        reservations = pd.read_excel(day_file, index_col=None)
+    except Exception as e:
+        # Escrituras simultáneas desde varios procesos pueden dejar el libro ilegible
+        return [{'hora': '*', 'reservas': None, 'capacidad': capacities[lab], 'error': f"Archivo del día ilegible: {e}"}]
+    lab_reservations = reservations[reservations['Laboratorio'] == lab]
+    counts = lab_reservations.groupby('Hora').size()
+    over = counts[counts > capacities[lab]]
+    return [
+        {'hora': str(hour), 'reservas': int(count), 'capacidad': capacities[lab]}
+        for hour, count in over.items()
+    ]
+
+
+def count_persisted(day, lab, correos):
+    day_file = f"{day.strftime('%Y-%m-%d')}.xlsx"
+    try:
+        reservations = pd.read_excel(day_file, index_col=None)
+    except Exception:
+        return 0
+    booked = reservations[(reservations['Laboratorio'] == lab) & reservations['Correo'].isin(correos)]
+    return int(booked['Correo'].nunique())
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    series = pd.Series(values) * 1000
+    return {
+        'p50_ms': round(float(series.quantile(0.50)), 1),
+        'p95_ms': round(float(series.quantile(0.95)), 1),
+        'p99_ms': round(float(series.quantile(0.99)), 1),
+        'max_ms': round(float(series.max()), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de Lab Sync con AppTest")
+    parser.add_argument('--sessions', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--lab', default='B501', choices=['B501', 'C402'])
+    parser.add_argument('--start', default='09:00')
+    parser.add_argument('--end', default='10:00')
+    parser.add_argument('--days-ahead', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--no-sync', action='store_true', help="No sincronizar las confirmaciones")
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--json', action='store_true', help="Imprimir el reporte como JSON")
+    parser.add_argument('--check-shared-state', action='store_true',
+                        help="Verificar que un cambio de capacidad o bloqueo en un proceso se aplica en otro")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='labsync-load-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    users = create_students(2 if args.check_shared_state else args.sessions, c402_access=args.lab == 'C402')
+    day = datetime.today().date() + timedelta(days=args.days_ahead)
+    context = multiprocessing.get_context('spawn')
+
+    if args.check_shared_state:
+        report = check_shared_state(args, context, workdir, day)
+        if args.json:
+            print(json.dumps(report, indent=2, ensure_ascii=False))
+        else:
+            print(f"Directorio de trabajo: {report['directorio']}")
+            for name, passed in report['verificaciones'].items():
+                print(f"  {name:<22} {'OK' if passed else 'FALLA'}")
+            for message in report['errores_admin']:
+                print(f"Fallo admin: {message}")
+            if report['error_alumno']:
+                print(f"Fallo alumno: {report['error_alumno']}")
+            print("Estado compartido: OK" if report['ok'] else "Estado compartido: FALLA")
+        sys.exit(0 if report['ok'] else 1)
+
+    manager = context.Manager()
+    barrier = None if args.no_sync else manager.Barrier(min(args.sessions, args.concurrency))
+
+    # AppTest reemplaza __main__ mientras ejecuta appv3; se envía la función
+    # desde el módulo importado para que los procesos reutilizados la encuentren.
+    session_worker = importlib.import_module('load_test').run_session
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.concurrency, mp_context=context) as pool:
+        futures = [
+            pool.submit(session_worker, correo, args, day, barrier, workdir)
+            for correo in users['Correo']
+        ]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'correo': '', 'resultado': 'fallo', 'mensaje': str(e), 'tiempos': {}})
+    elapsed = time.perf_counter() - start
+    manager.shutdown()
+
+    outcomes = pd.Series([r['resultado'] for r in results]).value_counts().to_dict()
+    confirmed = [r['correo'] for r in results if r['resultado'] == 'reservada']
+    persisted = count_persisted(day, args.lab, confirmed)
+    report = {
+        'directorio': workdir,
+        'sesiones': args.sessions,
+        'concurrencia': args.concurrency,
+        'laboratorio': args.lab,
+        'fecha': day.strftime('%Y-%m-%d'),
+        'franja': f"{args.start}-{args.end}",
+        'duracion_s': round(elapsed, 2),
+        'sesiones_por_segundo': round(len(results) / elapsed, 2),
+        'resultados': outcomes,
+        'latencias': {
+            step: percentiles([r['tiempos'][step] for r in results if step in r['tiempos']])
+            for step in steps
+        },
+        'sobrerreservas': check_overbooking(day, args.lab),
+        # Confirmaciones exitosas cuya reserva no quedó en el archivo del día
+        'reservas_perdidas': len(confirmed) - persisted,
+        'errores': sorted({r['mensaje'] for r in results if r['resultado'] == 'fallo'}),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+    print(f"Directorio de trabajo: {report['directorio']}")
+    print(f"{args.sessions} sesiones, concurrencia {args.concurrency}, {args.lab} {report['fecha']} {report['franja']}")
+    print(f"Duración: {report['duracion_s']} s — {report['sesiones_por_segundo']} sesiones/s")
+    print(f"Resultados: {outcomes}")
+    for step, stats in report['latencias'].items():
+        if stats:
+            print(f"  {step:<15} p50 {stats['p50_ms']:>8} ms  p95 {stats['p95_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  max {stats['max_ms']:>8} ms")
+    if report['sobrerreservas']:
+        print("SOBRERRESERVA detectada:")
+        for row in report['sobrerreservas']:
+            if 'error' in row:
+                print(f"  {row['error']}")
+            else:
+                print(f"  {row['hora']}: {row['reservas']} reservas para capacidad {row['capacidad']}")
+    else:
+        print("Sin sobrerreservas.")
+    if report['reservas_perdidas']:
+        print(f"RESERVAS PERDIDAS: {report['reservas_perdidas']} confirmaciones no quedaron guardadas.")
+    for message in report['errores']:
+        print(f"Fallo: {message}")
+
+
+if __name__ == "__main__":
+    main()
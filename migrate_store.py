@@ -0,0 +1,351 @@
+# migrate_store.py
+# Migra un despliegue existente (Excel por día, meses archivados, usuarios,
+# bloqueos, límites de grupo y comentarios) a una base SQLite:
+#
+#   python migrate_store.py                          -> migra LABSYNC_DATA_DIR (o .) a labsync.db
+#   python migrate_store.py --data-dir /srv/labsync --workers 8
+#   python migrate_store.py --verify-only            -> solo vuelve a verificar lo migrado
+#   python migrate_store.py --restart                -> descarta el progreso y migra todo de nuevo
+#
+# Los archivos se leen en un pool de procesos con los mismos cargadores de
+# appv3 (columnas faltantes, tipos y duplicados se normalizan igual que en la
+# app) y un solo proceso escribe en la base. Cada archivo se carga en su
+# propia transacción junto con su registro en la tabla 'migracion' (mtime,
+# tamaño, filas y checksum), así una ejecución interrumpida retoma desde el
+# último archivo completo y un archivo modificado después se vuelve a migrar.
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+
+# Tabla -> columnas (en el orden en que se insertan y se calcula el checksum)
+tables = {
+    'reservas': [
+        'fecha', 'laboratorio', 'hora', 'correo', 'nombre', 'apellido', 'codigo',
+        'proposito', 'tipo', 'grupo', 'cantidad_alumnos', 'confirmado', 'no_show', 'token', 'reserva_id'
+    ],
+    'usuarios': [
+        'correo', 'nombre', 'apellido', 'rol', 'codigo', 'contrasena', 'c402_access', 'temp_access_expiry'
+    ],
+    'bloqueos': [
+        'id', 'laboratorio', 'repeticion', 'dia', 'dia_semana', 'hasta', 'inicio', 'fin', 'motivo'
+    ],
+    'limites_grupo': ['tipo', 'limite'],
+    'comentarios': ['nombre', 'correo', 'comentario', 'fecha'],
+}
+
+# Columna de la tabla -> columna del DataFrame de appv3
+source_columns = {
+    'reservas': {
+        'fecha': 'Fecha', 'laboratorio': 'Laboratorio', 'hora': 'Hora', 'correo': 'Correo',
+        'nombre': 'Nombre', 'apellido': 'Apellido', 'codigo': 'Código', 'proposito': 'Propósito',
+        'tipo': 'Tipo', 'grupo': 'Grupo', 'cantidad_alumnos': 'Cantidad_alumnos',
+        'confirmado': 'Confirmado', 'no_show': 'No_show', 'token': 'Token', 'reserva_id': 'Reserva_ID',
+    },
+    'usuarios': {
+        'correo': 'Correo', 'nombre': 'Nombre', 'apellido': 'Apellido', 'rol': 'Rol', 'codigo': 'Código',
+        'contrasena': 'Contraseña', 'c402_access': 'C402_access', 'temp_access_expiry': 'Temp_access_expiry',
+    },
+    'bloqueos': {
+        'id': 'ID', 'laboratorio': 'Laboratorio', 'repeticion': 'Repetición', 'dia': 'Día',
+        'dia_semana': 'Día_semana', 'hasta': 'Hasta', 'inicio': 'Inicio', 'fin': 'Fin', 'motivo': 'Motivo',
+    },
+    'limites_grupo': {'tipo': 'Tipo', 'limite': 'Límite'},
+    'comentarios': {'nombre': 'Nombre', 'correo': 'Correo', 'comentario': 'Comentario', 'fecha': 'Fecha'},
+}
+
+schema_sql = """
+CREATE TABLE IF NOT EXISTS reservas (
+    fuente TEXT NOT NULL,
+    fecha TEXT NOT NULL,
+    laboratorio TEXT NOT NULL,
+    hora TEXT NOT NULL,
+    correo TEXT NOT NULL,
+    nombre TEXT, apellido TEXT, codigo TEXT, proposito TEXT, tipo TEXT, grupo TEXT,
+    cantidad_alumnos INTEGER NOT NULL DEFAULT 1,
+    confirmado INTEGER NOT NULL DEFAULT 0,
+    no_show INTEGER NOT NULL DEFAULT 0,
+    token TEXT NOT NULL DEFAULT '',
+    reserva_id TEXT NOT NULL DEFAULT '',
+    UNIQUE (fecha, laboratorio, hora, correo)
+);
+CREATE INDEX IF NOT EXISTS reservas_reserva_id ON reservas (reserva_id);
+CREATE INDEX IF NOT EXISTS reservas_fuente ON reservas (fuente);
+CREATE INDEX IF NOT EXISTS reservas_correo ON reservas (correo, fecha);
+CREATE TABLE IF NOT EXISTS usuarios (
+    fuente TEXT NOT NULL,
+    correo TEXT PRIMARY KEY,
+    nombre TEXT, apellido TEXT, rol TEXT, codigo TEXT, contrasena TEXT,
+    c402_access INTEGER NOT NULL DEFAULT 0,
+    temp_access_expiry TEXT
+);
+CREATE TABLE IF NOT EXISTS bloqueos (
+    fuente TEXT NOT NULL,
+    id INTEGER PRIMARY KEY,
+    laboratorio TEXT, repeticion TEXT, dia TEXT, dia_semana TEXT, hasta TEXT, inicio TEXT, fin TEXT, motivo TEXT
+);
+CREATE TABLE IF NOT EXISTS limites_grupo (
+    fuente TEXT NOT NULL,
+    tipo TEXT PRIMARY KEY,
+    limite INTEGER
+);
+CREATE TABLE IF NOT EXISTS comentarios (
+    fuente TEXT NOT NULL,
+    nombre TEXT, correo TEXT, comentario TEXT, fecha TEXT
+);
+CREATE TABLE IF NOT EXISTS migracion (
+    fuente TEXT PRIMARY KEY,
+    tabla TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    tamano INTEGER NOT NULL,
+    filas INTEGER NOT NULL,
+    filas_origen INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    migrado TEXT NOT NULL
+);
+"""
+
+appv3 = None
+
+
+def load_appv3(data_dir):
+    # appv3 resuelve sus rutas con LABSYNC_DATA_DIR al importarse
+    global appv3
+    if appv3 is None:
+        os.environ['LABSYNC_DATA_DIR'] = data_dir
+        import appv3 as module
+        appv3 = module
+    return appv3
+
+
+def list_sources(data_dir):
+    # (fuente relativa al directorio de datos, tabla)
+    app = load_appv3(data_dir)
+    sources = [(os.path.relpath(f, data_dir), 'reservas') for f in app.get_reservation_files()]
+    sources += [(os.path.relpath(f, data_dir), 'reservas') for f in app.get_archive_files()]
+    for path, table in [
+        (app.user_data_file, 'usuarios'),
+        (app.schedule_file, 'bloqueos'),
+        (app.group_limits_file, 'limites_grupo'),
+        (app.comments_file, 'comentarios'),
+    ]:
+        if os.path.exists(path):
+            sources.append((os.path.relpath(path, data_dir), table))
+    return sources
+
+
+def to_native(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d')
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def frame_rows(frame, table):
+    columns = source_columns[table]
+    data = frame.reindex(columns=list(columns.values()))
+    values = [[to_native(v) for v in data[col].astype(object).tolist()] for col in columns.values()]
+    return [list(row) for row in zip(*values)]
+
+
+def rows_checksum(rows):
+    # Independiente del orden de las filas
+    digest = hashlib.sha256()
+    for line in sorted(json.dumps(row, ensure_ascii=False, default=str) for row in rows):
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def parse_source(data_dir, source, table):
+    # Corre en el pool: lee y normaliza un archivo con los cargadores de appv3
+    app = load_appv3(data_dir)
+    path = os.path.join(data_dir, source)
+    stat = os.stat(path)
+    if table == 'reservas':
+        # Todas las columnas del esquema, con sus valores por defecto si faltan
+        frame = app.read_typed_excel(path, app.reservation_schema, list(app.reservation_schema))
+        if app.reservation_file_pattern.match(os.path.basename(source)):
+            frame['Fecha'] = app.file_date(path)
+        else:
+            frame['Fecha'] = frame['Fecha'].str[:10]
+        # Las filas anteriores a los IDs de reserva reciben el mismo ID que en la app
+        frame = app.fill_booking_ids(frame)
+        source_rows = len(frame)
+        frame = frame[frame['Laboratorio'].notna() & frame['Hora'].notna()]
+        valid_rows = len(frame)
+        # Misma restricción de unicidad que save_reservations_for_day
+        frame = frame[~frame.duplicated(['Fecha'] + app.reservation_key, keep='first')]
+    elif table == 'usuarios':
+        frame = app.read_typed_excel(path, app.user_schema, app.user_columns)
+        source_rows = len(frame)
+        frame = frame[frame['Correo'] != '']
+        valid_rows = len(frame)
+        frame = frame.drop_duplicates('Correo', keep='last')
+    elif table == 'bloqueos':
+        frame = app.load_blocks()
+        source_rows = valid_rows = len(frame)
+    elif table == 'limites_grupo':
+        frame = app.load_group_limits()
+        source_rows = valid_rows = len(frame)
+        frame = frame.drop_duplicates('Tipo', keep='last')
+    else:
+        frame = app.load_comments()
+        source_rows = valid_rows = len(frame)
+    rows = frame_rows(frame, table)
+    # Las filas descartadas se cuentan por separado: sin laboratorio, hora o
+    # correo (inválidas) y repetidas por la clave de unicidad (duplicadas)
+    return {
+        'fuente': source, 'tabla': table, 'mtime_ns': stat.st_mtime_ns, 'tamano': stat.st_size,
+        'filas': rows, 'filas_origen': source_rows, 'checksum': rows_checksum(rows),
+        'invalidas': source_rows - valid_rows, 'duplicados': valid_rows - len(rows),
+    }
+
+
+def open_store(db_path):
+    connection = sqlite3.connect(db_path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(schema_sql)
+    return connection
+
+
+def stored_rows(connection, source, table):
+    columns = ', '.join(tables[table])
+    return [list(row) for row in connection.execute(f"SELECT {columns} FROM {table} WHERE fuente = ?", (source,))]
+
+
+def load_source(connection, parsed):
+    # Una transacción por archivo: sus filas y su registro de progreso
+    table, source = parsed['tabla'], parsed['fuente']
+    columns = tables[table]
+    with connection:
+        connection.execute(f"DELETE FROM {table} WHERE fuente = ?", (source,))
+        connection.executemany(
+            f"INSERT INTO {table} (fuente, {', '.join(columns)}) VALUES (?, {', '.join('?' * len(columns))})",
+            [[source] + row for row in parsed['filas']]
+        )
+        loaded = stored_rows(connection, source, table)
+        if len(loaded) != len(parsed['filas']) or rows_checksum(loaded) != parsed['checksum']:
+            raise ValueError(f"{source}: la verificación falló después de cargar (filas o checksum distintos)")
+        connection.execute(
+            "INSERT OR REPLACE INTO migracion VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (source, table, parsed['mtime_ns'], parsed['tamano'], len(parsed['filas']),
+             parsed['filas_origen'], parsed['checksum'], datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+
+
+def pending_sources(connection, data_dir, sources):
+    done = {
+        source: (mtime_ns, size)
+        for source, mtime_ns, size in connection.execute("SELECT fuente, mtime_ns, tamano FROM migracion")
+    }
+    pending = []
+    for source, table in sources:
+        stat = os.stat(os.path.join(data_dir, source))
+        if done.get(source) != (stat.st_mtime_ns, stat.st_size):
+            pending.append((source, table))
+    return pending
+
+
+def remove_missing_sources(connection, sources):
+    # Archivos migrados antes que ya no existen (archivados o purgados)
+    current = {source for source, _ in sources}
+    removed = []
+    for source, table in connection.execute("SELECT fuente, tabla FROM migracion").fetchall():
+        if source not in current:
+            with connection:
+                connection.execute(f"DELETE FROM {table} WHERE fuente = ?", (source,))
+                connection.execute("DELETE FROM migracion WHERE fuente = ?", (source,))
+            removed.append(source)
+    return removed
+
+
+def verify_store(connection):
+    # Recalcula filas y checksum de todo lo migrado contra lo registrado
+    problems = []
+    records = connection.execute("SELECT fuente, tabla, filas, checksum FROM migracion").fetchall()
+    for source, table, count, checksum in records:
+        rows = stored_rows(connection, source, table)
+        if len(rows) != count:
+            problems.append(f"{source}: {len(rows)} filas en la base, {count} registradas")
+        elif rows_checksum(rows) != checksum:
+            problems.append(f"{source}: checksum distinto al registrado")
+    totals = {table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+    return {'fuentes': len(records), 'filas': totals, 'problemas': problems}
+
+
+def migrate(data_dir, db_path, workers, restart=False):
+    connection = open_store(db_path)
+    if restart:
+        with connection:
+            for table in list(tables) + ['migracion']:
+                connection.execute(f"DELETE FROM {table}")
+    sources = list_sources(data_dir)
+    removed = remove_missing_sources(connection, sources)
+    pending = pending_sources(connection, data_dir, sources)
+    report = {
+        'directorio': data_dir, 'base': db_path, 'fuentes': len(sources),
+        'ya_migradas': len(sources) - len(pending), 'migradas': 0,
+        'eliminadas': removed, 'duplicados_descartados': 0, 'filas_invalidas': 0, 'errores': [],
+    }
+    start = time.perf_counter()
+    # spawn: los procesos no heredan el estado de Streamlit del proceso principal
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {pool.submit(parse_source, data_dir, source, table): source for source, table in pending}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                parsed = future.result()
+                load_source(connection, parsed)
+            except Exception as e:
+                report['errores'].append(f"{source}: {e}")
+                continue
+            report['migradas'] += 1
+            report['duplicados_descartados'] += parsed['duplicados']
+            report['filas_invalidas'] += parsed['invalidas']
+            print(f"  {source}: {len(parsed['filas'])} filas", file=sys.stderr)
+    report['segundos'] = round(time.perf_counter() - start, 2)
+    report['verificacion'] = verify_store(connection)
+    connection.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migración de los archivos Excel de Lab Sync a SQLite")
+    parser.add_argument('--data-dir', default=os.environ.get('LABSYNC_DATA_DIR', '.'))
+    parser.add_argument('--db', default=None, help="Por defecto <data-dir>/labsync.db")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--verify-only', action='store_true', help="No migra, solo verifica lo ya migrado")
+    parser.add_argument('--restart', action='store_true', help="Descarta el progreso y migra todo de nuevo")
+    args = parser.parse_args()
+    data_dir = os.path.abspath(args.data_dir)
+    db_path = args.db or os.path.join(data_dir, 'labsync.db')
+
+    if args.verify_only:
+        connection = open_store(db_path)
+        report = verify_store(connection)
+        connection.close()
+        ok = not report['problemas']
+    else:
+        report = migrate(data_dir, db_path, args.workers, args.restart)
+        ok = not report['errores'] and not report['verificacion']['problemas']
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
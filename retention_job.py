@@ -0,0 +1,20 @@
+# retention_job.py
+# Ejecuta la política de retención fuera de la app (por ejemplo desde cron):
+#   python retention_job.py            -> archiva y purga
+#   python retention_job.py --dry-run  -> solo muestra lo que haría
+import argparse
+import json
+
+import appv3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retención y compactación de archivos de Lab Sync")
+    parser.add_argument('--dry-run', action='store_true', help="No modifica archivos, solo reporta")
+    args = parser.parse_args()
+    report = appv3.run_retention_job(dry_run=args.dry_run)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
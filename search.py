@@ -0,0 +1,139 @@
+# search.py
+# Índice invertido para la búsqueda de texto completo del panel de
+# administración. Cada documento (una reserva o un comentario) pertenece a
+# una fuente (un archivo del día, un mes archivado, el archivo de
+# comentarios); al cambiar una fuente solo se quitan y agregan sus
+# documentos distintos. Las consultas se responden con las listas de
+# términos y un ranking BM25, sin recorrer el historial. Sin Streamlit.
+import bisect
+import heapq
+import math
+import re
+import unicodedata
+from collections import Counter
+
+stopwords = {
+    'a', 'al', 'con', 'de', 'del', 'el', 'en', 'es', 'la', 'las', 'lo', 'los',
+    'para', 'por', 'se', 'su', 'un', 'una', 'y', 'o', 'que',
+}
+bm25_k1 = 1.2
+bm25_b = 0.75
+# Peso de un término que solo coincide por prefijo ("robot" -> "robotica")
+prefix_weight = 0.7
+
+
+def tokenize(text):
+    # Minúsculas y sin tildes: "Robótica" y "robotica" son el mismo término
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return [t for t in re.findall(r'[a-z0-9]+', text) if len(t) > 1 and t not in stopwords]
+
+
+def new_index():
+    return {'sources': {}, 'docs': {}, 'postings': {}, 'total_length': 0, 'vocabulary': None}
+
+
+def add_document(index, doc_id, fields, text):
+    terms = Counter(tokenize(text))
+    index['docs'][doc_id] = dict(fields, terms=dict(terms), length=sum(terms.values()))
+    for term, tf in terms.items():
+        if term not in index['postings']:
+            index['vocabulary'] = None
+        index['postings'].setdefault(term, {})[doc_id] = tf
+    index['total_length'] += sum(terms.values())
+
+
+def remove_document(index, doc_id):
+    doc = index['docs'].pop(doc_id, None)
+    if doc is None:
+        return
+    for term in doc['terms']:
+        postings = index['postings'].get(term, {})
+        postings.pop(doc_id, None)
+        if not postings:
+            index['postings'].pop(term, None)
+            index['vocabulary'] = None
+    index['total_length'] -= doc['length']
+
+
+def update_source(index, source, version, documents):
+    # documents: {doc_id: (campos, texto)}. Los documentos que siguen en la
+    # fuente no se vuelven a tokenizar.
+    previous = set(index['sources'].get(source, {}).get('docs', []))
+    for doc_id in previous - set(documents):
+        remove_document(index, doc_id)
+    for doc_id, (fields, text) in documents.items():
+        if doc_id not in previous:
+            add_document(index, doc_id, fields, text)
+    index['sources'][source] = {'version': version, 'docs': list(documents)}
+
+
+def remove_source(index, source):
+    for doc_id in index['sources'].pop(source, {}).get('docs', []):
+        remove_document(index, doc_id)
+
+
+def dump_index(index):
+    return {'sources': index['sources'], 'docs': index['docs']}
+
+
+def load_index(stored):
+    # Las listas de términos se reconstruyen a partir de los documentos
+    index = new_index()
+    index['sources'] = stored.get('sources', {})
+    index['docs'] = stored.get('docs', {})
+    for doc_id, doc in index['docs'].items():
+        for term, tf in doc['terms'].items():
+            index['postings'].setdefault(term, {})[doc_id] = tf
+        index['total_length'] += doc['length']
+    return index
+
+
+def expand_term(index, token):
+    # Términos del vocabulario que empiezan con el token (búsqueda binaria
+    # sobre el vocabulario ordenado, que solo se reordena si cambió)
+    if index['vocabulary'] is None:
+        index['vocabulary'] = sorted(index['postings'])
+    vocabulary = index['vocabulary']
+    matches = {}
+    i = bisect.bisect_left(vocabulary, token)
+    while i < len(vocabulary) and vocabulary[i].startswith(token):
+        matches[vocabulary[i]] = 1.0 if vocabulary[i] == token else prefix_weight
+        i += 1
+    return matches
+
+
+def search(index, query, kinds=None, limit=50):
+    # Todos los términos de la consulta deben aparecer (exactos o por prefijo)
+    tokens = list(dict.fromkeys(tokenize(query)))
+    if not tokens or not index['docs']:
+        return []
+    n_docs = len(index['docs'])
+    avg_length = index['total_length'] / n_docs or 1
+    scores = None
+    for token in tokens:
+        token_scores = {}
+        for term, weight in expand_term(index, token).items():
+            postings = index['postings'][term]
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                length = index['docs'][doc_id]['length']
+                score = weight * idf * tf * (bm25_k1 + 1) / (
+                    tf + bm25_k1 * (1 - bm25_b + bm25_b * length / avg_length)
+                )
+                token_scores[doc_id] = max(token_scores.get(doc_id, 0.0), score)
+        if scores is None:
+            scores = token_scores
+        else:
+            scores = {doc_id: s + token_scores[doc_id] for doc_id, s in scores.items() if doc_id in token_scores}
+        if not scores:
+            return []
+    if kinds:
+        scores = {doc_id: s for doc_id, s in scores.items() if index['docs'][doc_id]['Tipo'] in kinds}
+    best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], index['docs'][item[0]].get('Fecha', '')))
+    results = []
+    for doc_id, score in best:
+        doc = {k: v for k, v in index['docs'][doc_id].items() if k not in ('terms', 'length')}
+        doc['Puntaje'] = round(score, 3)
+        results.append(doc)
+    return results
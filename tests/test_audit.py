@@ -0,0 +1,93 @@
+import os
+
+import audit
+
+
+def paths(tmp_path):
+    return str(tmp_path / 'audit.log'), str(tmp_path / 'audit.idx')
+
+
+def append_many(log, idx, count, start=1000, step=10):
+    for i in range(count):
+        audit.append_event(log, idx, start + i * step, 'Bloqueo de horario', 'admin@up.edu.pe', f"B501-{i}", f"detalle {i}")
+
+
+def test_encode_decode_round_trip_with_unicode():
+    data = audit.encode_record(123, 'Eliminación de reserva', 'admin@up.edu.pe', 'ñandú@alum.up.edu.pe', 'Día 2026-03-02 - C402')
+    event, size = audit.decode_record(data + b'resto')
+    assert size == len(data)
+    assert event == {
+        'ts': 123, 'accion': 'Eliminación de reserva', 'usuario': 'admin@up.edu.pe',
+        'objetivo': 'ñandú@alum.up.edu.pe', 'detalle': 'Día 2026-03-02 - C402',
+    }
+
+
+def test_decode_incomplete_record_returns_none():
+    data = audit.encode_record(1, 'Acceso al C402', 'a', 'b', 'c')
+    assert audit.decode_record(data[:-1]) == (None, 0)
+    assert audit.decode_record(data[:5]) == (None, 0)
+
+
+def test_long_text_is_cut_on_a_character_boundary():
+    data = audit.encode_text('ñ' * audit.max_text_bytes)
+    assert len(data) <= audit.max_text_bytes
+    assert data.decode('utf-8') == 'ñ' * (audit.max_text_bytes // 2)
+
+
+def test_time_range_lookup_and_paging(tmp_path):
+    log, idx = paths(tmp_path)
+    append_many(log, idx, 25)
+    assert audit.index_count(idx) == 25
+    events, total = audit.read_events(log, idx, start_ms=1050, end_ms=1150, page=0, page_size=4)
+    assert total == 11
+    assert [e['objetivo'] for e in events] == ['B501-15', 'B501-14', 'B501-13', 'B501-12']
+    last_page, _ = audit.read_events(log, idx, start_ms=1050, end_ms=1150, page=2, page_size=4)
+    assert [e['objetivo'] for e in last_page] == ['B501-7', 'B501-6', 'B501-5']
+    assert audit.read_events(log, idx, start_ms=1050, end_ms=1150, page=3, page_size=4) == ([], 11)
+    assert audit.read_events(log, idx, start_ms=5000) == ([], 0)
+
+
+def test_timestamps_never_go_backwards(tmp_path):
+    log, idx = paths(tmp_path)
+    assert audit.append_event(log, idx, 2000, 'Cuenta creada', 'admin', 'x') == 2000
+    assert audit.append_event(log, idx, 1500, 'Cuenta creada', 'admin', 'y') == 2000
+    events, total = audit.read_events(log, idx, start_ms=2000, end_ms=2000)
+    assert total == 2
+    assert [e['objetivo'] for e in events] == ['y', 'x']
+
+
+def test_empty_log_reads_nothing(tmp_path):
+    log, idx = paths(tmp_path)
+    assert audit.read_events(log, idx) == ([], 0)
+    assert audit.sync_index(log, idx) == 0
+
+
+def test_recovers_event_written_without_index_entry(tmp_path):
+    log, idx = paths(tmp_path)
+    append_many(log, idx, 3)
+    # Caída entre la escritura del registro y la del índice
+    with open(log, 'ab') as f:
+        f.write(audit.encode_record(1030, 'Acceso al C402', 'admin', 'sin-indice', ''))
+    assert audit.index_count(idx) == 3
+    assert audit.sync_index(log, idx) == 1030
+    assert audit.index_count(idx) == 4
+    events, total = audit.read_events(log, idx)
+    assert total == 4
+    assert events[0]['objetivo'] == 'sin-indice'
+
+
+def test_discards_half_written_record_and_index_entry(tmp_path):
+    log, idx = paths(tmp_path)
+    append_many(log, idx, 3)
+    log_size = os.path.getsize(log)
+    with open(log, 'ab') as f:
+        f.write(audit.encode_record(1030, 'Acceso al C402', 'admin', 'cortado', 'x')[:-3])
+    with open(idx, 'ab') as f:
+        f.write(b'\x00' * 5)
+    audit.append_event(log, idx, 1040, 'Cuenta creada', 'admin', 'siguiente')
+    assert os.path.getsize(idx) == 4 * audit.index_entry.size
+    events, total = audit.read_events(log, idx)
+    assert total == 4
+    assert [e['objetivo'] for e in events] == ['siguiente', 'B501-2', 'B501-1', 'B501-0']
+    with open(log, 'rb') as f:
+        assert audit.read_record(f, log_size)[0]['objetivo'] == 'siguiente'
@@ -0,0 +1,89 @@
+import json
+
+import search
+
+
+def reservation(doc_id, text, fecha='2026-03-02'):
+    return doc_id, ({'Tipo': 'Reserva', 'Fecha': fecha, 'id': doc_id}, text)
+
+
+def build(sources):
+    index = search.new_index()
+    for source, docs in sources.items():
+        search.update_source(index, source, 1, dict(reservation(*doc) for doc in docs))
+    return index
+
+
+def ids(results):
+    return [r['id'] for r in results]
+
+
+def test_tokenize_drops_accents_stopwords_and_single_letters():
+    assert search.tokenize("Práctica de Robótica y C") == ['practica', 'robotica']
+
+
+def test_bm25_ranks_rarer_and_denser_matches_first():
+    index = build({'dia-1': [
+        ('a', "robotica robotica arduino"),
+        ('b', "robotica arduino sensores motores laboratorio grupo"),
+        ('c', "arduino sensores"),
+    ]})
+    results = search.search(index, "robotica")
+    assert ids(results) == ['a', 'b']
+    assert results[0]['Puntaje'] > results[1]['Puntaje'] > 0
+    assert 'terms' not in results[0] and 'length' not in results[0]
+
+
+def test_all_query_terms_must_match():
+    index = build({'dia-1': [('a', "robotica arduino"), ('b', "robotica sensores")]})
+    assert ids(search.search(index, "robotica sensores")) == ['b']
+    assert search.search(index, "robotica quimica") == []
+
+
+def test_prefix_expansion_scores_below_exact_match():
+    index = build({'dia-1': [('a', "robot movil"), ('b', "robotica movil")]})
+    assert search.expand_term(index, 'robot') == {'robot': 1.0, 'robotica': search.prefix_weight}
+    results = search.search(index, "robot")
+    assert ids(results) == ['a', 'b']
+    assert results[0]['Puntaje'] > results[1]['Puntaje']
+
+
+def test_kinds_filter_and_limit():
+    index = build({'dia-1': [('a', "impresora"), ('b', "impresora")]})
+    search.update_source(index, 'comentarios', 1, {'c': ({'Tipo': 'Comentario', 'id': 'c'}, "impresora")})
+    assert ids(search.search(index, "impresora", kinds=['Comentario'])) == ['c']
+    assert len(search.search(index, "impresora", limit=2)) == 2
+
+
+def test_update_source_replaces_only_changed_documents():
+    index = build({'dia-1': [('a', "robotica"), ('b', "quimica")]})
+    kept = index['docs']['a']
+    search.update_source(index, 'dia-1', 2, dict([reservation('a', "robotica"), reservation('c', "fisica")]))
+    assert index['docs']['a'] is kept
+    assert set(index['docs']) == {'a', 'c'}
+    assert 'quimica' not in index['postings']
+    assert search.search(index, "quimica") == []
+    assert ids(search.search(index, "fisica")) == ['c']
+    assert index['sources']['dia-1']['version'] == 2
+    assert index['total_length'] == 2
+
+
+def test_remove_source_drops_its_documents_and_terms():
+    index = build({'dia-1': [('a', "robotica")], 'dia-2': [('b', "robotica quimica")]})
+    search.expand_term(index, 'q')
+    search.remove_source(index, 'dia-2')
+    assert set(index['docs']) == {'a'}
+    assert 'quimica' not in index['postings']
+    assert search.expand_term(index, 'q') == {}
+    assert ids(search.search(index, "robotica")) == ['a']
+    assert index['total_length'] == 1
+
+
+def test_dump_and_load_round_trip_through_json():
+    index = build({'dia-1': [('a', "robotica arduino"), ('b', "quimica")], 'dia-2': [('c', "robotica")]})
+    restored = search.load_index(json.loads(json.dumps(search.dump_index(index))))
+    assert restored['postings'] == index['postings']
+    assert restored['total_length'] == index['total_length']
+    assert search.search(restored, "robot") == search.search(index, "robot")
+    search.update_source(restored, 'dia-1', 2, {})
+    assert ids(search.search(restored, "robotica")) == ['c']